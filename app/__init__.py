@@ -4,6 +4,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_bootstrap import Bootstrap4
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -12,6 +15,16 @@ login.login_view = 'authentication.login'
 bootstrap = Bootstrap4()
 
 
+# SQLite databases are switched to write-ahead logging so pages and status
+# checks can still read while an import job holds a long write transaction.
+@event.listens_for(Engine, 'connect')
+def set_sqlite_journal_mode(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
@@ -54,7 +67,12 @@ def create_app(config_class=Config):
     from app.user import bp as user_bp
     app.register_blueprint(user_bp)
 
+    if app.config['RECOVER_IMPORT_JOBS']:
+        from app.jobs import recover_import_jobs
+        recover_import_jobs(app)
+
     return app
 
 
 from app import models
+from app import rollups
@@ -22,6 +22,7 @@ class CustodianForm(FlaskForm):
 
 class UploadFileForm(FlaskForm):
     upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
     submit = SubmitField('Upload')
 
 
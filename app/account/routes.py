@@ -1,12 +1,12 @@
-from flask import render_template, redirect, url_for
-from flask_login import login_required
+from flask import render_template, flash, redirect, url_for
+from flask_login import login_required, current_user
 from app import db
-from app.models import (Client, Account, Custodian, Quarter)
+from app.models import (Client, Account, Custodian)
 from app.account.forms import (AccountForm, CustodianForm, UploadFileForm,
                                ExportToFileForm)
 from app.account import bp
-from app.route_helpers import (get_custodian_choices, get_fee_schedule_choices, upload_file,
-                               process_account_csv_file)
+from app.route_helpers import get_custodian_choices, get_fee_schedule_choices
+from app.jobs import submit_import_job
 from werkzeug.utils import secure_filename
 import os
 
@@ -58,9 +58,10 @@ def add_account(client_id):
 def upload_accounts():
     form = UploadFileForm()
     if form.validate_on_submit():
-        f = form.upload_file.data
-        process_account_csv_file(file_object=f)
-        return redirect(url_for('account.view_accounts'))
+        job = submit_import_job(kind='accounts', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_account_file.html', title='Upload Accounts', form=form)
 
 
@@ -114,11 +115,7 @@ def edit_account(account_id):
 def delete_account(account_id):
     account = Account.query.get(int(account_id))
     for snapshot in account.snapshots:
-        quarter = Quarter.query.get(snapshot.quarter_id)
-        quarter.aum -= snapshot.market_value
-        quarter.fee -= snapshot.fee
         db.session.delete(snapshot)
-        db.session.add(quarter)
     db.session.delete(account)
     db.session.commit()
     return redirect(url_for('account.view_accounts'))
@@ -0,0 +1,216 @@
+from flask import current_app
+from contextlib import contextmanager
+from datetime import datetime, timedelta, time as clock_time
+from threading import Lock, Thread
+from zoneinfo import ZoneInfo
+import sqlite3
+import hashlib
+import json
+import zlib
+import os
+import time
+
+MARKET_TIMEZONE = ZoneInfo('America/New_York')
+# Daily bars are published shortly after the 16:00 close, so cached daily data
+# is kept until half an hour past the next close
+MARKET_CLOSE = clock_time(16, 30)
+# Intraday interval -> seconds a response for it stays fresh
+INTRADAY_INTERVALS = {'1min': 60, '5min': 300, '15min': 900, '30min': 1800, '60min': 3600}
+# Share of the maximum size the cache is trimmed down to when it overflows
+EVICTION_TARGET = 0.9
+
+_cache = None
+_cache_lock = Lock()
+
+
+# PRE:  fetched is a unix timestamp
+# POST: RV = unix timestamp of the first market close after fetched, skipping
+#        weekends. Market holidays are not skipped; a response fetched on one
+#        is refreshed once more than needed.
+def get_next_market_close(fetched):
+    moment = datetime.fromtimestamp(fetched, MARKET_TIMEZONE)
+    close = datetime.combine(moment.date(), MARKET_CLOSE, tzinfo=MARKET_TIMEZONE)
+    while close <= moment or close.weekday() >= 5:
+        close = datetime.combine(close.date() + timedelta(days=1), MARKET_CLOSE, tzinfo=MARKET_TIMEZONE)
+    return close.timestamp()
+
+
+# PRE:  now is a unix timestamp, defaulting to the current time
+# POST: RV = date of the latest trading day whose daily bar is published as of
+#        now: today once past MARKET_CLOSE on a weekday, otherwise the weekday
+#        before. Market holidays are not skipped.
+def get_last_trading_day(now=None):
+    moment = datetime.fromtimestamp(time.time() if now is None else now, MARKET_TIMEZONE)
+    day = moment.date()
+    if moment.time() < MARKET_CLOSE:
+        day -= timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day
+
+
+# PRE:  params is the dictionary of arguments of an Alpha Vantage call
+#       fetched is the unix timestamp the response was fetched at
+# POST: RV = unix timestamp the response stops being fresh: one interval later
+#        for intraday data and the next market close for everything else
+def get_expiry(params, fetched):
+    interval = params.get('interval')
+    if interval in INTRADAY_INTERVALS:
+        return fetched + INTRADAY_INTERVALS[interval]
+    return get_next_market_close(fetched=fetched)
+
+
+class AlphaVantageCache(object):
+    # PRE:  path is the path of the SQLite file the responses are stored in
+    #       max_bytes is the maximum total size of the stored response bodies
+    #       stale_seconds is how long past its expiry a response may still be
+    #        served while it is refreshed in the background
+    def __init__(self, path, max_bytes, stale_seconds):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self.refreshing = set()
+        self.refreshing_lock = Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, function TEXT, '
+                               'symbol TEXT, params TEXT, body BLOB, size INTEGER, fetched REAL, expires REAL, '
+                               'accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_response_accessed ON response (accessed)')
+
+    # POST: RV is a context manager over a new connection to the cache file,
+    #        committed and closed on exit. Each use opens its own so background
+    #        refreshes never share a connection across threads.
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    # PRE:  function is the name of an Alpha Vantage client method
+    #       params is the dictionary of arguments it is called with
+    # POST: RV = the cache key of the call, independent of argument order
+    @staticmethod
+    def get_key(function, params):
+        return hashlib.sha1(json.dumps([function, params], sort_keys=True, default=str).encode()).hexdigest()
+
+    # POST: RV = (value, expires) of the stored response for key, or None. The
+    #        entry's access time has been updated for eviction.
+    def get(self, key):
+        with self.connect() as connection:
+            row = connection.execute('SELECT body, expires FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE response SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(zlib.decompress(row[0])), row[1]
+
+    # PRE:  value is the JSON serializable response of the call
+    # POST: The response has been stored under key and, if the cache is now over
+    #        max_bytes, the least recently used responses have been evicted
+    def put(self, key, function, params, value):
+        body = zlib.compress(json.dumps(value).encode())
+        fetched = time.time()
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, function, params.get('symbol'), json.dumps(params, sort_keys=True, default=str),
+                                body, len(body), fetched, get_expiry(params=params, fetched=fetched), fetched))
+            total, = connection.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()
+            if total > self.max_bytes:
+                self.evict(connection=connection, excess=total - int(self.max_bytes * EVICTION_TARGET))
+
+    # PRE:  connection is an open connection to the cache file
+    #       excess is the number of bytes to free
+    # POST: The least recently accessed responses adding up to at least excess
+    #        bytes have been deleted
+    @staticmethod
+    def evict(connection, excess):
+        keys = []
+        for key, size in connection.execute('SELECT key, size FROM response ORDER BY accessed'):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        connection.executemany('DELETE FROM response WHERE key = ?', keys)
+
+    # PRE:  fetch is a callable taking no arguments that calls the API
+    # POST: The call has been made in a background thread and its response
+    #        stored, unless a refresh of the same key is already running
+    def revalidate(self, key, function, params, fetch):
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.put(key=key, function=function, params=params, value=fetch())
+            except Exception:
+                # The stale response keeps being served and the next call retries
+                pass
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(key)
+
+        Thread(target=refresh, name='alpha-vantage-refresh', daemon=True).start()
+
+    # PRE:  function is the name of an Alpha Vantage client method
+    #       params is the dictionary of arguments it is called with
+    #       fetch is a callable taking no arguments that calls the API
+    # POST: RV = the response of the call. A fresh stored response is returned
+    #        without calling the API. A response past its expiry but within
+    #        stale_seconds is returned while it is refreshed in the background.
+    #        Otherwise the API is called and the response stored; if that call
+    #        fails, any stored response is returned instead of the error.
+    def fetch(self, function, params, fetch):
+        key = self.get_key(function=function, params=params)
+        cached = self.get(key=key)
+        now = time.time()
+        if cached is not None:
+            value, expires = cached
+            if now < expires:
+                return value
+            if now < expires + self.stale_seconds:
+                self.revalidate(key=key, function=function, params=params, fetch=fetch)
+                return value
+        try:
+            value = fetch()
+        except Exception:
+            if cached is None:
+                raise
+            return cached[0]
+        self.put(key=key, function=function, params=params, value=value)
+        return value
+
+
+# POST: RV = the AlphaVantageCache configured for the current application,
+#        created on first use
+def get_alpha_vantage_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = current_app.config
+            _cache = AlphaVantageCache(path=config['ALPHAVANTAGE_CACHE_PATH'],
+                                       max_bytes=config['ALPHAVANTAGE_CACHE_MAX_BYTES'],
+                                       stale_seconds=config['ALPHAVANTAGE_CACHE_STALE_SECONDS'])
+        return _cache
+
+
+# PRE:  client_class is TimeSeries or TechIndicators from alpha_vantage
+#       function is the name of one of its methods, such as 'get_daily_adjusted'
+#       params are the keyword arguments the method is called with
+# POST: RV = (data, meta_data) as returned by the method, served from the disk
+#        cache when a stored response for the same client, method and
+#        arguments is still usable
+def call_alpha_vantage(client_class, function, **params):
+    def fetch():
+        client = client_class(key=os.environ['ALPHAVANTAGE_API_KEY'])
+        return getattr(client, function)(**params)
+
+    data, meta_data = get_alpha_vantage_cache().fetch(function='{}.{}'.format(client_class.__name__, function),
+                                                      params=params, fetch=fetch)
+    return data, meta_data
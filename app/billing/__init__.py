@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('billing', __name__, template_folder='templates')
 
-from app.billing import routes
+from app.billing import routes, commands
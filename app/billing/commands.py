@@ -0,0 +1,70 @@
+from flask import current_app
+from app import create_app, db
+from app.billing import bp
+from app.billing.route_helpers import (generate_group_snapshots_set_based, generate_group_fees,
+                                       generate_account_fees)
+from app.models import Quarter
+from app.rollups import refresh_quarter_rollups
+from config import Config
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import click
+import time
+
+BILLING_STAGES = [('snapshots', generate_group_snapshots_set_based),
+                  ('group fees', generate_group_fees),
+                  ('account fees', generate_account_fees),
+                  ('rollups', refresh_quarter_rollups)]
+
+
+# Pre:  quarter_name is the name of a Quarter
+#       database_uri is the SQLALCHEMY_DATABASE_URI of the application that
+#        launched the run
+# Post: The snapshot, fee, and rollup stages have been run for the quarter in a
+#        fresh application on the launching application's database so the call
+#        can run in its own process. Import job recovery is left to the
+#        launching application.
+#       RV = {'quarter': quarter_name, 'stages': [(stage, rows, seconds)],
+#             'error': None or a description of the failure}
+def run_quarter_pipeline(quarter_name, database_uri):
+    config_class = type('BillingWorkerConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                           'RECOVER_IMPORT_JOBS': False})
+    app = create_app(config_class)
+    with app.app_context():
+        result = {'quarter': quarter_name, 'stages': [], 'error': None}
+        quarter = Quarter.query.filter_by(name=quarter_name).first()
+        if quarter is None:
+            result['error'] = 'quarter not found'
+            return result
+        for stage, function in BILLING_STAGES:
+            start = time.perf_counter()
+            try:
+                rows = function(quarter_id=quarter.id)
+            except Exception as error:
+                db.session.rollback()
+                result['error'] = '{} failed: {}'.format(stage, error)
+                return result
+            result['stages'].append((stage, rows, time.perf_counter() - start))
+        return result
+
+
+@bp.cli.command('run')
+@click.argument('quarter_names', nargs=-1, required=True)
+@click.option('--workers', type=int, default=None,
+              help='Number of quarters processed at once. Defaults to 1 on SQLite, where concurrent writers '
+                   'only wait on the database lock, and to one per CPU on server databases such as PostgreSQL.')
+def run_billing(quarter_names, workers):
+    """Run the snapshot, fee, and rollup pipeline for each quarter."""
+    database_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+    if workers is None and database_uri.startswith('sqlite'):
+        workers = 1
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(run_quarter_pipeline, quarter_name, database_uri) for quarter_name in quarter_names]
+        for future in as_completed(futures):
+            result = future.result()
+            stages = ' | '.join('{} {} rows {:.2f}s'.format(stage, rows, seconds)
+                                for stage, rows, seconds in result['stages'])
+            if result['error'] is not None:
+                stages = ' | '.join(part for part in (stages, 'ERROR ' + result['error']) if part)
+            click.echo('{}: {}'.format(result['quarter'], stages))
@@ -0,0 +1,195 @@
+from flask import current_app
+from app import db
+from app.models import Quarter, GroupSnapshot, AccountSnapshot
+from sqlalchemy.orm import aliased
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+from queue import Queue, Full
+import csv
+import os
+
+FEE_FILE_COLUMNS = ['client_name', 'group_name', 'account_number', 'description', 'group_market_value',
+                    'market_value', 'group_weight', 'group_fee', 'fee']
+
+
+class CustodianFeeFileWriter(object):
+    header = ['Account Number', 'Client Name', 'Group Name', 'Account Market Value', 'Account Fee']
+
+    # PRE:  directory is the folder the files are written to
+    #       custodian is the custodian name the rows belong to
+    def __init__(self, directory, custodian):
+        self.directory = directory
+        self.custodian = custodian
+        self.paths = []
+
+    # POST: RV = the path of the fee file for self.custodian, recorded in
+    #        self.paths so a failed write can remove it
+    def get_path(self, suffix='fees'):
+        path = os.path.join(self.directory, secure_filename('{}_{}.csv'.format(self.custodian, suffix)))
+        self.paths.append(path)
+        return path
+
+    # POST: Every file this writer started has been deleted
+    def remove_files(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # PRE:  row is a dictionary keyed by FEE_FILE_COLUMNS
+    # POST: RV = the list of values written for row
+    def format_row(self, row):
+        return [row['account_number'], row['client_name'], row['group_name'], row['market_value'], row['fee']]
+
+    # PRE:  rows is an iterable of dictionaries keyed by FEE_FILE_COLUMNS
+    # POST: The custodian's fee files have been written
+    #       RV = list of paths written
+    def write(self, rows):
+        path = self.get_path()
+        with open(path, 'w', newline='') as fee_file:
+            writer = csv.writer(fee_file)
+            writer.writerow(self.header)
+            for row in rows:
+                writer.writerow(self.format_row(row))
+        return [path]
+
+
+class TDAFeeFileWriter(CustodianFeeFileWriter):
+    header = ['Client Name', 'Group Name', 'Account Number', 'Account Type', 'Group Market Value',
+              'Account Market Value', 'Weight of Account', 'Group Fee', 'Account Fee']
+
+    def format_row(self, row):
+        return [row['client_name'], row['group_name'], row['account_number'], row['description'],
+                row['group_market_value'], row['market_value'], row['group_weight'], row['group_fee'],
+                row['fee']]
+
+    # POST: The fee by account file and the group value file have been written
+    def write(self, rows):
+        group_values = {}
+        path = self.get_path(suffix='fees_by_account')
+        with open(path, 'w', newline='') as account_file:
+            writer = csv.writer(account_file)
+            writer.writerow(self.header)
+            for row in rows:
+                writer.writerow(self.format_row(row))
+                group_values[row['group_name']] = row['group_market_value']
+        group_path = self.get_path(suffix='group_value')
+        with open(group_path, 'w', newline='') as group_file:
+            writer = csv.writer(group_file)
+            for group_name in group_values:
+                writer.writerow([group_name, group_values[group_name]])
+        return [path, group_path]
+
+
+# Custodian name (lower case) -> writer class. Custodians without an entry use
+# CustodianFeeFileWriter.
+custodian_fee_file_writers = {
+    'tda': TDAFeeFileWriter,
+    'td ameritrade': TDAFeeFileWriter,
+}
+
+
+# PRE:  name is a custodian name
+#       writer_class is a subclass of CustodianFeeFileWriter
+# POST: Fee files for custodian name are written with writer_class
+def register_fee_file_writer(name, writer_class):
+    custodian_fee_file_writers[name.strip().lower()] = writer_class
+
+
+# PRE:  queue is a Queue of row dictionaries terminated by None
+# POST: RV = generator over the rows of queue
+def iterate_queue(queue):
+    row = queue.get()
+    while row is not None:
+        yield row
+        row = queue.get()
+
+
+# PRE:  queue is the Queue feeding the writer running in future
+# POST: item has been put on queue
+#       RV = True if item was sent, False if the writer has already stopped
+def send_to_writer(queue, future, item):
+    while not future.done():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+# PRE:  quarter is a Quarter
+# POST: RV = the folder the quarter's fee files are written to, under the
+#        configured FEE_FILE_FOLDER
+def get_fee_file_directory(quarter):
+    return os.path.join(current_app.config['FEE_FILE_FOLDER'], secure_filename(quarter.name))
+
+
+# PRE:  quarter is a Quarter
+# POST: RV = sorted list of the names of the fee files written for the quarter
+def list_fee_files(quarter):
+    directory = get_fee_file_directory(quarter=quarter)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+
+
+# PRE:  quarter_id is the id of a Quarter
+#       directory is the folder to write to, defaulting to get_fee_file_directory
+#       batch_size is the number of rows fetched from the database at a time
+# POST: One fee file set per custodian has been written. The rows come from one
+#        query joining each account snapshot to its group snapshot, streamed to a
+#        writer thread per custodian so the files are produced in parallel. A
+#        custodian whose writer fails gets no more rows, has its partial files
+#        deleted, and is reported in failures rather than files.
+#       RV = (files, failures) where files = {custodian: [paths written]} and
+#             failures = {custodian: description of the error}
+def write_custodian_fee_files(quarter_id, directory=None, batch_size=1000):
+    quarter = Quarter.query.get(int(quarter_id))
+    if directory is None:
+        directory = get_fee_file_directory(quarter=quarter)
+    os.makedirs(directory, exist_ok=True)
+    group_snapshot = aliased(GroupSnapshot)
+    rows = (db.session.query(AccountSnapshot.custodian, AccountSnapshot.client_name,
+                             AccountSnapshot.group_name, AccountSnapshot.account_number,
+                             AccountSnapshot.description, group_snapshot.market_value,
+                             AccountSnapshot.market_value, AccountSnapshot.group_weight,
+                             group_snapshot.fee, AccountSnapshot.fee)
+            .outerjoin(group_snapshot, group_snapshot.id == AccountSnapshot.group_snapshot_id)
+            .filter(AccountSnapshot.quarter_id == quarter.id)
+            .order_by(AccountSnapshot.group_name, AccountSnapshot.account_number)
+            .yield_per(batch_size))
+    num_custodians = (db.session.query(AccountSnapshot.custodian)
+                      .filter(AccountSnapshot.quarter_id == quarter.id).distinct().count())
+    queues = {}
+    futures = {}
+    writers = {}
+    stopped = set()
+    with ThreadPoolExecutor(max_workers=max(num_custodians, 1)) as executor:
+        try:
+            for row in rows:
+                custodian = row[0] or 'Unknown'
+                if custodian in stopped:
+                    continue
+                if custodian not in queues:
+                    writer_class = custodian_fee_file_writers.get(custodian.strip().lower(), CustodianFeeFileWriter)
+                    writers[custodian] = writer_class(directory=directory, custodian=custodian)
+                    queues[custodian] = Queue(maxsize=batch_size)
+                    futures[custodian] = executor.submit(writers[custodian].write, iterate_queue(queues[custodian]))
+                if not send_to_writer(queues[custodian], futures[custodian], dict(zip(FEE_FILE_COLUMNS, row[1:]))):
+                    stopped.add(custodian)
+        finally:
+            for custodian in queues:
+                send_to_writer(queues[custodian], futures[custodian], None)
+    files = {}
+    failures = {}
+    for custodian in futures:
+        error = futures[custodian].exception()
+        if error is not None:
+            failures[custodian] = '{}: {}'.format(type(error).__name__, error)
+        elif custodian in stopped:
+            failures[custodian] = 'writer stopped before all rows were written'
+        else:
+            files[custodian] = futures[custodian].result()
+            continue
+        writers[custodian].remove_files()
+    return files, failures
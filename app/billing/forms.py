@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import (StringField, SubmitField, DateField, SelectField, SelectMultipleField,
+from wtforms import (StringField, BooleanField, SubmitField, DateField, SelectField, SelectMultipleField,
                      FloatField)
 from wtforms.validators import InputRequired, ValidationError, Optional
 
@@ -50,6 +50,12 @@ class UploadFileForm(FlaskForm):
     submit = SubmitField('Upload')
 
 
+class ImportFileForm(FlaskForm):
+    upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
+    submit = SubmitField('Upload')
+
+
 class ExportToFileForm(FlaskForm):
     filename = StringField('Filename', validators=[InputRequired()])
     submit = SubmitField('Export')
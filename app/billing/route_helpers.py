@@ -1,62 +1,58 @@
-from app.models import Quarter, FeeSchedule
+from app.models import (Quarter, FeeSchedule, GroupSnapshot, AccountSnapshot,
+                        Account, Client, Group, Custodian, QuarterCustodianTotal, QuarterFeeScheduleTotal)
 from app import db
+from app.rollups import refresh_quarter_rollups
+from app.fee_tables import compile_fee_rules, get_compiled_fee_schedule
+from app.route_helpers import read_csv_batches, remove_duplicate_rows, ACCOUNT_VALUE_COLUMNS, FEE_SCHEDULE_COLUMNS
+from sqlalchemy import func, select, update, delete, or_
+from sqlalchemy.orm import aliased
 from datetime import date
+import numpy as np
+import time
+import csv
+import io
+import zlib
 
 
-# Pre:  groups is a dictionary of format {group_name: market_value}
-# Post: tda_group_value.csv has been written with each key-value pair
-#        on a line
-def write_tda_group_value(groups):
-    with open('tda_group_value.csv', 'w') as group_file:
-        for group in groups:
-            market_value = str(groups[group])
-            group_line = '{},{}\n'.format(group, market_value)
-            group_file.write(group_line)
-
-
-# Pre:  accounts is a dictionary of format {account_number: data}
-#        where data is a dictionary of format {client_name, group_name,
-#        account_type, group_market_value, account_market_value,
-#        weight_of_account, group_fee, account_fee}
-# Post: tda_fees_by_account.csv has been written with each key-value pair
-#        on a line
-def write_tda_fee_by_account(accounts):
-    with open('tda_fees_by_account.csv') as account_file:
-        header = '{},{},{},{},{},{},{},{},{}\n'.format('Client Name',
-                                                       'Group Name',
-                                                       'Account Number',
-                                                       'Account Type',
-                                                       'Group Market Value',
-                                                       'Account Market Value',
-                                                       'Weight of Account',
-                                                       'Group Fee',
-                                                       'Account Fee')
-        account_file.write(header)
-        for account_number in accounts:
-            account = accounts[account_number]
-            account_line = '{},{},{},{},{},{},{},{},{}\n'.format(account['client_name'],
-                                                                 account['group_name'],
-                                                                 account_number,
-                                                                 account['account_type'],
-                                                                 account['group_market_value'],
-                                                                 account['account_market_value'],
-                                                                 account['weight_of_account'],
-                                                                 account['group_fee'],
-                                                                 account['account_fee'])
-            account_file.write(account_line)
-
-
+# Pre:  quarter_id is the id of a Quarter
+# Post: Every GroupSnapshot of the quarter with a fee schedule and market value
+#        has had its fee calculated and saved with a single bulk update. Each
+#        fee schedule's compiled fee table is fetched once for the whole quarter
+#        and evaluated over all of the schedule's market values at once.
+#       RV = # of group snapshots updated
 def generate_group_fees(quarter_id):
-    quarter = Quarter.query.get(int(quarter_id))
-    for group_snapshot in quarter.group_snapshots:
-        fee_schedule = FeeSchedule.query.get(group_snapshot.fee_schedule_id)
-        group_snapshot.fee = fee_schedule.calculate_fee(value=group_snapshot.market_value)
-        db.session.add(group_snapshot)
+    rows = (db.session.query(GroupSnapshot.id, GroupSnapshot.market_value, GroupSnapshot.fee_schedule_id)
+            .filter(GroupSnapshot.quarter_id == int(quarter_id),
+                    GroupSnapshot.fee_schedule_id.isnot(None),
+                    GroupSnapshot.market_value.isnot(None))
+            .all())
+    if not rows:
+        return 0
+    snapshot_ids = np.array([row[0] for row in rows])
+    values = np.array([row[1] for row in rows], dtype=float)
+    schedule_ids = np.array([row[2] for row in rows])
+    fees = np.zeros(len(rows))
+    for fee_schedule in FeeSchedule.query.filter(FeeSchedule.id.in_(np.unique(schedule_ids).tolist())):
+        compiled = get_compiled_fee_schedule(schedule_id=fee_schedule.id,
+                                             rules_version=fee_schedule.rules_version or 0,
+                                             load_rules=fee_schedule.get_rule_tiers)
+        mask = schedule_ids == fee_schedule.id
+        fees[mask] = compiled.calculate_fees(values[mask])
+    mappings = [{'id': snapshot_id, 'fee': round(fee, 2)}
+                for snapshot_id, fee in zip(snapshot_ids.tolist(), fees.tolist())]
+    db.session.bulk_update_mappings(GroupSnapshot, mappings)
     db.session.commit()
+    refresh_quarter_rollups(quarter_id=quarter_id)
+    return len(mappings)
 
 
+# Pre:  quarter_id is the id of a Quarter whose group fees have been generated
+# Post: Every billable AccountSnapshot of the quarter has been given its weight
+#        in its group and its share of the group fee
+#       RV = # of account snapshots updated
 def generate_account_fees(quarter_id):
     quarter = Quarter.query.get(int(quarter_id))
+    count = 0
     for group_snapshot in quarter.group_snapshots:
         group_market_value = group_snapshot.market_value
         for account_snapshot in group_snapshot.account_snapshots:
@@ -64,4 +60,423 @@ def generate_account_fees(quarter_id):
                 account_snapshot.group_weight = round(account_snapshot.market_value/group_market_value, 4)
                 account_snapshot.fee = round(group_snapshot.fee * account_snapshot.group_weight, 2)
                 db.session.add(account_snapshot)
+                count += 1
     db.session.commit()
+    return count
+
+
+# Pre:  quarter_id is the id of a Quarter
+# Post: RV = {group_id: (group_snapshot_id, market_value)} for every GroupSnapshot
+#        of the quarter
+def get_group_snapshots_by_group(quarter_id):
+    rows = (db.session.query(GroupSnapshot.group_id, GroupSnapshot.id, GroupSnapshot.market_value)
+            .filter(GroupSnapshot.quarter_id == quarter_id))
+    return {group_id: (snapshot_id, market_value) for group_id, snapshot_id, market_value in rows}
+
+
+# Pre:  quarter is a Quarter
+#       group_values is a dictionary of format {group_id: market_value to add}
+#       groups is a dictionary of format {group_id: Group row}
+#       group_snapshots is a dictionary as returned by get_group_snapshots_by_group
+# Post: group_values has been added to the quarter's GroupSnapshots with bulk
+#        mappings, creating any that are missing, and group_snapshots has been
+#        updated to match
+def add_group_snapshot_values(quarter, group_values, groups, group_snapshots):
+    new_group_snapshots = []
+    updated_group_snapshots = []
+    for group_id in group_values:
+        if group_id in group_snapshots:
+            snapshot_id, market_value = group_snapshots[group_id]
+            market_value = (market_value or 0) + group_values[group_id]
+            group_snapshots[group_id] = (snapshot_id, market_value)
+            updated_group_snapshots.append({'id': snapshot_id, 'market_value': market_value})
+        else:
+            group = groups[group_id]
+            name = '{group_name} - {quarter_name}'.format(group_name=group.name, quarter_name=quarter.name)
+            new_group_snapshots.append({'date': date.today(), 'name': name, 'group_name': group.name,
+                                        'quarter_name': quarter.name, 'group_id': group.id,
+                                        'quarter_id': quarter.id, 'market_value': group_values[group_id],
+                                        'fee': 0, 'fee_schedule_id': group.fee_schedule_id})
+    db.session.bulk_insert_mappings(GroupSnapshot, new_group_snapshots)
+    db.session.bulk_update_mappings(GroupSnapshot, updated_group_snapshots)
+    if new_group_snapshots:
+        rows = (db.session.query(GroupSnapshot.group_id, GroupSnapshot.id, GroupSnapshot.market_value)
+                .filter(GroupSnapshot.quarter_id == quarter.id,
+                        GroupSnapshot.group_id.in_([row['group_id'] for row in new_group_snapshots])))
+        for group_id, snapshot_id, market_value in rows:
+            group_snapshots[group_id] = (snapshot_id, market_value)
+
+
+# Pre:  file_object is a csv file uploaded via HTML form with format
+#        date,account_number,_,_,market_value
+#       quarter_id is the id of the Quarter the values belong to
+# Post: An AccountSnapshot has been inserted for every valid row and the market
+#        values have been added to the quarter's GroupSnapshots, creating any that
+#        are missing. Accounts, clients, groups, custodians, and group snapshots
+#        are read once up front and each batch of rows is written with bulk
+#        mappings and committed. Rows already imported into the quarter are skipped.
+#       RV = {'imported': # of rows matched to an account,
+#             'unmatched': # of rows with an unknown account number,
+#             'rows': # of rows written, 'duplicates': # of rows skipped,
+#             'errors': rows rejected, 'elapsed': seconds taken}
+def import_account_values(file_object, quarter_id):
+    start = time.perf_counter()
+    quarter = Quarter.query.get(int(quarter_id))
+    accounts = {row.account_number: row for row in
+                db.session.query(Account.id, Account.account_number, Account.description,
+                                 Account.billable, Account.discretionary, Account.client_id,
+                                 Account.group_id, Account.custodian_id)}
+    client_names = {client_id: first_name + ' ' + last_name for client_id, first_name, last_name in
+                    db.session.query(Client.id, Client.first_name, Client.last_name)}
+    groups = {row.id: row for row in db.session.query(Group.id, Group.name, Group.fee_schedule_id)}
+    custodian_names = dict(db.session.query(Custodian.id, Custodian.name))
+    group_snapshots = get_group_snapshots_by_group(quarter_id=quarter.id)
+
+    errors = []
+    imported = 0
+    unmatched = 0
+    duplicates = 0
+    occurrences = {}
+    for batch in read_csv_batches(file_object=file_object, columns=ACCOUNT_VALUE_COLUMNS, errors=errors):
+        batch, skipped = remove_duplicate_rows(model=AccountSnapshot, rows=batch, columns=ACCOUNT_VALUE_COLUMNS,
+                                               occurrences=occurrences, context=(quarter.id,))
+        duplicates += skipped
+        account_rows = []
+        group_values = {}
+        for row in batch:
+            name = '{account_number} - {quarter_name}'.format(account_number=row['account_number'],
+                                                              quarter_name=quarter.name)
+            account = accounts.get(row['account_number'])
+            if account is None:
+                unmatched += 1
+                account_rows.append({'name': name, 'account_number': row['account_number'],
+                                     'date': row['date'], 'market_value': row['market_value'],
+                                     'fingerprint': row['fingerprint']})
+                continue
+            imported += 1
+            group = groups.get(account.group_id)
+            if group is not None:
+                group_values[group.id] = group_values.get(group.id, 0) + row['market_value']
+            account_rows.append({'name': name,
+                                 'account_number': account.account_number,
+                                 'description': account.description,
+                                 'billable': account.billable,
+                                 'discretionary': account.discretionary,
+                                 'client_name': client_names.get(account.client_id),
+                                 'group_name': group.name if group is not None else None,
+                                 'custodian': custodian_names.get(account.custodian_id),
+                                 'account_id': account.id,
+                                 'client_id': account.client_id,
+                                 'market_value': row['market_value'],
+                                 'date': row['date'],
+                                 'quarter_name': quarter.name,
+                                 'quarter_id': quarter.id,
+                                 'fingerprint': row['fingerprint'],
+                                 'group_id': account.group_id})
+        add_group_snapshot_values(quarter=quarter, group_values=group_values, groups=groups,
+                                  group_snapshots=group_snapshots)
+        for row in account_rows:
+            group_id = row.pop('group_id', None)
+            if group_id in group_snapshots:
+                row['group_snapshot_id'] = group_snapshots[group_id][0]
+        db.session.bulk_insert_mappings(AccountSnapshot, account_rows)
+        db.session.commit()
+    refresh_quarter_rollups(quarter_id=quarter.id)
+    return {'imported': imported, 'unmatched': unmatched, 'rows': imported + unmatched,
+            'duplicates': duplicates, 'errors': errors, 'elapsed': time.perf_counter() - start}
+
+
+# Pre:  quarter_id is the id of a Quarter
+# Post: Every AccountSnapshot of the quarter without a GroupSnapshot has been added
+#        to the GroupSnapshot of its account's group, creating any that are
+#        missing. Account snapshots are walked one at a time.
+def generate_group_snapshots_by_row(quarter_id):
+    quarter = Quarter.query.get(int(quarter_id))
+    account_snapshots = AccountSnapshot.query.filter_by(quarter_id=quarter.id,
+                                                        group_snapshot_id=None).all()
+    for account_snapshot in account_snapshots:
+        if account_snapshot.account_id is None:
+            continue
+        account = Account.query.get(account_snapshot.account_id)
+        if account is None or account.group_id is None:
+            continue
+        group = Group.query.get(account.group_id)
+        if group is not None:
+            group_snapshot = GroupSnapshot.query.filter_by(quarter_id=quarter.id, group_id=group.id).first()
+            if group_snapshot is None:
+                name = '{group_name} - {quarter_name}'.format(group_name=group.name, quarter_name=quarter.name)
+                group_snapshot = GroupSnapshot(date=date.today(), name=name,
+                                               group_name=group.name,
+                                               quarter_name=quarter.name,
+                                               market_value=account_snapshot.market_value,
+                                               fee=0, fee_schedule_id=group.fee_schedule_id,
+                                               group_id=group.id, quarter_id=quarter.id)
+            else:
+                group_snapshot.market_value += account_snapshot.market_value
+            db.session.add(group_snapshot)
+            db.session.flush()
+            account_snapshot.group_snapshot_id = group_snapshot.id
+            db.session.add(account_snapshot)
+    db.session.commit()
+
+
+# Pre:  quarter_id is the id of a Quarter
+# Post: Same result as generate_group_snapshots_by_row, computed with a GROUP BY
+#        over the quarter's unlinked account snapshots, bulk writes of the group
+#        snapshots, and one UPDATE linking the account snapshots. The number of
+#        queries does not depend on the number of accounts.
+#       RV = # of account snapshots linked to a group snapshot
+def generate_group_snapshots_set_based(quarter_id):
+    quarter = Quarter.query.get(int(quarter_id))
+    unlinked = (AccountSnapshot.quarter_id == quarter.id, AccountSnapshot.group_snapshot_id.is_(None))
+    rows = (db.session.query(Account.group_id, func.sum(AccountSnapshot.market_value), func.count())
+            .join(Account, Account.id == AccountSnapshot.account_id)
+            .filter(*unlinked, Account.group_id.isnot(None))
+            .group_by(Account.group_id).all())
+    if not rows:
+        return 0
+    group_values = {group_id: market_value for group_id, market_value, count in rows}
+    group_snapshots = get_group_snapshots_by_group(quarter_id=quarter.id)
+    groups = Group.query.filter(Group.id.in_(list(group_values))).all()
+    new_group_snapshots = []
+    updated_group_snapshots = []
+    for group in groups:
+        if group.id in group_snapshots:
+            snapshot_id, market_value = group_snapshots[group.id]
+            updated_group_snapshots.append({'id': snapshot_id,
+                                            'market_value': (market_value or 0) + group_values[group.id]})
+        else:
+            name = '{group_name} - {quarter_name}'.format(group_name=group.name, quarter_name=quarter.name)
+            new_group_snapshots.append({'date': date.today(), 'name': name, 'group_name': group.name,
+                                        'quarter_name': quarter.name, 'group_id': group.id,
+                                        'quarter_id': quarter.id, 'market_value': group_values[group.id],
+                                        'fee': 0, 'fee_schedule_id': group.fee_schedule_id})
+    db.session.bulk_insert_mappings(GroupSnapshot, new_group_snapshots)
+    db.session.bulk_update_mappings(GroupSnapshot, updated_group_snapshots)
+    group_snapshot_id = (select(GroupSnapshot.id)
+                         .where(GroupSnapshot.quarter_id == quarter.id,
+                                GroupSnapshot.group_id == Account.group_id,
+                                Account.id == AccountSnapshot.account_id)
+                         .scalar_subquery())
+    db.session.execute(update(AccountSnapshot)
+                       .where(*unlinked)
+                       .values(group_snapshot_id=group_snapshot_id)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    refresh_quarter_rollups(quarter_id=quarter.id)
+    return sum(count for group_id, market_value, count in rows)
+
+
+# Pre:  file_object is a csv file uploaded via HTML form with format
+#        schedule_name,minimum,maximum,rate,flat where maximum may be empty
+#       errors is a list collecting rows that could not be parsed
+# Post: RV = {schedule_name: [(minimum, maximum, rate, flat)]} in file order
+def parse_candidate_fee_schedules(file_object, errors):
+    candidates = {}
+    for batch in read_csv_batches(file_object=file_object, columns=FEE_SCHEDULE_COLUMNS, errors=errors):
+        for row in batch:
+            candidates.setdefault(row['name'], []).append((row['minimum'], row['maximum'],
+                                                           row['rate'], row['flat']))
+    return candidates
+
+
+# Pre:  candidates is a dictionary of format {name: [(minimum, maximum, rate, flat)]}
+#        where maximum may be None
+# Post: Nothing has been written. Every candidate has been evaluated against every
+#        historical GroupSnapshot market value through its compiled fee table,
+#        giving one schedules x snapshots matrix compared to the fee actually billed.
+#       RV = {'names': candidate names,
+#             'quarter_names': quarter names, 'group_names': group names,
+#             'actual_by_quarter': billed revenue per quarter,
+#             'revenue_by_quarter': (# of candidates, # of quarters) revenue,
+#             'delta_by_quarter': revenue_by_quarter - actual_by_quarter,
+#             'actual_by_group': billed revenue per group over all quarters,
+#             'revenue_by_group': (# of candidates, # of groups) revenue,
+#             'delta_by_group': revenue_by_group - actual_by_group}
+def simulate_fee_schedule_revenue(candidates):
+    names = list(candidates)
+    rows = (db.session.query(Quarter.name, GroupSnapshot.group_name,
+                             GroupSnapshot.market_value, GroupSnapshot.fee)
+            .join(Quarter, Quarter.id == GroupSnapshot.quarter_id)
+            .filter(GroupSnapshot.market_value.isnot(None))
+            .order_by(Quarter.from_date, Quarter.name)
+            .all())
+    quarter_names = list(dict.fromkeys(row[0] for row in rows))
+    group_names = sorted(set(row[1] or '' for row in rows))
+    quarter_index = {name: index for index, name in enumerate(quarter_names)}
+    group_index = {name: index for index, name in enumerate(group_names)}
+    quarters = np.array([quarter_index[row[0]] for row in rows], dtype=int)
+    groups = np.array([group_index[row[1] or ''] for row in rows], dtype=int)
+    values = np.array([row[2] for row in rows], dtype=float)
+    actual = np.array([row[3] or 0 for row in rows], dtype=float)
+
+    fees = np.round(np.array([compile_fee_rules(rules=candidates[name]).calculate_fees(values)
+                              for name in names]).reshape(len(names), len(values)), 2)
+    actual_by_quarter = np.bincount(quarters, weights=actual, minlength=len(quarter_names))
+    actual_by_group = np.bincount(groups, weights=actual, minlength=len(group_names))
+    revenue_by_quarter = np.zeros((len(quarter_names), len(names)))
+    revenue_by_group = np.zeros((len(group_names), len(names)))
+    np.add.at(revenue_by_quarter, quarters, fees.T)
+    np.add.at(revenue_by_group, groups, fees.T)
+    return {'names': names,
+            'quarter_names': quarter_names,
+            'group_names': group_names,
+            'actual_by_quarter': actual_by_quarter,
+            'revenue_by_quarter': revenue_by_quarter.T,
+            'delta_by_quarter': revenue_by_quarter.T - actual_by_quarter,
+            'actual_by_group': actual_by_group,
+            'revenue_by_group': revenue_by_group.T,
+            'delta_by_group': revenue_by_group.T - actual_by_group}
+
+
+# Pre:  header is the list of column names
+#       rows is an iterable of row tuples
+#       compress is True to gzip the output
+#       batch_size is the number of rows written between yields
+# Post: RV is a generator yielding header and rows as csv bytes, one chunk per
+#        batch_size rows, so memory use does not grow with the number of rows
+def stream_csv_rows(header, rows, compress=False, batch_size=1000):
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % batch_size == 0:
+            chunk = buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = buffer.getvalue().encode()
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    else:
+        yield chunk
+
+
+# Pre:  quarter_id is the id of a Quarter
+#       compress is True to gzip the output
+#       batch_size is the number of rows fetched from the database at a time
+# Post: RV is a generator yielding the quarter's account fee export as csv
+#        bytes. The rows come from one query joining each AccountSnapshot to its
+#        GroupSnapshot and are written as they are fetched, so memory use does
+#        not grow with the size of the quarter.
+def generate_quarter_csv(quarter_id, compress=False, batch_size=1000):
+    group_snapshot = aliased(GroupSnapshot)
+    rows = (db.session.query(AccountSnapshot.account_number, AccountSnapshot.group_name,
+                             group_snapshot.market_value, AccountSnapshot.market_value,
+                             AccountSnapshot.group_weight, group_snapshot.fee, AccountSnapshot.fee)
+            .outerjoin(group_snapshot, group_snapshot.id == AccountSnapshot.group_snapshot_id)
+            .filter(AccountSnapshot.quarter_id == int(quarter_id))
+            .order_by(AccountSnapshot.group_name, AccountSnapshot.account_number)
+            .yield_per(batch_size))
+    return stream_csv_rows(header=['Account Number', 'Group Name', 'Group Market Value', 'Account Market Value',
+                                   'Account Weight', 'Group Fee', 'Account Fee'],
+                           rows=rows, compress=compress, batch_size=batch_size)
+
+
+# Pre:  quarter_id is the id of a Quarter
+#       compress is True to gzip the output
+#       batch_size is the number of rows fetched from the database at a time
+# Post: RV is a generator yielding the quarter's group fee export, one row of
+#        group, market value and fee per GroupSnapshot, as csv bytes
+def generate_quarter_group_csv(quarter_id, compress=False, batch_size=1000):
+    rows = (db.session.query(GroupSnapshot.group_name, GroupSnapshot.market_value, GroupSnapshot.fee)
+            .filter(GroupSnapshot.quarter_id == int(quarter_id))
+            .order_by(GroupSnapshot.group_name)
+            .yield_per(batch_size))
+    return stream_csv_rows(header=['Group', 'Market Value', 'Fee'], rows=rows, compress=compress,
+                           batch_size=batch_size)
+
+
+# Pre:  step is a label for the report
+#       model is a mapped class
+#       criteria is a list of filter expressions on model that no longer match a
+#        row once the statement has been applied to it
+#       values is a dictionary of column values to update, or None to delete
+#       chunk_size is the maximum number of rows changed per statement
+#       report is a list the chunk results are appended to
+# Post: Every row of model matching criteria has been deleted or updated with
+#        set-based statements of at most chunk_size rows, committing after each
+#        so that readers are not locked out for the whole operation.
+#       report has been extended with {'step', 'rows', 'seconds'} for each chunk
+def apply_in_chunks(step, model, criteria, values=None, chunk_size=5000, report=None):
+    while True:
+        start = time.perf_counter()
+        ids = select(model.id).where(*criteria).limit(chunk_size).scalar_subquery()
+        if values is None:
+            statement = delete(model).where(model.id.in_(ids))
+        else:
+            statement = update(model).where(model.id.in_(ids)).values(**values)
+        result = db.session.execute(statement.execution_options(synchronize_session=False))
+        db.session.commit()
+        if report is not None:
+            report.append({'step': step, 'rows': result.rowcount, 'seconds': time.perf_counter() - start})
+        if result.rowcount < chunk_size:
+            return report
+
+
+# Pre:  quarter_id is the id of a Quarter
+# Post: The quarter, its account and group snapshots, and its rollup totals
+#        have been deleted in chunks.
+#       RV = the chunk report as built by apply_in_chunks
+def delete_quarter_data(quarter_id, chunk_size=5000):
+    quarter_id = int(quarter_id)
+    report = []
+    group_snapshot_ids = select(GroupSnapshot.id).where(GroupSnapshot.quarter_id == quarter_id)
+    apply_in_chunks('account snapshots', AccountSnapshot,
+                    [or_(AccountSnapshot.quarter_id == quarter_id,
+                         AccountSnapshot.group_snapshot_id.in_(group_snapshot_ids))],
+                    chunk_size=chunk_size, report=report)
+    apply_in_chunks('group snapshots', GroupSnapshot, [GroupSnapshot.quarter_id == quarter_id],
+                    chunk_size=chunk_size, report=report)
+    apply_in_chunks('custodian totals', QuarterCustodianTotal, [QuarterCustodianTotal.quarter_id == quarter_id],
+                    chunk_size=chunk_size, report=report)
+    apply_in_chunks('fee schedule totals', QuarterFeeScheduleTotal,
+                    [QuarterFeeScheduleTotal.quarter_id == quarter_id],
+                    chunk_size=chunk_size, report=report)
+    apply_in_chunks('quarter', Quarter, [Quarter.id == quarter_id], chunk_size=chunk_size, report=report)
+    return report
+
+
+# Pre:  snapshot_id is the id of a GroupSnapshot
+# Post: The group snapshot has been deleted after unlinking its account snapshots
+#        in chunks, and its quarter's rollups have been refreshed.
+#       RV = the chunk report as built by apply_in_chunks
+def delete_group_snapshot_data(snapshot_id, chunk_size=5000):
+    snapshot_id = int(snapshot_id)
+    quarter_id = db.session.query(GroupSnapshot.quarter_id).filter(GroupSnapshot.id == snapshot_id).scalar()
+    report = []
+    apply_in_chunks('account snapshots', AccountSnapshot, [AccountSnapshot.group_snapshot_id == snapshot_id],
+                    values={'group_snapshot_id': None}, chunk_size=chunk_size, report=report)
+    apply_in_chunks('group snapshots', GroupSnapshot, [GroupSnapshot.id == snapshot_id],
+                    chunk_size=chunk_size, report=report)
+    if quarter_id is not None:
+        refresh_quarter_rollups(quarter_id=quarter_id)
+    return report
+
+
+# Pre:  None
+# Post: Every group snapshot has been deleted after unlinking all account
+#        snapshots in chunks, and every quarter's rollups have been refreshed.
+#       RV = the chunk report as built by apply_in_chunks
+def delete_all_group_snapshot_data(chunk_size=5000):
+    report = []
+    apply_in_chunks('account snapshots', AccountSnapshot, [AccountSnapshot.group_snapshot_id.isnot(None)],
+                    values={'group_snapshot_id': None}, chunk_size=chunk_size, report=report)
+    apply_in_chunks('group snapshots', GroupSnapshot, [], chunk_size=chunk_size, report=report)
+    for quarter_id, in db.session.query(Quarter.id).all():
+        refresh_quarter_rollups(quarter_id=quarter_id)
+    return report
+
+
+# Pre:  report is a chunk report as built by apply_in_chunks
+# Post: RV = a one line summary of the rows affected and time spent per step
+def summarize_chunk_report(report):
+    steps = {}
+    for chunk in report:
+        rows, chunks, seconds = steps.get(chunk['step'], (0, 0, 0))
+        steps[chunk['step']] = (rows + chunk['rows'], chunks + 1, seconds + chunk['seconds'])
+    return '; '.join('{}: {} rows in {} chunks ({:.2f}s)'.format(step, *steps[step]) for step in steps)
@@ -1,18 +1,28 @@
-from flask import render_template, redirect, url_for
-from flask_login import login_required
+from flask import (render_template, flash, redirect, url_for, request, Response, stream_with_context,
+                   send_from_directory, abort)
+from flask_login import login_required, current_user
 from app import db
 from app.models import (Account, Client, Quarter, FeeRule, FeeSchedule, Group,
                         GroupSnapshot, AccountSnapshot)
 from app.billing.forms import (QuarterForm, AccountSnapshotForm, FeeRuleForm, FeeScheduleForm,
                                AssignFeeScheduleToGroupForm, AssignFeeScheduleToGroupsForm, UploadFileForm, ExportToFileForm,
-                               GenerateFeesByAccountForm)
+                               GenerateFeesByAccountForm, ImportFileForm)
 from app.billing import bp
-from app.billing.route_helpers import (generate_group_fees, generate_account_fees)
-from app.route_helpers import upload_file
+from app.billing.route_helpers import (generate_group_fees, generate_account_fees, import_account_values,
+                                       generate_group_snapshots_by_row, generate_group_snapshots_set_based,
+                                       parse_candidate_fee_schedules, simulate_fee_schedule_revenue,
+                                       generate_quarter_csv, generate_quarter_group_csv, delete_quarter_data,
+                                       delete_group_snapshot_data, delete_all_group_snapshot_data,
+                                       summarize_chunk_report)
+from app.billing.fee_file_writers import write_custodian_fee_files, get_fee_file_directory, list_fee_files
+from app.jobs import submit_import_job, register_import_job_kind
+from app.rollups import refresh_quarter_rollups
 from datetime import date
 import os
 from werkzeug.utils import secure_filename
 
+register_import_job_kind('account_values', import_account_values)
+
 
 @bp.route('/billing_index')
 @login_required
@@ -31,7 +41,8 @@ def view_quarters():
 @login_required
 def view_quarter(quarter_id):
     quarter = Quarter.query.get(int(quarter_id))
-    return render_template('view_quarter.html', title='View Quarter', quarter=quarter)
+    return render_template('view_quarter.html', title='View Quarter', quarter=quarter,
+                           fee_files=list_fee_files(quarter=quarter))
 
 
 @bp.route('/add_quarter', methods=['GET', 'POST'])
@@ -68,13 +79,8 @@ def edit_quarter(quarter_id):
 @bp.route('/delete_quarter/<quarter_id>')
 @login_required
 def delete_quarter(quarter_id):
-    quarter = Quarter.query.get(int(quarter_id))
-    for group_snapshot in quarter.group_snapshots:
-        for account_snapshot in group_snapshot.account_snapshots:
-            db.session.delete(account_snapshot)
-        db.session.delete(group_snapshot)
-    db.session.delete(quarter)
-    db.session.commit()
+    report = delete_quarter_data(quarter_id=quarter_id)
+    flash(summarize_chunk_report(report=report))
     return redirect(url_for('billing.view_quarters'))
 
 
@@ -142,55 +148,13 @@ def add_account_snapshot(account_id):
 @bp.route('/upload_account_values/<quarter_id>', methods=['GET', 'POST'])
 @login_required
 def upload_account_values(quarter_id):
-    form = UploadFileForm()
+    form = ImportFileForm()
     if form.validate_on_submit():
-        quarter = Quarter.query.get(int(quarter_id))
-        f = form.upload_file.data
-        lines = upload_file(file_object=f)
-        for line in lines:
-            data = line.split(',')
-            snapshot_date = date.fromisoformat(data[0].strip())
-            account_number = data[1].strip()
-            market_value = float(data[4].strip())
-            name = '{account_number} - {quarter_name}'.format(account_number=account_number,
-                                                              quarter_name=quarter.name)
-            account = Account.query.filter_by(account_number=account_number).first()
-            if account is not None:
-                client = Client.query.get(account.client_id)
-                group = Group.query.get(account.group_id)
-                group_snapshot = GroupSnapshot.query.filter_by(group_id=group.id, quarter_id=quarter.id).first()
-                if group_snapshot is None:
-                    name = '{group_name} - {quarter_name}'.format(group_name=group.name, quarter_name=quarter.name)
-                    group_snapshot = GroupSnapshot(date=date.today(), name=name, group_name=group.name,
-                                                   quarter_name=quarter.name, group_id=group.id,
-                                                   quarter_id=quarter.id, market_value=market_value,
-                                                   fee=0, fee_schedule_id=group.fee_schedule_id)
-                else:
-                    group_snapshot.market_value += market_value
-                db.session.add(group_snapshot)
-                snapshot = AccountSnapshot(name=name,
-                                           account_number=account.account_number,
-                                           description=account.description,
-                                           billable=account.billable,
-                                           discretionary=account.discretionary,
-                                           client_name=client.get_name(),
-                                           group_name=group.name,
-                                           custodian=account.get_custodian_name(),
-                                           account_id=account.id,
-                                           client_id=client.id,
-                                           market_value=market_value,
-                                           date=snapshot_date,
-                                           quarter_name=quarter.name,
-                                           quarter_id=quarter.id,
-                                           group_snapshot_id=group_snapshot.id)
-                db.session.add(snapshot)
-            else:
-                snapshot = AccountSnapshot(name=name,
-                                           account_number=account_number,
-                                           date=snapshot_date,
-                                           market_value=market_value)
-                db.session.add(snapshot)
-        return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
+        job = submit_import_job(kind='account_values', file_objects=[form.upload_file.data],
+                                user_id=current_user.id, dry_run=form.dry_run.data,
+                                context={'quarter_id': int(quarter_id)})
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_account_values.html', title='Upload Account Values', form=form)
 
 
@@ -207,12 +171,10 @@ def delete_account_snapshot(snapshot_id):
 @login_required
 def delete_all_account_snapshots():
     AccountSnapshot.query.delete()
+    db.session.commit()
     quarters = Quarter.query.all()
     for quarter in quarters:
-        quarter.aum = 0
-        quarter.fee = 0
-        db.session.add(quarter)
-    db.session.commit()
+        refresh_quarter_rollups(quarter_id=quarter.id)
     return redirect(url_for('main.index'))
 
 
@@ -233,23 +195,16 @@ def view_group_snapshot(snapshot_id):
 @bp.route('/delete_group_snapshot/<snapshot_id>')
 @login_required
 def delete_group_snapshot(snapshot_id):
-    snapshot = GroupSnapshot.query.get(int(snapshot_id))
-    for account_snapshot in snapshot.account_snapshots:
-        account_snapshot.group_snapshot_id = None
-    db.session.delete(snapshot)
-    db.session.commit()
+    report = delete_group_snapshot_data(snapshot_id=snapshot_id)
+    flash(summarize_chunk_report(report=report))
     return redirect(url_for('billing.view_group_snapshots'))
 
 
 @bp.route('/delete_all_group_snapshots')
 @login_required
 def delete_all_group_snapshots():
-    snapshots = GroupSnapshot.query.all()
-    for snapshot in snapshots:
-        for account_snapshot in snapshot.account_snapshots:
-            account_snapshot.group_snapshot_id = None
-        db.session.delete(snapshot)
-    db.session.commit()
+    report = delete_all_group_snapshot_data()
+    flash(summarize_chunk_report(report=report))
     return redirect(url_for('main.index'))
 
 @bp.route('/view_fee_schedules')
@@ -295,29 +250,30 @@ def edit_fee_schedule(schedule_id):
 @bp.route('/upload_fee_schedules', methods=['GET', 'POST'])
 @login_required
 def upload_fee_schedules():
-    form = UploadFileForm()
+    form = ImportFileForm()
     if form.validate_on_submit():
-        f = form.upload_file.data
-        lines = upload_file(file_object=f)
-        for line in lines:
-            data = line.split(',')
-            name = data[0].strip()
-            minimum = float(data[1].strip())
-            maximum = float(data[2].strip())
-            rate = float(data[3].strip())
-            flat = float(data[4].strip())
-            fee_schedule = FeeSchedule.query.filter_by(name=name).first()
-            if fee_schedule is None:
-                fee_schedule = FeeSchedule(name=name)
-                db.session.add(fee_schedule)
-            fee_rule = FeeRule(minimum=minimum, maximum=maximum, rate=rate,
-                               flat=flat, schedule_id=fee_schedule.id)
-            db.session.add(fee_rule)
-        db.session.commit()
-        return redirect(url_for('billing.view_fee_schedules'))
+        job = submit_import_job(kind='fee_schedules', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_fee_schedules.html', title='Upload Fee Schedules', form=form)
 
 
+@bp.route('/simulate_fee_schedules', methods=['GET', 'POST'])
+@login_required
+def simulate_fee_schedules():
+    form = UploadFileForm()
+    if form.validate_on_submit():
+        errors = []
+        candidates = parse_candidate_fee_schedules(file_object=form.upload_file.data, errors=errors)
+        for error in errors:
+            flash('Line {line}: {error}'.format(**error))
+        simulation = simulate_fee_schedule_revenue(candidates=candidates)
+        return render_template('simulate_fee_schedules_display.html', title='Fee Schedule Simulation',
+                               simulation=simulation)
+    return render_template('simulate_fee_schedules.html', title='Simulate Fee Schedules', form=form)
+
+
 @bp.route('/export_fee_schedules', methods=['GET', 'POST'])
 @login_required
 def export_fee_schedules():
@@ -379,6 +335,7 @@ def delete_fee_schedule(schedule_id):
     schedule = FeeSchedule.query.get(int(schedule_id))
     for rule in schedule.rules:
         db.session.delete(rule)
+    schedule.rules_changed()
     db.session.delete(schedule)
     db.session.commit()
     return redirect(url_for('billing.view_fee_schedules'))
@@ -392,6 +349,9 @@ def add_fee_rule(schedule_id):
         rule = FeeRule(minimum=form.minimum.data, maximum=form.maximum.data, rate=form.rate.data,
                        flat=form.flat.data, schedule_id=int(schedule_id))
         db.session.add(rule)
+        schedule = FeeSchedule.query.get(int(schedule_id))
+        schedule.rules_changed()
+        db.session.add(schedule)
         db.session.commit()
         return redirect(url_for('billing.view_fee_schedule', schedule_id=schedule_id))
     return render_template('add_fee_rule.html', title='Add Fee Rule', form=form)
@@ -408,6 +368,9 @@ def edit_fee_rule(rule_id):
         rule.rate = form.rate.data
         rule.flat = form.flat.data
         db.session.add(rule)
+        schedule = FeeSchedule.query.get(rule.schedule_id)
+        schedule.rules_changed()
+        db.session.add(schedule)
         db.session.commit()
         return redirect(url_for('billing.view_fee_schedule', schedule_id=rule.schedule_id))
     form.minimum.data = rule.minimum
@@ -423,6 +386,9 @@ def delete_fee_rule(rule_id):
     rule = FeeRule.query.get(int(rule_id))
     schedule_id = rule.schedule_id
     db.session.delete(rule)
+    schedule = FeeSchedule.query.get(schedule_id)
+    schedule.rules_changed()
+    db.session.add(schedule)
     db.session.commit()
     return redirect(url_for('billing.view_fee_schedule', schedule_id=schedule_id))
 
@@ -430,28 +396,10 @@ def delete_fee_rule(rule_id):
 @bp.route('/generate_group_snapshots/<quarter_id>')
 @login_required
 def generate_group_snapshots(quarter_id):
-    quarter = Quarter.query.get(int(quarter_id))
-    account_snapshots = AccountSnapshot.query.filter_by(quarter_id=quarter.id,
-                                                        group_snapshot_id=None)
-    for account_snapshot in account_snapshots:
-        account = Account.query.get(account_snapshot.account_id)
-        group = Group.query.get(account.group_id)
-        if group is not None:
-            group_snapshot = GroupSnapshot.query.filter_by(quarter_id=quarter.id, group_id=group.id).first()
-            if group_snapshot is not None:
-                name = '{group_name} - {quarter_name}'.format(group_name=group.name, quarter_name=quarter.name)
-                group_snapshot = GroupSnapshot(date=date.today(), name=name,
-                                               group_name=group.name,
-                                               quarter_name=quarter.name,
-                                               market_value=account_snapshot.market_value,
-                                               fee=0, fee_schedule_id=group.fee_schedule_id,
-                                               group_id=group.id, quarter_id=quarter.id)
-            else:
-                group_snapshot.market_value += account_snapshot.market_value
-            db.session.add(group_snapshot)
-            account_snapshot.group_snapshot_id = group_snapshot.id
-            db.session.add(group_snapshot)
-    db.session.commit()
+    if request.args.get('mode') == 'row':
+        generate_group_snapshots_by_row(quarter_id=quarter_id)
+    else:
+        generate_group_snapshots_set_based(quarter_id=quarter_id)
     return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
 
 
@@ -463,37 +411,51 @@ def calculate_fees(quarter_id):
     return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
 
 
+@bp.route('/generate_custodian_fee_files/<quarter_id>')
+@login_required
+def generate_custodian_fee_files(quarter_id):
+    files, failures = write_custodian_fee_files(quarter_id=quarter_id)
+    for custodian in files:
+        flash('{custodian}: {names}'.format(custodian=custodian,
+                                            names=', '.join(os.path.basename(path) for path in files[custodian])))
+    for custodian in failures:
+        flash('{custodian}: fee files failed, {error}'.format(custodian=custodian, error=failures[custodian]))
+    return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
+
+
+@bp.route('/download_custodian_fee_file/<quarter_id>/<filename>')
+@login_required
+def download_custodian_fee_file(quarter_id, filename):
+    quarter = Quarter.query.get(int(quarter_id))
+    if quarter is None:
+        abort(404)
+    return send_from_directory(get_fee_file_directory(quarter=quarter), filename, as_attachment=True)
+
+
 @bp.route('/update_quarter_data/<quarter_id>')
 @login_required
 def update_quarter_data(quarter_id):
-    quarter = Quarter.query.get(int(quarter_id))
-    quarter.aum = 0
-    quarter.fee = 0
-    for group_snapshot in quarter.group_snapshots:
-        quarter.aum += group_snapshot.market_value
-        quarter.fee += group_snapshot.fee
-    db.session.add(quarter)
-    db.session.commit()
+    refresh_quarter_rollups(quarter_id=quarter_id)
     return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
 
 
 @bp.route('/export_quarter_csv/<quarter_id>')
 @login_required
 def export_quarter_csv(quarter_id):
-    group_filename = 'groups'
-    account_filename = 'accounts'
-    with open(group_filename, 'w') as group_file:
-        header = 'Group,Market Value,Fee\n'
-        group_file.write(header)
-        group_snapshots = GroupSnapshot.query.filter_by(quarter_id=quarter_id).all()
-        for snapshot in group_snapshots:
-            group_file.write(snapshot.export_to_csv() + '\n')
-    with open(account_filename, 'w') as account_file:
-        header = ('Account Number,Group Name,Group Market Value,' +
-                  'Account Market Value,Account Weight,Group Fee,' +
-                  'Account Fee\n')
-        account_file.write(header)
-        account_snapshots = AccountSnapshot.query.filter_by(quarter_id=quarter_id).all()
-        for snapshot in account_snapshots:
-            account_file.write(snapshot.export_to_csv() + '\n')
-    return redirect(url_for('billing.view_quarter', quarter_id=quarter_id))
+    quarter = Quarter.query.get(int(quarter_id))
+    compress = request.args.get('gzip') == '1'
+    # ?section=groups exports one row per group snapshot instead of per account
+    if request.args.get('section') == 'groups':
+        generator = generate_quarter_group_csv
+        filename = '{quarter_name}_group_fees.csv'.format(quarter_name=quarter.name)
+    else:
+        generator = generate_quarter_csv
+        filename = '{quarter_name}_fees.csv'.format(quarter_name=quarter.name)
+    filename = secure_filename(filename)
+    mimetype = 'text/csv'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(generator(quarter_id=quarter.id, compress=compress)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import (StringField, SubmitField, RadioField, DateField, SelectMultipleField, widgets)
+from wtforms import (StringField, BooleanField, SubmitField, RadioField, DateField, SelectMultipleField, widgets)
 from wtforms.validators import InputRequired, Email
 
 
@@ -38,6 +38,7 @@ class AssignClientForm(FlaskForm):
 
 class UploadFileForm(FlaskForm):
     upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
     submit = SubmitField('Upload')
 
 
@@ -1,11 +1,11 @@
-from flask import render_template, redirect, url_for
-from flask_login import login_required
+from flask import render_template, flash, redirect, url_for
+from flask_login import login_required, current_user
 from app import db
 from app.models import Client, Group
 from app.client.forms import (ClientInformationForm, GroupForm, AssignClientsForm, AssignClientForm,
                               UploadFileForm, ExportToFileForm)
 from app.client import bp
-from app.route_helpers import upload_file, process_client_csv_file
+from app.jobs import submit_import_job
 from datetime import date
 import os
 from werkzeug.utils import secure_filename
@@ -46,9 +46,10 @@ def add_client():
 def upload_clients():
     form = UploadFileForm()
     if form.validate_on_submit():
-        f = form.upload_file.data
-        process_client_csv_file(file_object=f)
-        return redirect(url_for('client.view_clients'))
+        job = submit_import_job(kind='clients', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_client_file.html', title='Upload Clients', form=form)
 
 
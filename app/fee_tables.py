@@ -0,0 +1,98 @@
+from bisect import bisect_left
+from threading import Lock
+import numpy as np
+
+_compiled_fee_schedules = {}
+_compiled_fee_schedules_lock = Lock()
+
+
+class CompiledFeeSchedule(object):
+    # PRE:  breakpoints is a sorted list of distinct market values
+    #       cumulative_fees[i] is the fee for a value just above breakpoints[i]
+    #       rates[i] is the quarterly rate applied between breakpoints[i] and
+    #        breakpoints[i + 1]
+    #       base_fee is the fee for a value at or below breakpoints[0]
+    def __init__(self, breakpoints, cumulative_fees, rates, base_fee):
+        self.breakpoints = breakpoints
+        self.cumulative_fees = cumulative_fees
+        self.rates = rates
+        self.base_fee = base_fee
+
+    # PRE:  value is a market value
+    # POST: RV = the unrounded fee for value
+    def calculate_fee(self, value):
+        index = bisect_left(self.breakpoints, value)
+        if index == 0:
+            return self.base_fee
+        index -= 1
+        return self.cumulative_fees[index] + (value - self.breakpoints[index]) * self.rates[index]
+
+    # PRE:  values is a numpy array of market values
+    # POST: RV = numpy array of unrounded fees, one per value, found with a single
+    #        searchsorted over the breakpoints instead of one bisect per value
+    def calculate_fees(self, values):
+        values = np.asarray(values, dtype=float)
+        if not self.breakpoints:
+            return np.full(len(values), float(self.base_fee))
+        breakpoints = np.array(self.breakpoints, dtype=float)
+        index = np.searchsorted(breakpoints, values, side='left') - 1
+        below = index < 0
+        index[below] = 0
+        fees = (np.array(self.cumulative_fees, dtype=float)[index] +
+                (values - breakpoints[index]) * np.array(self.rates, dtype=float)[index])
+        fees[below] = self.base_fee
+        return fees
+
+
+# PRE:  rules is an iterable of (minimum, maximum, rate, flat) tuples where
+#        maximum may be None
+# POST: RV = a CompiledFeeSchedule charging the same fee as walking every rule
+#        the way FeeSchedule.calculate_fee does
+def compile_fee_rules(rules):
+    rules = [(minimum, float('inf') if maximum is None else maximum, rate/4, flat)
+             for minimum, maximum, rate, flat in rules]
+    base_fee = sum(flat for minimum, maximum, rate, flat in rules)
+    breakpoints = sorted(set([rule[0] for rule in rules] +
+                             [rule[1] for rule in rules if rule[1] != float('inf')]))
+    cumulative_fees = []
+    rates = []
+    for breakpoint in breakpoints:
+        fee = base_fee
+        rate = 0
+        for minimum, maximum, quarterly_rate, flat in rules:
+            if minimum <= breakpoint:
+                fee += (min(breakpoint, maximum) - minimum) * quarterly_rate
+                if maximum > breakpoint:
+                    rate += quarterly_rate
+        cumulative_fees.append(fee)
+        rates.append(rate)
+    return CompiledFeeSchedule(breakpoints=breakpoints, cumulative_fees=cumulative_fees,
+                               rates=rates, base_fee=base_fee)
+
+
+# PRE:  schedule_id is the id of a FeeSchedule
+#       rules_version is the FeeSchedule's current rules version
+#       load_rules is a callable returning the schedule's rules in the format
+#        accepted by compile_fee_rules
+# POST: RV = the CompiledFeeSchedule for (schedule_id, rules_version). The rules
+#        are only loaded and compiled when no table is cached for that key.
+def get_compiled_fee_schedule(schedule_id, rules_version, load_rules):
+    key = (schedule_id, rules_version)
+    compiled = _compiled_fee_schedules.get(key)
+    if compiled is None:
+        compiled = compile_fee_rules(rules=load_rules())
+        with _compiled_fee_schedules_lock:
+            for cached_key in list(_compiled_fee_schedules):
+                if cached_key[0] == schedule_id:
+                    del _compiled_fee_schedules[cached_key]
+            _compiled_fee_schedules[key] = compiled
+    return compiled
+
+
+# PRE:  schedule_id is the id of a FeeSchedule
+# POST: Every compiled table cached for schedule_id has been dropped
+def invalidate_compiled_fee_schedule(schedule_id):
+    with _compiled_fee_schedules_lock:
+        for cached_key in list(_compiled_fee_schedules):
+            if cached_key[0] == schedule_id:
+                del _compiled_fee_schedules[cached_key]
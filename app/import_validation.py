@@ -0,0 +1,357 @@
+from app import db
+from app.models import Client, Account, Security, Transaction, OptionQuote, AccountSnapshot, Quarter
+from app.route_helpers import (CLIENT_COLUMNS, ACCOUNT_COLUMNS, TRANSACTION_COLUMNS, OPTION_QUOTE_COLUMNS,
+                               FEE_SCHEDULE_COLUMNS, ACCOUNT_VALUE_COLUMNS, iterate_upload_lines,
+                               read_xml_batches, get_row_content_hash, get_occurrence_fingerprint)
+from flask import flash
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import chain
+from datetime import date
+import multiprocessing
+import csv
+import os
+
+VALIDATION_BATCH_SIZE = 5000
+# Files with more batches than this are checked on a process pool; smaller files
+# are checked in process, where starting the workers would cost more than it saves
+VALIDATION_POOL_MIN_BATCHES = 4
+MAX_REPORTED_ROWS = 1000
+
+# Import kind -> the column schema its rows are checked against
+VALIDATION_COLUMNS = {
+    'clients': CLIENT_COLUMNS,
+    'accounts': ACCOUNT_COLUMNS,
+    'transactions': TRANSACTION_COLUMNS,
+    'option_quotes': OPTION_QUOTE_COLUMNS,
+    'fee_schedules': FEE_SCHEDULE_COLUMNS,
+    'account_values': ACCOUNT_VALUE_COLUMNS,
+}
+
+# Reference keys the rows are checked against, set once per worker process
+_reference = {}
+
+
+# PRE:  reference is a dictionary of sets as built by load_validation_reference
+# POST: The reference keys of this process have been set to reference
+def set_validation_reference(reference):
+    global _reference
+    _reference = reference
+
+
+# PRE:  kind is a key of VALIDATION_COLUMNS
+#       row is a dictionary of parsed values
+# POST: RV = (status, message) for the foreign keys of row, where status is
+#        'ok', 'warning' (the importer handles the row but not as a match) or
+#        'error' (the importer would drop or fail on the row)
+def check_row_references(kind, row):
+    if kind == 'accounts' and (row['client_first'], row['client_last']) not in _reference['client_names']:
+        return 'error', 'unknown client {} {}'.format(row['client_first'], row['client_last'])
+    if kind == 'transactions' and row['account_number'] not in _reference['account_numbers']:
+        return 'error', 'unknown account {}'.format(row['account_number'])
+    if kind == 'option_quotes' and row['symbol'] not in _reference['symbols']:
+        return 'error', 'unknown symbol {}'.format(row['symbol'])
+    if kind == 'account_values' and row['account_number'] not in _reference['account_numbers']:
+        return 'warning', 'unknown account {}, stored unmatched'.format(row['account_number'])
+    if kind == 'fee_schedules' and row['maximum'] is not None and row['maximum'] < row['minimum']:
+        return 'error', 'maximum is below minimum'
+    return 'ok', None
+
+
+# PRE:  kind is a key of VALIDATION_COLUMNS
+#       rows is a list of (line, fields) pairs read from a csv file
+#       context is a tuple of values the rows' content hashes are scoped to
+# POST: RV = list of {'line', 'status', 'error', 'hash', 'key'} per row, checked
+#        against the schema and the reference keys of this process. 'hash' is
+#        the row's content hash and 'key' the value the kind must keep unique.
+def check_row_batch(kind, rows, context=()):
+    columns = VALIDATION_COLUMNS[kind]
+    results = []
+    for line, fields in rows:
+        result = {'line': line, 'status': 'ok', 'error': None, 'hash': None, 'key': None}
+        if len(fields) < len(columns):
+            result.update(status='error', error='expected {} columns, found {}'.format(len(columns), len(fields)))
+            results.append(result)
+            continue
+        try:
+            row = {name: parse(fields[index]) for index, (name, parse) in enumerate(columns) if name is not None}
+        except ValueError as error:
+            result.update(status='error', error=str(error))
+            results.append(result)
+            continue
+        if kind == 'option_quotes':
+            row['type'] = row['type'].lower()
+        result['status'], result['error'] = check_row_references(kind=kind, row=row)
+        result['hash'] = get_row_content_hash(row=row, columns=columns, context=context)
+        if kind == 'clients':
+            result['key'] = row['email']
+            result['client_name'] = (row['first_name'], row['last_name'])
+        elif kind == 'accounts':
+            result['key'] = row['account_number']
+        elif kind == 'account_values':
+            result['key'] = row['account_number']
+        elif kind == 'option_quotes':
+            result['key'] = (row['symbol'], row['type'], row['expiration_date'], row['strike_price'])
+        results.append(result)
+    return results
+
+
+# PRE:  file_object is a csv file uploaded via HTML form or a binary file object
+#       batch_size is the number of rows per batch
+# POST: RV is a generator over lists of (line, fields) pairs for the data rows,
+#        leaving the parsing to check_row_batch
+def read_raw_csv_batches(file_object, batch_size=VALIDATION_BATCH_SIZE):
+    reader = csv.reader(iterate_upload_lines(file_object=file_object))
+    next(reader, None)
+    batch = []
+    for fields in reader:
+        if not any(field.strip() for field in fields):
+            continue
+        batch.append((reader.line_num, fields))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# PRE:  executor is a ProcessPoolExecutor whose workers hold the reference keys
+#       kind, batches and context are passed to check_row_batch per batch
+#       window is the number of batches in flight at once
+# POST: RV is a generator over the results of check_row_batch in batch order.
+#        At most window batches are in flight, so the file is never held in
+#        memory whole.
+def check_batches_on_pool(executor, kind, batches, context, window):
+    futures = deque()
+    for batch in batches:
+        futures.append(executor.submit(check_row_batch, kind, batch, context))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+# PRE:  kind is an import kind
+#       context is a dictionary holding the 'quarter_id' for account values
+#       extra is a dictionary of reference sets to merge in, such as the keys of
+#        an earlier file of the same upload
+# POST: RV = dictionary of the reference key sets the kind's rows are checked
+#        against, read from the database
+def load_validation_reference(kind, context=None, extra=None):
+    reference = {}
+    if kind == 'clients':
+        reference['emails'] = set(email for email, in db.session.query(Client.email))
+    if kind == 'accounts':
+        reference['client_names'] = set(db.session.query(Client.first_name, Client.last_name))
+    if kind in ('accounts', 'transactions', 'account_values', 'custodian_xml'):
+        reference['account_numbers'] = set(number for number, in db.session.query(Account.account_number))
+    if kind == 'option_quotes':
+        reference['symbols'] = set(symbol for symbol, in db.session.query(Security.symbol))
+    if kind == 'account_values':
+        quarter = Quarter.query.get(int(context['quarter_id']))
+        reference['snapshot_names'] = set(name for name, in db.session.query(AccountSnapshot.name)
+                                          .filter(AccountSnapshot.quarter_id == quarter.id))
+    for name, keys in (extra or {}).items():
+        reference[name] = reference.get(name, set()) | keys
+    return reference
+
+
+# PRE:  model is a model with an indexed fingerprint column
+#       fingerprints is a list of fingerprints
+# POST: RV = the set of fingerprints already stored, found with one IN query
+def get_stored_fingerprints(model, fingerprints):
+    if not fingerprints:
+        return set()
+    return set(fingerprint for fingerprint, in
+               db.session.query(model.fingerprint).filter(model.fingerprint.in_(fingerprints)))
+
+
+class ValidationReport(object):
+    # PRE:  filename is the name of the file reported on
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.rows = 0
+        self.error_count = 0
+        self.duplicate_count = 0
+        self.warning_count = 0
+        self.issues = []
+
+    # PRE:  status is 'ok', 'duplicate', 'warning' or 'error'
+    # POST: The row has been counted and, unless ok, added to the issues
+    def add(self, line, status, error=None):
+        self.rows += 1
+        if status == 'ok':
+            return
+        if status == 'error':
+            self.error_count += 1
+        elif status == 'duplicate':
+            self.duplicate_count += 1
+        else:
+            self.warning_count += 1
+        if len(self.issues) < MAX_REPORTED_ROWS:
+            self.issues.append({'file': self.filename, 'line': line, 'status': status, 'error': error})
+
+    # POST: RV = the report as a dictionary in the shape of an import summary
+    def to_dict(self):
+        return {'passed': self.error_count == 0, 'rows': self.rows, 'valid': self.rows - self.error_count,
+                'duplicates': self.duplicate_count, 'warnings': self.warning_count,
+                'error_count': self.error_count, 'errors': self.issues}
+
+
+# PRE:  kind is a key of VALIDATION_COLUMNS
+#       file_object is a csv file uploaded via HTML form or a binary file object
+#       reference is a dictionary as returned by load_validation_reference
+#       report is the ValidationReport to add the rows to
+#       context is a dictionary holding the 'quarter_id' for account values
+# POST: Every row of the file has been checked against the schema and the
+#        reference keys, on a process pool when the file is large, and then for
+#        duplicates against the rest of the file and the database.
+#       RV = dictionary of the keys the valid rows would add, for the files that
+#        follow in the same upload
+def validate_csv_file(kind, file_object, reference, report, context=None):
+    quarter_id = int(context['quarter_id']) if kind == 'account_values' else None
+    hash_context = {'option_quotes': (date.today(),), 'account_values': (quarter_id,)}.get(kind, ())
+    batches = read_raw_csv_batches(file_object=file_object)
+    pending = []
+    for batch in batches:
+        pending.append(batch)
+        if len(pending) > VALIDATION_POOL_MIN_BATCHES:
+            break
+    if len(pending) > VALIDATION_POOL_MIN_BATCHES:
+        workers = os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=set_validation_reference, initargs=(reference,))
+        checked = check_batches_on_pool(executor=executor, kind=kind, batches=chain(pending, batches),
+                                        context=hash_context, window=2 * workers)
+    else:
+        executor = None
+        set_validation_reference(reference)
+        checked = (check_row_batch(kind, batch, hash_context) for batch in pending)
+
+    seen_keys = {}
+    occurrences = {}
+    added = {'client_names': set(), 'account_numbers': set()}
+    quarter = Quarter.query.get(quarter_id) if quarter_id is not None else None
+    try:
+        for results in checked:
+            fingerprints = {}
+            for result in results:
+                if result['status'] == 'error' or result['hash'] is None:
+                    continue
+                if kind in ('transactions', 'account_values'):
+                    fingerprint = get_occurrence_fingerprint(content_hash=result['hash'], occurrences=occurrences)
+                    fingerprints[fingerprint] = result
+                elif kind == 'option_quotes':
+                    fingerprints[result['hash']] = result
+            model = {'transactions': Transaction, 'account_values': AccountSnapshot,
+                     'option_quotes': OptionQuote}.get(kind)
+            stored = get_stored_fingerprints(model=model, fingerprints=list(fingerprints)) if model else set()
+            duplicate_lines = set(fingerprints[fingerprint]['line'] for fingerprint in stored)
+            for result in results:
+                status, error = result['status'], result['error']
+                key = result['key']
+                if status != 'error' and result['line'] in duplicate_lines:
+                    status, error = 'duplicate', 'already imported'
+                elif status != 'error' and key is not None:
+                    if kind == 'clients' and key in reference['emails']:
+                        status, error = 'error', 'email {} already exists'.format(key)
+                    elif kind == 'accounts' and key in reference['account_numbers']:
+                        status, error = 'error', 'account {} already exists'.format(key)
+                    elif kind == 'account_values' and \
+                            '{} - {}'.format(key, quarter.name) in reference['snapshot_names']:
+                        status, error = 'error', 'account {} already has a different value this quarter'.format(key)
+                    elif key in seen_keys and kind != 'option_quotes':
+                        status, error = 'error', '{} repeats line {}'.format(key, seen_keys[key])
+                    elif key in seen_keys:
+                        status, error = 'warning', 'replaces the quote on line {}'.format(seen_keys[key])
+                    seen_keys.setdefault(key, result['line'])
+                if status != 'error' and kind == 'clients':
+                    added['client_names'].add(result['client_name'])
+                if status != 'error' and kind == 'accounts':
+                    added['account_numbers'].add(key)
+                report.add(line=result['line'], status=status, error=error)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return added
+
+
+# PRE:  file_object is a custodian xml file uploaded via HTML form
+#       reference is a dictionary as returned by load_validation_reference
+#       report is the ValidationReport to add the records to
+# POST: Every record has been checked against its schema, its account number
+#        resolved, and every transaction record checked against the stored
+#        fingerprints. read_xml_batches parses the records in document order, so
+#        they are checked in process, numbered around the records that failed.
+def validate_xml_file(file_object, reference, report):
+    errors = []
+    occurrences = {}
+    record_number = 0
+    for kind, batch in read_xml_batches(file_object=file_object, errors=errors):
+        results = []
+        for row in batch:
+            record_number += 1
+            while errors and errors[0]['line'] == record_number:
+                error = errors.pop(0)
+                report.add(line=error['line'], status='error', error=error['error'])
+                record_number += 1
+            if row['account_number'] not in reference['account_numbers']:
+                results.append((record_number, 'error', 'unknown account {}'.format(row['account_number'])))
+            elif kind == 'transaction':
+                content_hash = get_row_content_hash(row=row, columns=TRANSACTION_COLUMNS)
+                row['fingerprint'] = get_occurrence_fingerprint(content_hash=content_hash, occurrences=occurrences)
+                results.append((record_number, 'ok', row['fingerprint']))
+            else:
+                results.append((record_number, 'ok', None))
+        stored = get_stored_fingerprints(model=Transaction, fingerprints=[fingerprint for line, status, fingerprint
+                                                                          in results if status == 'ok'
+                                                                          and fingerprint is not None])
+        for line, status, detail in results:
+            if status == 'error':
+                report.add(line=line, status=status, error=detail)
+            elif detail in stored:
+                report.add(line=line, status='duplicate', error='already imported')
+            else:
+                report.add(line=line, status='ok')
+    for error in errors:
+        report.add(line=error['line'], status='error', error=error['error'])
+
+
+# PRE:  kind is an import job kind or 'account_values'
+#       file_objects are the files the kind's importer takes, in order
+#       filenames are the names reported for the files
+#       context is a dictionary holding the 'quarter_id' for account values
+# POST: Nothing has been written. Every row of every file has been checked for
+#        schema errors, unresolved foreign keys and duplicates, and the rows of
+#        later Get Started files are resolved against the earlier ones.
+#       RV = {'passed': True when no row has an error, 'rows', 'valid',
+#             'duplicates', 'warnings', 'error_count', 'errors': the first
+#             MAX_REPORTED_ROWS rows with an issue as {'file', 'line', 'status',
+#             'error'}}
+def validate_import(kind, file_objects, filenames=None, context=None):
+    filenames = filenames or [None] * len(file_objects)
+    report = ValidationReport()
+    if kind == 'custodian_xml':
+        report.filename = filenames[0]
+        validate_xml_file(file_object=file_objects[0], reference=load_validation_reference(kind), report=report)
+        return report.to_dict()
+    kinds = ['clients', 'accounts', 'transactions'] if kind == 'get_started' else [kind]
+    added = {}
+    for file_kind, file_object, filename in zip(kinds, file_objects, filenames):
+        report.filename = filename
+        reference = load_validation_reference(kind=file_kind, context=context, extra=added)
+        file_added = validate_csv_file(kind=file_kind, file_object=file_object, reference=reference,
+                                       report=report, context=context)
+        added = {'client_names': file_added['client_names'], 'account_numbers': file_added['account_numbers']}
+    return report.to_dict()
+
+
+# PRE:  report is a validation report as returned by validate_import
+# POST: Whether the upload passed, its counts, and the first rows with an issue
+#        have been flashed
+def flash_validation_report(report, max_errors=10):
+    flash('Validation {}: {} rows, {} valid, {} duplicates, {} warnings, {} rows rejected'.format(
+        'passed' if report['passed'] else 'failed, nothing imported', report['rows'], report['valid'],
+        report['duplicates'], report['warnings'], report['error_count']))
+    for error in report['errors'][:max_errors]:
+        flash('Line {line} ({status}): {error}'.format(**error))
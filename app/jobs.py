@@ -0,0 +1,284 @@
+from app import db
+from app.models import ImportJob
+from app.import_validation import validate_import
+from app.route_helpers import (process_client_csv_file, process_account_csv_file, process_transaction_csv_file,
+                               process_option_quote_csv_file, process_fee_schedule_csv_file,
+                               process_onboarding_files, process_xml_file)
+from flask import current_app
+from werkzeug.utils import secure_filename
+from sqlalchemy import update, bindparam
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from threading import Lock, Thread
+from uuid import uuid4
+import socket
+import json
+import os
+import time
+
+# Import job kind -> the importer run for it, called with the job's files in
+# upload order and the job's context as keyword arguments
+IMPORT_JOB_KINDS = {
+    'clients': process_client_csv_file,
+    'accounts': process_account_csv_file,
+    'transactions': process_transaction_csv_file,
+    'option_quotes': process_option_quote_csv_file,
+    'fee_schedules': process_fee_schedule_csv_file,
+    'get_started': process_onboarding_files,
+    'custodian_xml': process_xml_file,
+}
+MAX_STORED_ERRORS = 100
+# Seconds between saves of the progress of this process's jobs
+PROGRESS_INTERVAL = 2
+# Identifies this run of this process in ImportJob.owner. The token tells a
+# restarted process apart from an earlier one that had the same pid.
+OWNER_TOKEN = uuid4().hex
+
+_executor = None
+_executor_lock = Lock()
+# Job id -> {'bytes_read', 'lines_read'} for the jobs queued or running in this
+# process. Saved to their ImportJob rows every PROGRESS_INTERVAL seconds so
+# every process can report on them.
+_job_progress = {}
+
+
+class ProgressReader(object):
+    # PRE:  data_file is a file opened in binary mode
+    #       progress is the progress dictionary of the job reading it
+    def __init__(self, data_file, progress):
+        self.data_file = data_file
+        self.progress = progress
+
+    # POST: RV = up to size bytes of the file, counted into self.progress
+    def read(self, size=-1):
+        data = self.data_file.read(size)
+        self.progress['bytes_read'] += len(data)
+        self.progress['lines_read'] += data.count(b'\n')
+        return data
+
+
+# POST: The bytes and lines read by every job in _job_progress have been saved
+#        to its ImportJob row in one statement on its own connection so the
+#        jobs' transactions are left alone
+def save_job_progress():
+    rows = [{'job_id': job_id, 'progress_bytes': progress['bytes_read'], 'progress_lines': progress['lines_read']}
+            for job_id, progress in list(_job_progress.items())]
+    if not rows:
+        return
+    table = ImportJob.__table__
+    statement = (update(table).where(table.c.id == bindparam('job_id'))
+                 .values(bytes_read=bindparam('progress_bytes'), lines_read=bindparam('progress_lines')))
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(statement, rows)
+    except OperationalError:
+        # SQLite refuses the write while an import holds the database lock for
+        # longer than its busy timeout; the next pass saves the newer counts.
+        # Only progress reporting depends on these saves.
+        pass
+
+
+# POST: RV = the ImportJob.owner of the jobs queued by this process
+def get_job_owner():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), OWNER_TOKEN)
+
+
+# PRE:  owner is an ImportJob.owner, or None for a job queued before owners were
+#        recorded
+# POST: RV = False when the process that owns the job is known to have stopped:
+#        there is no owner, the owner is an earlier run of this process, or no
+#        process with the owner's pid is left on this host. Owners on other hosts
+#        cannot be checked and are taken to be alive.
+def is_job_owner_alive(owner):
+    if not owner:
+        return False
+    host, pid, token = owner.rsplit(':', 2)
+    if host != socket.gethostname():
+        return True
+    pid = int(pid)
+    if pid == os.getpid():
+        return token == OWNER_TOKEN
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# PRE:  kind is the name of an import job kind
+#       importer is the function run for it, taking the job's files in upload
+#        order and the job's context as keyword arguments
+# POST: Jobs of kind run importer. Used by blueprints whose importers cannot be
+#        imported here without an import cycle.
+def register_import_job_kind(kind, importer):
+    IMPORT_JOB_KINDS[kind] = importer
+
+
+# PRE:  app is the application the jobs run in
+# POST: Runs forever, saving the progress of this process's jobs every
+#        PROGRESS_INTERVAL seconds
+def monitor_import_jobs(app):
+    with app.app_context():
+        while True:
+            time.sleep(PROGRESS_INTERVAL)
+            save_job_progress()
+
+
+# PRE:  app is the application the executor's jobs run in
+# POST: RV = the ThreadPoolExecutor import jobs are run on, created on first use
+#        with IMPORT_JOB_WORKERS threads along with the thread saving their
+#        progress
+def get_executor(app):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['IMPORT_JOB_WORKERS'],
+                                           thread_name_prefix='import-job')
+            Thread(target=monitor_import_jobs, args=(app,), name='import-job-monitor', daemon=True).start()
+        return _executor
+
+
+# POST: Every queued or running ImportJob whose owner is no longer alive, left
+#        behind by a process that stopped before finishing it, has been marked
+#        failed and its files removed. Jobs of live processes are left alone,
+#        however long their imports run.
+#       RV = # of jobs marked failed
+def fail_abandoned_import_jobs():
+    jobs = [job for job in ImportJob.query.filter(ImportJob.status.in_(('queued', 'running')))
+            if not is_job_owner_alive(job.owner)]
+    for job in jobs:
+        job.status = 'failed'
+        job.message = 'Interrupted: the server stopped before the job finished. Upload the files again.'
+        job.finished = datetime.utcnow()
+        for path in job.get_paths():
+            if os.path.exists(path):
+                os.remove(path)
+    db.session.commit()
+    return len(jobs)
+
+
+# PRE:  app is the application being created
+# POST: Jobs abandoned by a previous run of the server have been marked failed.
+#        Run once at startup so that requests never write to the job table.
+def recover_import_jobs(app):
+    with app.app_context():
+        try:
+            fail_abandoned_import_jobs()
+        except SQLAlchemyError:
+            # The database has not been created or upgraded yet
+            db.session.rollback()
+
+
+# PRE:  kind is a key of IMPORT_JOB_KINDS
+#       file_objects is the list of files uploaded via HTML form passed to the
+#        kind's importer
+#       user_id is the id of the User submitting the job
+#       dry_run is True to validate the files without importing them
+#       context is a dictionary of the extra arguments the kind's importer and
+#        its validation take, such as {'quarter_id': id} for account values
+# POST: The files have been saved under IMPORT_JOB_FOLDER, a queued ImportJob has
+#        been committed, and the job has been handed to the executor
+#       RV = the ImportJob
+def submit_import_job(kind, file_objects, user_id=None, dry_run=False, context=None):
+    app = current_app._get_current_object()
+    folder = app.config['IMPORT_JOB_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    job = ImportJob(kind=kind, status='queued', dry_run=dry_run, context=json.dumps(context) if context else None,
+                    created=datetime.utcnow(), owner=get_job_owner(), user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+    paths = []
+    for index, file_object in enumerate(file_objects):
+        path = os.path.join(folder, '{}-{}_{}'.format(job.id, index, secure_filename(file_object.filename)))
+        file_object.save(path)
+        paths.append(path)
+    job.paths = '\n'.join(paths)
+    # The files are read once to validate them and, unless this is a dry run,
+    # once more to import them
+    passes = 1 if dry_run else 2
+    job.bytes_total = passes * sum(os.path.getsize(path) for path in paths)
+    db.session.commit()
+    _job_progress[job.id] = {'bytes_read': 0, 'lines_read': 0}
+    get_executor(app).submit(run_import_job, app, job.id)
+    return job
+
+
+# PRE:  app is the application to run in
+#       job_id is the id of a queued ImportJob
+# POST: The job's files have been validated with validate_import. A dry run is
+#        marked validated or rejected with the validation report stored in the
+#        job row. Otherwise a job that failed validation is marked rejected
+#        without writing anything, and one that passed has had its importer run
+#        over the files, the summary stored and the job marked finished or
+#        failed. The files have been removed.
+def run_import_job(app, job_id):
+    with app.app_context():
+        job = ImportJob.query.get(job_id)
+        progress = _job_progress.setdefault(job_id, {'bytes_read': 0, 'lines_read': 0})
+        job.status = 'running'
+        job.started = datetime.utcnow()
+        db.session.commit()
+        summary = {'rows': 0, 'errors': []}
+        status = 'finished'
+        message = None
+        try:
+            with ExitStack() as stack:
+                readers = [ProgressReader(data_file=stack.enter_context(open(path, 'rb')), progress=progress)
+                           for path in job.get_paths()]
+                summary = validate_import(kind=job.kind, file_objects=readers, filenames=job.get_filenames(),
+                                          context=job.get_context())
+                if job.dry_run or not summary['passed']:
+                    status = 'validated' if summary['passed'] else 'rejected'
+                else:
+                    readers = [ProgressReader(data_file=stack.enter_context(open(path, 'rb')), progress=progress)
+                               for path in job.get_paths()]
+                    progress['lines_read'] = 0
+                    summary = IMPORT_JOB_KINDS[job.kind](*readers, **job.get_context())
+        except Exception as error:
+            db.session.rollback()
+            status = 'failed'
+            message = '{}: {}'.format(type(error).__name__, error)
+        filename = ', '.join(job.get_filenames())
+        errors = [dict({'file': filename}, **error) for error in summary['errors']]
+        job = ImportJob.query.get(job_id)
+        job.status = status
+        job.message = message[:512] if message else None
+        job.rows = summary['rows']
+        job.duplicates = summary.get('duplicates', 0)
+        job.error_count = summary.get('error_count', len(errors))
+        job.errors = json.dumps(errors[:MAX_STORED_ERRORS])
+        job.bytes_read = progress['bytes_read']
+        job.lines_read = progress['lines_read']
+        job.finished = datetime.utcnow()
+        db.session.commit()
+        for path in job.get_paths():
+            if os.path.exists(path):
+                os.remove(path)
+        _job_progress.pop(job_id, None)
+
+
+# PRE:  job is an ImportJob
+# POST: RV = dictionary describing the job's status. While the job runs,
+#        progress and rows per second come from the bytes and lines read so far:
+#        the live counts when it runs in this process and the last saved ones
+#        when it runs in another. Once it has finished they come from the stored
+#        summary.
+def get_import_job_status(job):
+    status = {'id': job.id, 'kind': job.kind, 'status': job.status, 'dry_run': bool(job.dry_run),
+              'files': job.get_filenames(),
+              'rows': job.rows or 0, 'duplicates': job.duplicates or 0, 'error_count': job.error_count or 0,
+              'errors': job.get_errors(), 'message': job.message, 'elapsed': job.get_elapsed(),
+              'progress': 1.0 if job.status in ('finished', 'failed', 'validated', 'rejected') else 0.0,
+              'rows_per_second': 0.0}
+    if job.status == 'running':
+        progress = _job_progress.get(job.id) or {'bytes_read': job.bytes_read or 0, 'lines_read': job.lines_read or 0}
+        status['rows'] = progress['lines_read']
+        if job.bytes_total:
+            status['progress'] = min(progress['bytes_read'] / job.bytes_total, 1.0)
+    if status['elapsed'] > 0:
+        status['rows_per_second'] = status['rows'] / status['elapsed']
+    return status
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('main', __name__, template_folder='templates')
 
-from app.main import routes
+from app.main import routes, commands
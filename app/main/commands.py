@@ -0,0 +1,207 @@
+from app import create_app, db
+from app.main import bp
+from app.models import Client, Account, Group, Custodian, Security, Quarter
+from app.route_helpers import (process_client_csv_file, process_account_csv_file, process_transaction_csv_file,
+                               process_option_quote_csv_file)
+from app.billing.route_helpers import import_account_values
+from config import Config
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy import event
+import multiprocessing
+import platform
+import resource
+import tempfile
+import random
+import click
+import json
+import sys
+import os
+import time
+
+BENCHMARK_SIZES = [10000, 100000, 1000000]
+BENCHMARK_IMPORTERS = ['clients', 'accounts', 'transactions', 'option_quotes', 'account_values']
+BENCHMARK_QUARTER = '2022Q3'
+
+
+# PRE:  rows is the number of data rows in the benchmark file
+# POST: RV = the number of clients, accounts and securities seeded for a file
+#        of that size, scaled so lookups stay realistic without the seeding
+#        dominating the run
+def get_reference_counts(rows):
+    return {'clients': max(rows // 10, 10), 'accounts': max(rows // 10, 10), 'securities': 500}
+
+
+# PRE:  kind is a key of BENCHMARK_IMPORTERS
+#       rows is the number of data rows to write
+#       path is the path the csv file is written to
+# POST: A synthetic csv file in the importer's column order has been written,
+#        using a fixed seed so every run imports the same data
+def write_benchmark_file(kind, rows, path):
+    counts = get_reference_counts(rows=rows)
+    generator = random.Random(rows)
+    with open(path, 'w', newline='') as csv_file:
+        if kind == 'clients':
+            csv_file.write('First,Middle,Last,DOB,Email,Cell,Work,Home,Group\n')
+            for index in range(rows):
+                csv_file.write('First{0},M,Last{0},1970-01-01,client{0}@example.com,5550000000,,,Group{1}\n'
+                               .format(index, index % 100))
+        elif kind == 'accounts':
+            csv_file.write('Account Number,Description,First,Last,Custodian,Billable,Discretionary\n')
+            for index in range(rows):
+                client = generator.randrange(counts['clients'])
+                csv_file.write('N{0},Account {0},First{1},Last{1},Custodian{2},True,False\n'
+                               .format(index, client, index % 5))
+        elif kind == 'transactions':
+            csv_file.write('Date,Account Number,Type,Symbol,Name,Quantity,Share Price,Gross Amount,Description\n')
+            start = date(2022, 1, 1)
+            for index in range(rows):
+                quantity = generator.randint(1, 100)
+                price = round(generator.uniform(1, 500), 2)
+                csv_file.write('{},A{},{},S{},Security,{},{},{},Benchmark\n'.format(
+                    start + timedelta(days=index % 365), generator.randrange(counts['accounts']),
+                    'BUY' if generator.random() < 0.7 else 'SELL', generator.randrange(counts['securities']),
+                    quantity, price, round(quantity * price, 2)))
+        elif kind == 'option_quotes':
+            csv_file.write('Symbol,Type,Expiration,Strike,Bid,Ask,Last,High,Low,Change,Volume,Open Interest\n')
+            expiration = date(2023, 1, 20)
+            for index in range(rows):
+                csv_file.write('S{},{},{},{},{},{},{},{},{},0,{},{}\n'.format(
+                    index % counts['securities'], 'call' if index % 2 else 'put',
+                    expiration + timedelta(weeks=(index // 1000) % 52), 5 * ((index // 2) % 500 + 1),
+                    1.0, 1.1, 1.05, 1.2, 0.9, generator.randint(0, 1000), generator.randint(0, 1000)))
+        elif kind == 'account_values':
+            csv_file.write('Date,Account Number,Description,Custodian,Market Value\n')
+            for index in range(rows):
+                csv_file.write('2022-09-30,A{},,,{}\n'.format(index, round(generator.uniform(1000, 5000000), 2)))
+
+
+# PRE:  kind is a key of BENCHMARK_IMPORTERS
+#       rows is the number of data rows in the benchmark file
+# POST: The rows the importer resolves its file against have been bulk inserted:
+#        clients for accounts, accounts for transactions and account values,
+#        securities for transactions and option quotes, and a quarter for
+#        account values
+def seed_benchmark_database(kind, rows):
+    counts = get_reference_counts(rows=rows)
+    if kind in ('accounts', 'transactions', 'account_values'):
+        db.session.bulk_insert_mappings(Group, [{'name': 'Group{}'.format(index)} for index in range(100)])
+        db.session.bulk_insert_mappings(Custodian, [{'name': 'Custodian{}'.format(index)} for index in range(5)])
+        db.session.bulk_insert_mappings(Client, [{'first_name': 'First{}'.format(index),
+                                                  'last_name': 'Last{}'.format(index),
+                                                  'email': 'client{}@example.com'.format(index),
+                                                  'group_id': index % 100 + 1, 'assigned': True}
+                                                 for index in range(counts['clients'])])
+    if kind in ('transactions', 'account_values'):
+        accounts = rows if kind == 'account_values' else counts['accounts']
+        db.session.bulk_insert_mappings(Account, [{'account_number': 'A{}'.format(index), 'billable': True,
+                                                   'discretionary': False,
+                                                   'client_id': index % counts['clients'] + 1,
+                                                   'group_id': index % 100 + 1, 'custodian_id': index % 5 + 1}
+                                                  for index in range(accounts)])
+    if kind in ('transactions', 'option_quotes'):
+        db.session.bulk_insert_mappings(Security, [{'symbol': 'S{}'.format(index), 'name': 'Security'}
+                                                   for index in range(counts['securities'])])
+    if kind == 'account_values':
+        db.session.add(Quarter(name=BENCHMARK_QUARTER, from_date=date(2022, 7, 1), to_date=date(2022, 9, 30),
+                               aum=0, fee=0))
+    db.session.commit()
+
+
+# POST: RV = peak resident set size of this process in megabytes
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Pre:  kind is a key of BENCHMARK_IMPORTERS
+#       rows is the number of data rows in file_path
+#       file_path is the path of a file written by write_benchmark_file
+#       database_path is the path of a SQLite database that does not exist yet
+# Post: A fresh application has been created on the database, seeded, and the
+#        importer run over the file once, so the call can run in its own process
+#        and the peak RSS is the run's own.
+#       RV = {'importer', 'rows', 'imported', 'seconds', 'rows_per_second',
+#             'statements', 'peak_rss_mb', 'baseline_rss_mb', 'file_mb', 'error'}
+def run_import_benchmark(kind, rows, file_path, database_path):
+    config_class = type('BenchmarkConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database_path,
+                                                       'RECOVER_IMPORT_JOBS': False})
+    app = create_app(config_class)
+    result = {'importer': kind, 'rows': rows, 'imported': 0, 'seconds': 0, 'rows_per_second': 0,
+              'statements': 0, 'peak_rss_mb': 0, 'baseline_rss_mb': 0,
+              'file_mb': os.path.getsize(file_path) / (1024 * 1024), 'error': None}
+    with app.app_context():
+        db.create_all()
+        seed_benchmark_database(kind=kind, rows=rows)
+        quarter_id = Quarter.query.filter_by(name=BENCHMARK_QUARTER).first().id if kind == 'account_values' else None
+        statements = [0]
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements[0] += 1
+
+        result['baseline_rss_mb'] = get_peak_rss()
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        start = time.perf_counter()
+        try:
+            with open(file_path, 'rb') as file_object:
+                if kind == 'clients':
+                    summary = process_client_csv_file(file_object=file_object)
+                elif kind == 'accounts':
+                    summary = process_account_csv_file(file_object=file_object)
+                elif kind == 'transactions':
+                    summary = process_transaction_csv_file(file_object=file_object)
+                elif kind == 'option_quotes':
+                    summary = process_option_quote_csv_file(file_object=file_object)
+                else:
+                    summary = import_account_values(file_object=file_object, quarter_id=quarter_id)
+            result['imported'] = summary['rows']
+        except Exception as error:
+            db.session.rollback()
+            result['error'] = '{}: {}'.format(type(error).__name__, error)
+        result['seconds'] = time.perf_counter() - start
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    result['statements'] = statements[0]
+    result['rows_per_second'] = rows / result['seconds'] if result['seconds'] else 0
+    result['peak_rss_mb'] = get_peak_rss()
+    return result
+
+
+@bp.cli.command('benchmark-imports')
+@click.option('--sizes', type=int, multiple=True, default=BENCHMARK_SIZES, show_default=True,
+              help='Number of rows per synthetic file. Repeat for several sizes.')
+@click.option('--importer', 'importers', type=click.Choice(BENCHMARK_IMPORTERS), multiple=True,
+              default=BENCHMARK_IMPORTERS, help='Importer to run. Repeat for several; defaults to all.')
+@click.option('--output', type=click.Path(dir_okay=False), default='import_benchmark.json', show_default=True,
+              help='JSON file the results are written to.')
+@click.option('--workdir', type=click.Path(file_okay=False), default=None,
+              help='Directory for the synthetic files and databases. Defaults to a temporary directory.')
+def benchmark_imports(sizes, importers, output, workdir):
+    """Time each csv importer on synthetic files against a fresh SQLite database."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as folder:
+        for rows in sizes:
+            for kind in importers:
+                file_path = os.path.join(folder, '{}_{}.csv'.format(kind, rows))
+                database_path = os.path.join(folder, '{}_{}.db'.format(kind, rows))
+                write_benchmark_file(kind=kind, rows=rows, path=file_path)
+                # Every run gets a new process so its database, caches and peak
+                # RSS start from nothing
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_import_benchmark, kind, rows, file_path, database_path).result()
+                os.remove(file_path)
+                for path in (database_path, database_path + '-wal', database_path + '-shm'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                results.append(result)
+                line = '{importer} {rows} rows: {rows_per_second:,.0f} rows/s, {statements} statements, ' \
+                       '{peak_rss_mb:.0f} MB peak RSS'.format(**result)
+                if result['error'] is not None:
+                    line += ' ERROR ' + result['error']
+                click.echo(line)
+    report = {'created': datetime.utcnow().isoformat(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    click.echo('Results written to {}'.format(output))
@@ -10,6 +10,7 @@ class GetStartedForm(FlaskForm):
     client_file = FileField('Client File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
     account_file = FileField('Account File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
     transaction_file = FileField('Transaction File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
     submit = SubmitField('Submit')
 
 
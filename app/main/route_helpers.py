@@ -0,0 +1,151 @@
+from app import db
+from app.models import ChunkedUpload
+from flask import current_app, url_for
+from werkzeug.utils import secure_filename
+from datetime import datetime
+import os
+import shutil
+import uuid
+
+COPY_BLOCK_SIZE = 1024 * 1024
+# Import job kinds that take a single file, with the label shown when uploading
+CHUNKED_UPLOAD_KINDS = [('transactions', 'Transactions'), ('custodian_xml', 'Custodian XML'),
+                        ('option_quotes', 'Option Quotes'), ('accounts', 'Accounts'), ('clients', 'Clients'),
+                        ('fee_schedules', 'Fee Schedules')]
+
+
+class AssembledUpload(object):
+    # PRE:  upload is a ChunkedUpload whose chunks have all been received
+    def __init__(self, upload):
+        self.upload = upload
+        self.filename = upload.filename
+
+    # POST: The chunks have been concatenated into path
+    def save(self, path):
+        concatenate_files(paths=[get_chunk_path(self.upload, index) for index in range(self.upload.chunk_count)],
+                          destination=path)
+
+
+# PRE:  upload is a ChunkedUpload
+# POST: RV = the folder the upload's chunks are stored in
+def get_chunk_folder(upload):
+    return os.path.join(current_app.config['CHUNKED_UPLOAD_FOLDER'], upload.id)
+
+
+# PRE:  upload is a ChunkedUpload
+#       index is a chunk number between 0 and upload.chunk_count - 1
+# POST: RV = the path chunk index is stored at
+def get_chunk_path(upload, index):
+    return os.path.join(get_chunk_folder(upload), '{:06d}.part'.format(index))
+
+
+# PRE:  upload is a ChunkedUpload
+#       index is a chunk number
+# POST: RV = the number of bytes chunk index must contain
+def get_expected_chunk_size(upload, index):
+    return min(upload.chunk_size, upload.size - index * upload.chunk_size)
+
+
+# PRE:  kind is an import job kind taking a single file
+#       filename is the name of the file being uploaded
+#       size is its size in bytes
+#       user_id is the id of the User uploading it
+# POST: A ChunkedUpload has been committed and its chunk folder created
+#       RV = the ChunkedUpload
+def start_chunked_upload(kind, filename, size, user_id=None):
+    chunk_size = current_app.config['CHUNKED_UPLOAD_CHUNK_SIZE']
+    upload = ChunkedUpload(id=uuid.uuid4().hex, kind=kind, filename=secure_filename(filename), size=size,
+                           chunk_size=chunk_size, chunk_count=max((size + chunk_size - 1) // chunk_size, 1),
+                           created=datetime.utcnow(), user_id=user_id)
+    db.session.add(upload)
+    db.session.commit()
+    os.makedirs(get_chunk_folder(upload), exist_ok=True)
+    return upload
+
+
+# PRE:  upload is a ChunkedUpload
+# POST: RV = sorted list of the chunk numbers received so far
+def get_received_chunks(upload):
+    received = []
+    for index in range(upload.chunk_count):
+        path = get_chunk_path(upload, index)
+        if os.path.exists(path) and os.path.getsize(path) == get_expected_chunk_size(upload, index):
+            received.append(index)
+    return received
+
+
+# PRE:  upload is a ChunkedUpload
+#       index is a chunk number between 0 and upload.chunk_count - 1
+#       stream is the request body holding the chunk's bytes
+# POST: The chunk has been written to a temporary file and moved into place, so
+#        a chunk cut off partway is never mistaken for a received one. Sending a
+#        chunk again replaces it.
+#       RV = None, or a description of why the chunk was rejected
+def save_chunk(upload, index, stream):
+    if not 0 <= index < upload.chunk_count:
+        return 'chunk {} is out of range'.format(index)
+    path = get_chunk_path(upload, index)
+    temporary_path = '{}.{}'.format(path, uuid.uuid4().hex)
+    with open(temporary_path, 'wb') as chunk_file:
+        shutil.copyfileobj(stream, chunk_file, COPY_BLOCK_SIZE)
+    if os.path.getsize(temporary_path) != get_expected_chunk_size(upload, index):
+        os.remove(temporary_path)
+        return 'chunk {} should be {} bytes'.format(index, get_expected_chunk_size(upload, index))
+    os.replace(temporary_path, path)
+    return None
+
+
+# PRE:  upload is a ChunkedUpload
+# POST: RV = True when this caller may assemble the upload. Only the first
+#        caller to ask wins, so two final chunks arriving together start one job.
+def claim_chunked_upload(upload):
+    try:
+        os.close(os.open(os.path.join(get_chunk_folder(upload), 'assembling'), os.O_CREAT | os.O_EXCL))
+        return True
+    except FileExistsError:
+        return False
+
+
+# PRE:  upload is a ChunkedUpload that has been handed to an import job
+# POST: The upload's chunk folder has been removed
+def remove_chunks(upload):
+    shutil.rmtree(get_chunk_folder(upload), ignore_errors=True)
+
+
+# PRE:  paths is a list of files to concatenate in order
+#       destination is the path of the file to write
+# POST: destination holds the contents of paths one after another. The bytes are
+#        moved with os.sendfile, so they are copied inside the kernel without
+#        passing through Python, falling back to shutil.copyfileobj where
+#        sendfile cannot copy between files.
+def concatenate_files(paths, destination):
+    with open(destination, 'wb', buffering=0) as destination_file:
+        for path in paths:
+            with open(path, 'rb', buffering=0) as part_file:
+                size = os.fstat(part_file.fileno()).st_size
+                offset = 0
+                try:
+                    while offset < size:
+                        sent = os.sendfile(destination_file.fileno(), part_file.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    pass
+                if offset < size:
+                    part_file.seek(offset)
+                    shutil.copyfileobj(part_file, destination_file, COPY_BLOCK_SIZE)
+
+
+# PRE:  upload is a ChunkedUpload
+# POST: RV = dictionary of the upload's chunks received and missing, and the
+#        import job it was handed to once complete
+def get_chunked_upload_status(upload):
+    received = get_received_chunks(upload) if upload.job_id is None else list(range(upload.chunk_count))
+    status = {'upload_id': upload.id, 'kind': upload.kind, 'filename': upload.filename, 'size': upload.size,
+              'chunk_size': upload.chunk_size, 'chunk_count': upload.chunk_count, 'received': received,
+              'missing': sorted(set(range(upload.chunk_count)) - set(received)), 'job_id': upload.job_id,
+              'job_url': None}
+    if upload.job_id is not None:
+        status['job_url'] = url_for('main.view_import_job', job_id=upload.job_id)
+    return status
@@ -1,10 +1,13 @@
-from flask import render_template, url_for, redirect
-from flask_login import login_required
+from flask import render_template, url_for, redirect, flash, jsonify, request
+from flask_login import login_required, current_user
+from app import db
 from app.main import bp
 from app.main.forms import GetStartedForm
-from app.route_helpers import (process_client_csv_file,
-                               process_account_csv_file,
-                               process_transaction_csv_file)
+from app.main.route_helpers import (CHUNKED_UPLOAD_KINDS, AssembledUpload, start_chunked_upload,
+                                    get_received_chunks, save_chunk, claim_chunked_upload, remove_chunks,
+                                    get_chunked_upload_status)
+from app.models import ImportJob, ChunkedUpload
+from app.jobs import submit_import_job, get_import_job_status
 
 
 @bp.route('/')
@@ -13,13 +16,78 @@ def index():
     return render_template('index.html', title='Home')
 
 
-@bp.route('/get_started')
+@bp.route('/get_started', methods=['GET', 'POST'])
 @login_required
 def get_started():
     form = GetStartedForm()
     if form.validate_on_submit():
-        process_client_csv_file(file_object=form.client_file.data)
-        process_account_csv_file(file_object=form.account_file.data)
-        process_transaction_csv_file(file_object=form.transaction_file.data)
-        return redirect(url_for('main.index'))
+        job = submit_import_job(kind='get_started', file_objects=[form.client_file.data, form.account_file.data,
+                                                                  form.transaction_file.data],
+                                user_id=current_user.id, dry_run=form.dry_run.data)
+        flash('Files queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('get_started.html', title='Get Started', form=form)
+
+
+@bp.route('/view_import_jobs')
+@login_required
+def view_import_jobs():
+    jobs = ImportJob.query.order_by(ImportJob.id.desc()).limit(100).all()
+    return render_template('view_import_jobs.html', title='Import Jobs', jobs=jobs)
+
+
+@bp.route('/view_import_job/<job_id>')
+@login_required
+def view_import_job(job_id):
+    job = ImportJob.query.get(int(job_id))
+    return render_template('view_import_job.html', title='Import Job', job=job, status=get_import_job_status(job))
+
+
+@bp.route('/import_job_status/<job_id>')
+@login_required
+def import_job_status(job_id):
+    job = ImportJob.query.get(int(job_id))
+    return jsonify(get_import_job_status(job))
+
+
+@bp.route('/chunked_upload')
+@login_required
+def chunked_upload():
+    return render_template('chunked_upload.html', title='Upload Large File', kinds=CHUNKED_UPLOAD_KINDS)
+
+
+@bp.route('/start_chunked_upload', methods=['POST'])
+@login_required
+def start_chunked_upload_route():
+    data = request.get_json(force=True)
+    if data.get('kind') not in dict(CHUNKED_UPLOAD_KINDS) or not data.get('filename') or \
+            not isinstance(data.get('size'), int) or data['size'] < 0:
+        return jsonify({'error': 'kind, filename and size are required'}), 400
+    upload = start_chunked_upload(kind=data['kind'], filename=data['filename'], size=data['size'],
+                                  user_id=current_user.id)
+    return jsonify(get_chunked_upload_status(upload))
+
+
+@bp.route('/chunked_upload_status/<upload_id>')
+@login_required
+def chunked_upload_status(upload_id):
+    upload = ChunkedUpload.query.get_or_404(upload_id)
+    return jsonify(get_chunked_upload_status(upload))
+
+
+@bp.route('/upload_chunk/<upload_id>/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    upload = ChunkedUpload.query.get_or_404(upload_id)
+    if upload.job_id is None:
+        error = save_chunk(upload=upload, index=index, stream=request.stream)
+        if error is not None:
+            return jsonify({'error': error}), 400
+        if len(get_received_chunks(upload)) == upload.chunk_count and claim_chunked_upload(upload):
+            job = submit_import_job(kind=upload.kind, file_objects=[AssembledUpload(upload)],
+                                    user_id=current_user.id)
+            upload.job_id = job.id
+            db.session.commit()
+            remove_chunks(upload)
+    return jsonify(get_chunked_upload_status(upload))
+
@@ -1,6 +1,10 @@
 from werkzeug.security import check_password_hash, generate_password_hash
 from app import db, login
+from app.fee_tables import get_compiled_fee_schedule, invalidate_compiled_fee_schedule
 from flask_login import UserMixin
+from datetime import datetime
+import json
+import os
 
 
 class User(UserMixin, db.Model):
@@ -151,6 +155,7 @@ class Security(db.Model):
 
 
 class SecurityDailyAdjusted(db.Model):
+    __table_args__ = (db.UniqueConstraint('security_id', 'date', name='uq_security_daily_adjusted_date'),)
     id = db.Column(db.Integer, primary_key=True)
     symbol = db.Column(db.String(16), index=True)
     date = db.Column(db.Date)
@@ -192,6 +197,8 @@ class SecurityIndicatorChart(db.Model):
 
 
 class OptionQuote(db.Model):
+    __table_args__ = (db.UniqueConstraint('security_id', 'quote_date', 'type', 'expiration_date', 'strike_price',
+                                          name='uq_option_quote_contract'),)
     id = db.Column(db.Integer, primary_key=True)
     symbol = db.Column(db.String(16), index=True)
     quote_date = db.Column(db.Date)
@@ -206,6 +213,7 @@ class OptionQuote(db.Model):
     change = db.Column(db.Float)
     volume = db.Column(db.Float)
     open_interest = db.Column(db.Float)
+    fingerprint = db.Column(db.String(40), index=True)
     security_id = db.Column(db.Integer, db.ForeignKey('security.id'))
 
 
@@ -218,14 +226,31 @@ class Benchmark(db.Model):
     mean = db.Column(db.Float)
     last_updated = db.Column(db.Date)
     securities = db.relationship('Security', backref='benchmark', lazy='dynamic')
+    adjusted_dailies = db.relationship('BenchmarkDailyAdjusted', backref='benchmark', lazy='dynamic')
+
+
+class BenchmarkDailyAdjusted(db.Model):
+    __table_args__ = (db.UniqueConstraint('benchmark_id', 'date', name='uq_benchmark_daily_adjusted_date'),)
+    id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.String(16), index=True)
+    date = db.Column(db.Date)
+    open = db.Column(db.Float)
+    close = db.Column(db.Float)
+    adjusted_close = db.Column(db.Float)
+    high = db.Column(db.Float)
+    low = db.Column(db.Float)
+    volume = db.Column(db.Integer)
+    dividend_amount = db.Column(db.Float)
+    split_coefficient = db.Column(db.Float)
+    benchmark_id = db.Column(db.Integer, db.ForeignKey('benchmark.id'))
 
 
 class Position(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Float)
     cost_basis = db.Column(db.Float)
-    account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
-    security_id = db.Column(db.Integer, db.ForeignKey('security.id'))
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), index=True)
+    security_id = db.Column(db.Integer, db.ForeignKey('security.id'), index=True)
     transactions = db.relationship('Transaction', backref='position', lazy='dynamic')
 
     def get_account_number(self):
@@ -279,6 +304,7 @@ class Transaction(db.Model):
     quantity = db.Column(db.Float)
     share_price = db.Column(db.Float)
     gross_amount = db.Column(db.Float)
+    fingerprint = db.Column(db.String(40), index=True)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
     security_id = db.Column(db.Integer, db.ForeignKey('security.id'))
     position_id = db.Column(db.Integer, db.ForeignKey('position.id'))
@@ -309,6 +335,8 @@ class Quarter(db.Model):
     fee = db.Column(db.Float)
     account_snapshots = db.relationship('AccountSnapshot', backref='quarter', lazy='dynamic')
     group_snapshots = db.relationship('GroupSnapshot', backref='quarter', lazy='dynamic')
+    custodian_totals = db.relationship('QuarterCustodianTotal', backref='quarter', lazy='dynamic')
+    fee_schedule_totals = db.relationship('QuarterFeeScheduleTotal', backref='quarter', lazy='dynamic')
 
     def get_rate(self):
         rate = 0
@@ -317,17 +345,41 @@ class Quarter(db.Model):
         return rate
 
 
+class QuarterCustodianTotal(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    custodian = db.Column(db.String(), index=True)
+    aum = db.Column(db.Float)
+    fee = db.Column(db.Float)
+    quarter_id = db.Column(db.Integer, db.ForeignKey('quarter.id'), index=True)
+
+
+class QuarterFeeScheduleTotal(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    aum = db.Column(db.Float)
+    fee = db.Column(db.Float)
+    quarter_id = db.Column(db.Integer, db.ForeignKey('quarter.id'), index=True)
+    fee_schedule_id = db.Column(db.Integer, db.ForeignKey('fee_schedule.id'), index=True)
+
+    def get_fee_schedule_name(self):
+        if self.fee_schedule_id is None:
+            return 'Unassigned'
+        fee_schedule = FeeSchedule.query.get(self.fee_schedule_id)
+        return fee_schedule.name
+
+
 class GroupSnapshot(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date, index=True)
     name = db.Column(db.String(64), index=True, unique=True)
     quarter_name = db.Column(db.String(7), index=True)
     group_name = db.Column(db.String(32), index=True)
-    market_value = db.Column(db.Float)
-    fee = db.Column(db.Float)
+    # Columns feeding the quarter rollups keep their previous value when set so
+    # app.rollups can take it back out of the quarter totals
+    market_value = db.column_property(db.Column(db.Float), active_history=True)
+    fee = db.column_property(db.Column(db.Float), active_history=True)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'))
-    quarter_id = db.Column(db.Integer, db.ForeignKey('quarter.id'))
-    fee_schedule_id = db.Column(db.Integer, db.ForeignKey('fee_schedule.id'))
+    quarter_id = db.column_property(db.Column(db.Integer, db.ForeignKey('quarter.id')), active_history=True)
+    fee_schedule_id = db.column_property(db.Column(db.Integer, db.ForeignKey('fee_schedule.id')), active_history=True)
     account_snapshots = db.relationship('AccountSnapshot', backref='group_snapshot', lazy='dynamic')
 
     def get_string_id(self):
@@ -353,14 +405,15 @@ class AccountSnapshot(db.Model):
     discretionary = db.Column(db.Boolean, index=True)
     client_name = db.Column(db.String(), index=True)
     group_name = db.Column(db.String(), index=True)
-    custodian = db.Column(db.String(), index=True)
-    market_value = db.Column(db.Float)
-    fee = db.Column(db.Float)
+    custodian = db.column_property(db.Column(db.String(), index=True), active_history=True)
+    market_value = db.column_property(db.Column(db.Float), active_history=True)
+    fee = db.column_property(db.Column(db.Float), active_history=True)
     group_weight = db.Column(db.Float)
     billable = db.Column(db.Boolean, index=True)
+    fingerprint = db.Column(db.String(40), index=True)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
-    quarter_id = db.Column(db.Integer, db.ForeignKey('quarter.id'))
+    quarter_id = db.column_property(db.Column(db.Integer, db.ForeignKey('quarter.id')), active_history=True)
     group_snapshot_id = db.Column(db.Integer, db.ForeignKey('group_snapshot.id'))
 
     def get_account(self):
@@ -382,23 +435,32 @@ class AccountSnapshot(db.Model):
 class FeeSchedule(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), index=True, unique=True)
+    rules_version = db.Column(db.Integer, default=0)
     groups = db.relationship('Group', backref='FeeSchedule', lazy='dynamic')
     group_snapshots = db.relationship('GroupSnapshot', backref='fee_schedule', lazy='dynamic')
     rules = db.relationship('FeeRule', backref='FeeSchedule', lazy='dynamic')
 
+    # PRE:  self is a well-defined FeeSchedule object
+    # POST: RV = [(minimum, maximum, rate, flat)] for every FeeRule of self
+    def get_rule_tiers(self):
+        return [(rule.minimum, rule.maximum, rule.rate, rule.flat)
+                for rule in self.rules.order_by(FeeRule.id)]
+
+    # PRE:  self is a well-defined FeeSchedule object
+    # POST: self.rules_version has been incremented so that the compiled fee table
+    #        is rebuilt on the next fee calculation in every process
+    def rules_changed(self):
+        self.rules_version = (self.rules_version or 0) + 1
+        invalidate_compiled_fee_schedule(schedule_id=self.id)
+
+    # PRE:  value is a market value
+    # POST: RV = the quarterly fee for value, looked up in the schedule's compiled
+    #            fee table
     def calculate_fee(self, value):
-        fee = 0
-        for rule in self.rules:
-            fee += rule.flat
-            if value > rule.minimum:
-                if rule.maximum is not None:
-                    if value < rule.maximum:
-                        fee += (value - rule.minimum) * (rule.rate/4)
-                    else:
-                        fee += (rule.maximum - rule.minimum) * (rule.rate/4)
-                else:
-                    fee += (value - rule.minimum) * (rule.rate/4)
-        return round(fee, 2)
+        compiled = get_compiled_fee_schedule(schedule_id=self.id,
+                                             rules_version=self.rules_version or 0,
+                                             load_rules=self.get_rule_tiers)
+        return round(compiled.calculate_fee(value), 2)
 
 
 class FeeRule(db.Model):
@@ -434,3 +496,59 @@ class Task(db.Model):
     completed = db.Column(db.Boolean, index=True)
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+
+class ImportJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), index=True)
+    status = db.Column(db.String(16), index=True)
+    dry_run = db.Column(db.Boolean, default=False)
+    paths = db.Column(db.Text)
+    # JSON dictionary of the extra arguments the importer takes, such as the
+    # quarter_id of account values
+    context = db.Column(db.Text)
+    rows = db.Column(db.Integer, default=0)
+    duplicates = db.Column(db.Integer, default=0)
+    error_count = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Text)
+    message = db.Column(db.String(512))
+    # Progress of a running job, saved periodically by the process running it
+    bytes_read = db.Column(db.BigInteger, default=0)
+    bytes_total = db.Column(db.BigInteger, default=0)
+    lines_read = db.Column(db.Integer, default=0)
+    # 'host:pid:token' of the process that queued the job and runs it, where
+    # token is generated each time the process starts
+    owner = db.Column(db.String(128), index=True)
+    created = db.Column(db.DateTime, index=True)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    def get_paths(self):
+        return self.paths.split('\n') if self.paths else []
+
+    def get_filenames(self):
+        return [os.path.basename(path).split('_', 1)[-1] for path in self.get_paths()]
+
+    def get_errors(self):
+        return json.loads(self.errors) if self.errors else []
+
+    def get_context(self):
+        return json.loads(self.context) if self.context else {}
+
+    def get_elapsed(self):
+        if self.started is None:
+            return 0
+        return ((self.finished or datetime.utcnow()) - self.started).total_seconds()
+
+
+class ChunkedUpload(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(32))
+    filename = db.Column(db.String(256))
+    size = db.Column(db.BigInteger)
+    chunk_size = db.Column(db.Integer)
+    chunk_count = db.Column(db.Integer)
+    created = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    job_id = db.Column(db.Integer, db.ForeignKey('import_job.id'))
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('option', __name__, template_folder='templates')
 
-from app.option import routes
\ No newline at end of file
+from app.option import routes, commands
\ No newline at end of file
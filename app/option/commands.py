@@ -0,0 +1,13 @@
+from app.option import bp
+from app.route_helpers import remove_duplicate_option_quotes
+import click
+
+
+@bp.cli.command('dedupe-quotes')
+def dedupe_quotes():
+    """Delete repeated option quote rows and add the unique contract key.
+
+    Run once on a database created before the key existed, since create_all
+    does not add constraints to existing tables.
+    """
+    click.echo('option_quote: {} duplicate rows deleted'.format(remove_duplicate_option_quotes()))
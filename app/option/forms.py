@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import (StringField, SubmitField, SelectField,
+from wtforms import (StringField, BooleanField, SubmitField, SelectField,
                      DateField, FloatField)
 from wtforms.validators import InputRequired, ValidationError
 
@@ -34,6 +34,7 @@ class AddOptionQuoteForm(FlaskForm):
 
 class UploadFileForm(FlaskForm):
     upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
     submit = SubmitField('Upload')
 
 
@@ -1,10 +1,10 @@
-from flask import render_template, redirect, url_for
-from flask_login import login_required
+from flask import render_template, flash, redirect, url_for
+from flask_login import login_required, current_user
 from app import db
 from app.models import (Security, OptionQuote)
 from app.option.forms import (AddOptionQuoteForm, UploadFileForm)
 from app.option import bp
-from app.route_helpers import (process_option_quote_csv_file)
+from app.jobs import submit_import_job
 from datetime import date
 
 
@@ -32,20 +32,25 @@ def add_option_quote(security_id):
     form = AddOptionQuoteForm()
     if form.validate_on_submit():
         security = Security.query.get(int(security_id))
-        quote = OptionQuote(symbol=security.symbol,
-                            security_id=security.id,
-                            quote_date=date.today(),
-                            type=form.type.data,
-                            expiration_date=form.expiration_date.data,
-                            strike_price=form.strike_price.data,
-                            bid=form.bid.data,
-                            ask=form.ask.data,
-                            last=form.last.data,
-                            high=form.high.data,
-                            low=form.low.data,
-                            change=form.change.data,
-                            volume=form.volume.data,
-                            open_interest=form.open_interest.data)
+        quote = OptionQuote.query.filter_by(security_id=security.id, quote_date=date.today(), type=form.type.data,
+                                            expiration_date=form.expiration_date.data,
+                                            strike_price=form.strike_price.data).first()
+        if quote is None:
+            quote = OptionQuote(security_id=security.id,
+                                quote_date=date.today(),
+                                type=form.type.data,
+                                expiration_date=form.expiration_date.data,
+                                strike_price=form.strike_price.data)
+        quote.symbol = security.symbol
+        quote.bid = form.bid.data
+        quote.ask = form.ask.data
+        quote.last = form.last.data
+        quote.high = form.high.data
+        quote.low = form.low.data
+        quote.change = form.change.data
+        quote.volume = form.volume.data
+        quote.open_interest = form.open_interest.data
+        quote.fingerprint = None
         db.session.add(quote)
         db.session.commit()
         return redirect(url_for('option.view_option_quote',
@@ -60,8 +65,10 @@ def add_option_quote(security_id):
 def upload_option_quotes():
     form = UploadFileForm()
     if form.validate_on_submit():
-        process_option_quote_csv_file(file_object=form.upload_file.data)
-        return redirect(url_for('option.view_option_quotes'))
+        job = submit_import_job(kind='option_quotes', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_option_quotes.html',
                            title='Upload Option Quotes',
                            form=form)
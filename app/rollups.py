@@ -0,0 +1,119 @@
+from app import db
+from app.models import (Quarter, GroupSnapshot, AccountSnapshot, QuarterCustodianTotal,
+                        QuarterFeeScheduleTotal)
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+
+# PRE:  instance is a persistent mapped object
+#       attribute is the name of one of its column attributes, mapped with
+#        active_history so a changed value keeps its previous value
+# POST: RV = the value of the attribute as of the last flush
+def get_committed_value(instance, attribute):
+    history = inspect(instance).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(instance, attribute)
+
+
+# PRE:  snapshot is a GroupSnapshot or AccountSnapshot
+#       get_value is a callable (instance, attribute) returning the attribute value
+# POST: RV = (quarter_id, key, market_value, fee) describing what the snapshot adds
+#        to its quarter, where key is ('fee_schedule', fee_schedule_id) for a
+#        GroupSnapshot and ('custodian', custodian) for an AccountSnapshot
+def get_snapshot_contribution(snapshot, get_value):
+    if isinstance(snapshot, GroupSnapshot):
+        key = ('fee_schedule', get_value(snapshot, 'fee_schedule_id'))
+    else:
+        key = ('custodian', get_value(snapshot, 'custodian'))
+    return (get_value(snapshot, 'quarter_id'), key,
+            get_value(snapshot, 'market_value') or 0, get_value(snapshot, 'fee') or 0)
+
+
+# PRE:  deltas is a dictionary of format {(quarter_id, key): [market_value, fee]}
+#       contribution is a tuple as returned by get_snapshot_contribution
+#       sign is 1 to add the contribution and -1 to remove it
+# POST: The contribution has been added into deltas
+def add_contribution(deltas, contribution, sign):
+    quarter_id, key, market_value, fee = contribution
+    if quarter_id is None:
+        return
+    delta = deltas.setdefault((quarter_id, key), [0, 0])
+    delta[0] += sign * market_value
+    delta[1] += sign * fee
+
+
+# PRE:  session is the Session being flushed
+# POST: The Quarter totals and the QuarterCustodianTotal/QuarterFeeScheduleTotal
+#        rows have been adjusted by the changes to GroupSnapshot and AccountSnapshot
+#        rows pending in session, so they are written in the same flush
+def update_quarter_rollups(session, flush_context, instances):
+    deltas = {}
+    for snapshot in session.new:
+        if isinstance(snapshot, (GroupSnapshot, AccountSnapshot)):
+            add_contribution(deltas, get_snapshot_contribution(snapshot, getattr), 1)
+    for snapshot in session.dirty:
+        if isinstance(snapshot, (GroupSnapshot, AccountSnapshot)) and session.is_modified(snapshot):
+            add_contribution(deltas, get_snapshot_contribution(snapshot, get_committed_value), -1)
+            add_contribution(deltas, get_snapshot_contribution(snapshot, getattr), 1)
+    for snapshot in session.deleted:
+        if isinstance(snapshot, (GroupSnapshot, AccountSnapshot)):
+            add_contribution(deltas, get_snapshot_contribution(snapshot, get_committed_value), -1)
+    deleted_quarters = set(quarter.id for quarter in session.deleted if isinstance(quarter, Quarter))
+    for (quarter_id, (category, name)), (market_value, fee) in deltas.items():
+        if quarter_id in deleted_quarters or (market_value == 0 and fee == 0):
+            continue
+        if category == 'fee_schedule':
+            quarter = session.get(Quarter, quarter_id)
+            if quarter is not None:
+                quarter.aum = (quarter.aum or 0) + market_value
+                quarter.fee = (quarter.fee or 0) + fee
+            total = (session.query(QuarterFeeScheduleTotal)
+                     .filter_by(quarter_id=quarter_id, fee_schedule_id=name).first())
+            if total is None:
+                total = QuarterFeeScheduleTotal(quarter_id=quarter_id, fee_schedule_id=name, aum=0, fee=0)
+        else:
+            total = (session.query(QuarterCustodianTotal)
+                     .filter_by(quarter_id=quarter_id, custodian=name).first())
+            if total is None:
+                total = QuarterCustodianTotal(quarter_id=quarter_id, custodian=name, aum=0, fee=0)
+        total.aum += market_value
+        total.fee += fee
+        session.add(total)
+
+
+event.listen(Session, 'before_flush', update_quarter_rollups)
+
+
+# PRE:  quarter_id is the id of a Quarter
+# POST: The quarter's aum, fee, and per-custodian and per-fee-schedule totals
+#        have been recomputed from the snapshot tables with aggregate queries.
+#        Used after bulk writes and set-based statements, which skip the flush
+#        events that keep the totals current.
+#       RV = # of rollup rows written: the quarter plus its per-custodian and
+#             per-fee-schedule totals
+def refresh_quarter_rollups(quarter_id):
+    quarter = Quarter.query.get(int(quarter_id))
+    fee_schedule_rows = (db.session.query(GroupSnapshot.fee_schedule_id, func.sum(GroupSnapshot.market_value),
+                                          func.sum(GroupSnapshot.fee), func.count())
+                         .filter(GroupSnapshot.quarter_id == quarter.id)
+                         .group_by(GroupSnapshot.fee_schedule_id).all())
+    custodian_rows = (db.session.query(AccountSnapshot.custodian,
+                                       func.sum(AccountSnapshot.market_value), func.sum(AccountSnapshot.fee))
+                      .filter(AccountSnapshot.quarter_id == quarter.id)
+                      .group_by(AccountSnapshot.custodian).all())
+    QuarterFeeScheduleTotal.query.filter_by(quarter_id=quarter.id).delete(synchronize_session=False)
+    QuarterCustodianTotal.query.filter_by(quarter_id=quarter.id).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(QuarterFeeScheduleTotal,
+                                    [{'quarter_id': quarter.id, 'fee_schedule_id': fee_schedule_id,
+                                      'aum': aum or 0, 'fee': fee or 0}
+                                     for fee_schedule_id, aum, fee, count in fee_schedule_rows])
+    db.session.bulk_insert_mappings(QuarterCustodianTotal,
+                                    [{'quarter_id': quarter.id, 'custodian': custodian,
+                                      'aum': aum or 0, 'fee': fee or 0}
+                                     for custodian, aum, fee in custodian_rows])
+    quarter.aum = sum(aum or 0 for fee_schedule_id, aum, fee, count in fee_schedule_rows)
+    quarter.fee = sum(fee or 0 for fee_schedule_id, aum, fee, count in fee_schedule_rows)
+    db.session.add(quarter)
+    db.session.commit()
+    return 1 + len(fee_schedule_rows) + len(custodian_rows)
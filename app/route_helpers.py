@@ -1,12 +1,24 @@
 from app import db
 from app.models import (Client, Account, Transaction, Custodian,
-                        Position, Group, FeeSchedule, Security,
+                        Position, Group, FeeSchedule, FeeRule, Security,
                         OptionQuote)
+from flask import flash
+from sqlalchemy import tuple_, func, inspect
 from werkzeug.utils import secure_filename
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event
+import codecs
+import csv
+import hashlib
 import os
 import xml.etree.ElementTree as ET
+import numpy as np
 from datetime import date
 
+CSV_CHUNK_SIZE = 64 * 1024
+CSV_BATCH_SIZE = 1000
+
 
 # PRE:  The Custodian data table must be defined with rows id and name
 # POST: Returns a list of tuples (custodian.id, custodian.name) for each custodian in Custodian
@@ -44,135 +56,771 @@ def upload_file(file_object):
         return lines
 
 
-# PRE:  file_object is a file uploaded via HTML form with format .xml
-# POST: The file associated with file_object has been saved and the data has been parsed into
-#        an ElementTree. The ElementTree is returned.
-def upload_xml_file(file_object):
-    filename = os.path.join('uploads/files/' + secure_filename(file_object.filename))
-    file_object.save(filename)
-    tree = ET.parse(filename)
-    return tree
+# PRE:  value is a csv field
+# POST: RV = value converted to the column type
+def parse_string(value):
+    return value.strip()
+
+
+def parse_float(value):
+    return float(value.strip())
+
+
+def parse_optional_float(value):
+    value = value.strip()
+    return float(value) if value else None
+
+
+def parse_date(value):
+    return date.fromisoformat(value.strip())
+
+
+def parse_bool(value):
+    return value.strip().lower() == 'true'
+
+
+# Column schemas for the csv importers: (field name, parser) per column in file
+# order. A field name of None marks a column that is ignored.
+CLIENT_COLUMNS = [('first_name', parse_string), ('middle_name', parse_string), ('last_name', parse_string),
+                  ('dob', parse_date), ('email', parse_string), ('cell_phone', parse_string),
+                  ('work_phone', parse_string), ('home_phone', parse_string), ('group_name', parse_string)]
+ACCOUNT_COLUMNS = [('account_number', parse_string), ('description', parse_string),
+                   ('client_first', parse_string), ('client_last', parse_string), ('custodian', parse_string),
+                   ('billable', parse_bool), ('discretionary', parse_bool)]
+TRANSACTION_COLUMNS = [('date', parse_date), ('account_number', parse_string), ('type', parse_string),
+                       ('symbol', parse_string), ('name', parse_string), ('quantity', parse_float),
+                       ('share_price', parse_float), ('gross_amount', parse_float),
+                       ('description', parse_string)]
+OPTION_QUOTE_COLUMNS = [('symbol', parse_string), ('type', parse_string), ('expiration_date', parse_date),
+                        ('strike_price', parse_float), ('bid', parse_float), ('ask', parse_float),
+                        ('last', parse_float), ('high', parse_float), ('low', parse_float),
+                        ('change', parse_float), ('volume', parse_float), ('open_interest', parse_float)]
+FEE_SCHEDULE_COLUMNS = [('name', parse_string), ('minimum', parse_float), ('maximum', parse_optional_float),
+                        ('rate', parse_float), ('flat', parse_float)]
+ACCOUNT_VALUE_COLUMNS = [('date', parse_date), ('account_number', parse_string), (None, None), (None, None),
+                         ('market_value', parse_float)]
+POSITION_COLUMNS = [('account_number', parse_string), ('symbol', parse_string), ('name', parse_string),
+                    ('quantity', parse_float), ('cost_basis', parse_float)]
+
+# Custodian xml record tag (lower case) -> the column schema of its fields
+XML_RECORD_COLUMNS = {
+    'transaction': TRANSACTION_COLUMNS,
+    'position': POSITION_COLUMNS,
+}
+
+
+# PRE:  file_object is a file uploaded via HTML form or a binary file object
+#       chunk_size is the number of bytes read at a time
+# POST: RV is a generator over the decoded lines of the file, each ending in its
+#        newline. At most one chunk and one partial line are held in memory.
+def iterate_upload_lines(file_object, chunk_size=CSV_CHUNK_SIZE):
+    stream = getattr(file_object, 'stream', file_object)
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    remainder = ''
+    chunk = stream.read(chunk_size)
+    while chunk:
+        lines = (remainder + decoder.decode(chunk)).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        chunk = stream.read(chunk_size)
+    remainder += decoder.decode(b'', final=True)
+    if remainder:
+        yield remainder
+
+
+# PRE:  file_object is a csv file uploaded via HTML form whose first row is a header
+#       columns is a column schema such as CLIENT_COLUMNS
+#       errors is a list collecting rows that could not be parsed
+#       batch_size is the maximum number of rows per batch
+# POST: RV is a generator over lists of at most batch_size dictionaries, one per
+#        data row, keyed by the schema's field names with parsed values. Rows that
+#        fail to parse are skipped and recorded in errors as {'line', 'error'}.
+def read_csv_batches(file_object, columns, errors, batch_size=CSV_BATCH_SIZE):
+    reader = csv.reader(iterate_upload_lines(file_object=file_object))
+    next(reader, None)
+    batch = []
+    for row in reader:
+        if not any(field.strip() for field in row):
+            continue
+        if len(row) < len(columns):
+            errors.append({'line': reader.line_num,
+                           'error': 'expected {} columns, found {}'.format(len(columns), len(row))})
+            continue
+        try:
+            batch.append({name: parse(row[index]) for index, (name, parse) in enumerate(columns)
+                          if name is not None})
+        except ValueError as error:
+            errors.append({'line': reader.line_num, 'error': str(error)})
+            continue
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# PRE:  name is an xml tag or attribute name, possibly namespaced
+# POST: RV = name without its namespace, underscores, or case, so AccountNumber,
+#        account_number and ACCOUNT_NUMBER compare equal
+def normalize_xml_name(name):
+    return name.rsplit('}', 1)[-1].replace('_', '').lower()
+
+
+# PRE:  element is a complete xml record element
+#       columns is a column schema such as TRANSACTION_COLUMNS
+# POST: RV = dictionary keyed by the schema's field names, read from the
+#        element's attributes or child elements, with parsed values
+def parse_xml_record(element, columns):
+    values = {normalize_xml_name(name): value for name, value in element.attrib.items()}
+    for child in element:
+        values.setdefault(normalize_xml_name(child.tag), child.text or '')
+    row = {}
+    for name, parse in columns:
+        if name is None:
+            continue
+        if normalize_xml_name(name) not in values:
+            raise ValueError('missing field {}'.format(name))
+        row[name] = parse(values[normalize_xml_name(name)])
+    return row
+
+
+# PRE:  file_object is an xml file uploaded via HTML form or a binary file object
+#       errors is a list collecting records that could not be parsed
+#       batch_size is the maximum number of records per batch
+# POST: RV is a generator over (kind, batch) pairs where kind is a key of
+#        XML_RECORD_COLUMNS and batch a list of at most batch_size records of that
+#        kind in document order. The file is read with iterparse and every record
+#        is cleared and detached from its parent once parsed, so memory stays
+#        bounded by the batch size rather than the file size. Records that fail to
+#        parse are recorded in errors as {'line': record number, 'error'}.
+def read_xml_batches(file_object, errors, batch_size=CSV_BATCH_SIZE):
+    stream = getattr(file_object, 'stream', file_object)
+    parents = []
+    record_depth = 0
+    kind = None
+    batch = []
+    record_number = 0
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        tag = normalize_xml_name(element.tag)
+        if event == 'start':
+            parents.append(element)
+            record_depth += tag in XML_RECORD_COLUMNS
+            continue
+        parents.pop()
+        if tag in XML_RECORD_COLUMNS:
+            record_depth -= 1
+            record_number += 1
+            if tag != kind and batch:
+                yield kind, batch
+                batch = []
+            kind = tag
+            try:
+                batch.append(parse_xml_record(element=element, columns=XML_RECORD_COLUMNS[tag]))
+            except ValueError as error:
+                errors.append({'line': record_number, 'error': str(error)})
+            if len(batch) == batch_size:
+                yield kind, batch
+                batch = []
+        if record_depth == 0:
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+    if batch:
+        yield kind, batch
+
+
+# PRE:  row is a dictionary read with columns
+#       columns is the column schema the row was read with
+#       context is a tuple of values the row is scoped to, such as its quarter
+# POST: RV = hex digest of the row's parsed values and context
+def get_row_content_hash(row, columns, context=()):
+    values = [row[name] for name, parse in columns if name is not None] + list(context)
+    return hashlib.sha1('\x1f'.join(repr(value) for value in values).encode()).hexdigest()
+
+
+# PRE:  content_hash is a hex digest as returned by get_row_content_hash
+#       occurrences is a dictionary {content hash prefix: count} shared by every
+#        batch of one upload, keyed by 64 bit integers to keep it small
+# POST: RV = fingerprint built from the content hash and how many identical rows
+#        came before it in the upload, so a file with two identical rows keeps
+#        both while a re-upload of either is recognized
+def get_occurrence_fingerprint(content_hash, occurrences):
+    key = int(content_hash[:16], 16)
+    occurrence = occurrences.get(key, 0)
+    occurrences[key] = occurrence + 1
+    return hashlib.sha1('{}:{}'.format(content_hash, occurrence).encode()).hexdigest()
+
+
+# PRE:  model is a model with an indexed fingerprint column
+#       rows is a batch of dictionaries read with columns
+#       occurrences is passed to get_occurrence_fingerprint
+#       context is passed to get_row_content_hash
+# POST: Each row has been given a 'fingerprint' by get_occurrence_fingerprint.
+#        Fingerprints already stored are found with one indexed IN query.
+#       RV = (rows not yet imported, # of duplicate rows skipped)
+def remove_duplicate_rows(model, rows, columns, occurrences, context=()):
+    for row in rows:
+        content_hash = get_row_content_hash(row=row, columns=columns, context=context)
+        row['fingerprint'] = get_occurrence_fingerprint(content_hash=content_hash, occurrences=occurrences)
+    fingerprints = [row['fingerprint'] for row in rows]
+    existing = set(fingerprint for fingerprint, in
+                   db.session.query(model.fingerprint).filter(model.fingerprint.in_(fingerprints)))
+    new_rows = [row for row in rows if row['fingerprint'] not in existing]
+    return new_rows, len(rows) - len(new_rows)
+
+
+# PRE:  summary is an import summary of format {'rows': int, 'errors': list}
+#        with an optional 'duplicates' count
+# POST: The number of rows imported and the first errors have been flashed
+def flash_import_summary(summary, max_errors=10):
+    if summary.get('duplicates'):
+        flash('Imported {} rows, skipped {} duplicate rows, {} rows rejected'.format(
+            summary['rows'], summary['duplicates'], len(summary['errors'])))
+    else:
+        flash('Imported {} rows, {} rows rejected'.format(summary['rows'], len(summary['errors'])))
+    for error in summary['errors'][:max_errors]:
+        flash('Line {line}: {error}'.format(**error))
 
 
 # Pre:  file_object is a file uploaded via HTML form with format .csv
 #        containing client data
-# Post:
+# Post: A Client has been added for every valid row, creating groups as needed
+#       RV = {'rows': # of clients added, 'errors': rows rejected}
 def process_client_csv_file(file_object):
-    lines = upload_file(file_object=file_object)
-    data = [line.strip().split(',') for line in lines]
-    for line in data:
-        group_name = line[8].strip()
-        group_id = None
-        assigned = False
-        if group_name is not None:
-            assigned = True
-            group = Group.query.filter_by(name=group_name).first()
-            if group is None:
-                group = Group(name=group_name)
-                db.session.add(group)
-                db.session.commit()
-            group_id = group.id
-        client = Client(first_name=line[0].strip(),
-                        middle_name=line[1].strip(),
-                        last_name=line[2].strip(),
-                        dob=date.fromisoformat(data[3].strip()),
-                        email=line[4].strip(),
-                        cell_phone=line[5].strip(),
-                        work_phone=line[6].strip(),
-                        home_phone=line[7].strip(),
-                        group_id=group_id,
-                        assigned=assigned)
-        db.session.add(client)
-    db.session.commit()
+    errors = []
+    count = 0
+    for batch in read_csv_batches(file_object=file_object, columns=CLIENT_COLUMNS, errors=errors):
+        for row in batch:
+            group_id = None
+            if row['group_name']:
+                group = Group.query.filter_by(name=row['group_name']).first()
+                if group is None:
+                    group = Group(name=row['group_name'])
+                    db.session.add(group)
+                    db.session.flush()
+                group_id = group.id
+            client = Client(first_name=row['first_name'],
+                            middle_name=row['middle_name'],
+                            last_name=row['last_name'],
+                            dob=row['dob'],
+                            email=row['email'],
+                            cell_phone=row['cell_phone'],
+                            work_phone=row['work_phone'],
+                            home_phone=row['home_phone'],
+                            group_id=group_id,
+                            assigned=group_id is not None)
+            db.session.add(client)
+            count += 1
+        db.session.commit()
+    return {'rows': count, 'errors': errors}
 
 
-# Pre:
-# Post:
+# Pre:  file_object is a file uploaded via HTML form with format .csv
+#        containing account data
+# Post: An Account has been added for every valid row whose client exists,
+#        creating custodians as needed
+#       RV = {'rows': # of accounts added, 'errors': rows rejected}
 def process_account_csv_file(file_object):
-    lines = upload_file(file_object=file_object)
-    data = [line.split(',') for line in lines]
-    for line in data:
-        client_first = line[2].strip()
-        client_last = line[3].strip()
-        custodian_name = line[4].strip()
-        client = Client.query.filter_by(first_name=client_first, last_name=client_last).first()
-        if client is not None:
-            custodian = Custodian.query.filter_by(name=custodian_name).first()
-            if custodian is None:
-                custodian = Custodian(name=custodian_name)
-                db.session.add(custodian)
-                db.session.commit()
-            account = Account(account_number=line[0].strip(),
-                              description=line[1].strip(),
-                              billable=(line[5].strip.lower() == 'true'),
-                              discretionary=(line[6].strip().lower() == 'true'),
-                              client_id=client.id,
-                              group_id=client.group_id,
-                              custodian_id=custodian.id)
-            db.session.add(account)
-    db.session.commit()
+    errors = []
+    count = 0
+    for batch in read_csv_batches(file_object=file_object, columns=ACCOUNT_COLUMNS, errors=errors):
+        for row in batch:
+            client = Client.query.filter_by(first_name=row['client_first'], last_name=row['client_last']).first()
+            if client is not None:
+                custodian = Custodian.query.filter_by(name=row['custodian']).first()
+                if custodian is None:
+                    custodian = Custodian(name=row['custodian'])
+                    db.session.add(custodian)
+                    db.session.flush()
+                account = Account(account_number=row['account_number'],
+                                  description=row['description'],
+                                  billable=row['billable'],
+                                  discretionary=row['discretionary'],
+                                  client_id=client.id,
+                                  group_id=client.group_id,
+                                  custodian_id=custodian.id)
+                db.session.add(account)
+                count += 1
+        db.session.commit()
+    return {'rows': count, 'errors': errors}
+
 
+# PRE:  quantity and cost_basis are a position's current values
+#       transaction_type, quantity_delta and gross_amount describe a transaction
+# POST: RV = (quantity, cost_basis) after applying the transaction the way
+#        Position.add_transaction does, clamping a SELL's cost basis at 0
+def fold_transaction(quantity, cost_basis, transaction_type, quantity_delta, gross_amount):
+    if transaction_type.upper() == 'BUY':
+        return quantity + quantity_delta, cost_basis + gross_amount
+    elif transaction_type.upper() == 'SELL':
+        return quantity - quantity_delta, max(cost_basis - gross_amount, 0)
+    return quantity, cost_basis
 
-# Pre:
-# Post:
-def process_transaction_csv_file(file_object):
-    lines = upload_file(file_object=file_object)
-    data = [line.split(',') for line in lines]
-    for line in data:
-        symbol = data[3].strip()
-        name = data[4].strip()
-        account = Account.query.filter_by(account_number=line[1].strip()).first()
-        if account is not None:
-            security = Security.query.filter_by(symbol=symbol).first()
-            if security is None:
-                security = Security(symbol=symbol, name=name)
-                db.session.add(security)
-                db.session.commit()
-            position = Position.query.filter_by(account_id=account.id, security_id=security.id).first()
-            if position is None:
-                position = Position(account_id=account.id, security_id=security.id, quantity=0, cost_basis=0)
+
+# Pre:  file_object is a file uploaded via HTML form with format .csv
+#        containing transaction data
+# Post: A Transaction has been added for every valid row whose account exists,
+#        creating securities and positions as needed and updating the position
+#        Rows already imported by an earlier upload are skipped.
+#       RV = {'rows': # of transactions added, 'duplicates': # of rows skipped,
+#             'errors': rows rejected}
+def process_transaction_csv_file(file_object, bulk=True):
+    if bulk:
+        return bulk_import_transactions(file_object=file_object)
+    errors = []
+    count = 0
+    duplicates = 0
+    occurrences = {}
+    for batch in read_csv_batches(file_object=file_object, columns=TRANSACTION_COLUMNS, errors=errors):
+        batch, skipped = remove_duplicate_rows(model=Transaction, rows=batch, columns=TRANSACTION_COLUMNS,
+                                               occurrences=occurrences)
+        duplicates += skipped
+        for row in batch:
+            account = Account.query.filter_by(account_number=row['account_number']).first()
+            if account is not None:
+                security = Security.query.filter_by(symbol=row['symbol']).first()
+                if security is None:
+                    security = Security(symbol=row['symbol'], name=row['name'])
+                    db.session.add(security)
+                    db.session.flush()
+                position = Position.query.filter_by(account_id=account.id, security_id=security.id).first()
+                if position is None:
+                    position = Position(account_id=account.id, security_id=security.id, quantity=0, cost_basis=0)
+                    db.session.add(position)
+                    db.session.flush()
+                transaction = Transaction(date=row['date'],
+                                          type=row['type'],
+                                          quantity=row['quantity'],
+                                          share_price=row['share_price'],
+                                          gross_amount=row['gross_amount'],
+                                          description=row['description'],
+                                          fingerprint=row['fingerprint'],
+                                          account_id=account.id,
+                                          security_id=security.id,
+                                          position_id=position.id)
+                position.add_transaction(transaction_type=transaction.type, quantity=transaction.quantity,
+                                         gross_amount=transaction.gross_amount)
+                db.session.add(transaction)
                 db.session.add(position)
-                db.session.commit()
-            transaction = Transaction(date=date.fromisoformat(line[0].strip()),
-                                      type=line[2].strip(),
-                                      quantity=float(line[5].strip()),
-                                      share_price=float(line[6].strip()),
-                                      gross_amount=float(line[7].strip()),
-                                      description=line[8].strip(),
-                                      account_id=account.id,
-                                      security_id=security.id,
-                                      position_id=position.id)
-            position.add_transaction(transaction_type=transaction.type, quantity=transaction.quantity,
-                                     gross_amount=transaction.gross_amount)
-            db.session.add(transaction)
-            db.session.add(position)
+                count += 1
+        db.session.commit()
+    return {'rows': count, 'duplicates': duplicates, 'errors': errors}
+
+
+# PRE:  rows is a list of transaction rows as read with TRANSACTION_COLUMNS
+#       account_ids is a dictionary {account_number: account id or None}
+#       security_ids is a dictionary {symbol: security id}
+#       positions is a dictionary {(account_id, security_id): [id, quantity, cost_basis]}
+# POST: The accounts, securities and positions used by rows have been loaded into
+#        the dictionaries with IN queries, inserting the missing securities and
+#        positions in one statement each
+def resolve_transaction_keys(rows, account_ids, security_ids, positions):
+    account_numbers = set(row['account_number'] for row in rows) - set(account_ids)
+    if account_numbers:
+        account_ids.update(dict.fromkeys(account_numbers))
+        account_ids.update(db.session.query(Account.account_number, Account.id)
+                           .filter(Account.account_number.in_(account_numbers)).all())
+    rows = [row for row in rows if account_ids[row['account_number']] is not None]
+    new_securities = {}
+    for row in rows:
+        if row['symbol'] not in security_ids:
+            new_securities.setdefault(row['symbol'], row['name'])
+    if new_securities:
+        security_ids.update(db.session.query(Security.symbol, Security.id)
+                            .filter(Security.symbol.in_(new_securities)).all())
+        missing = [{'symbol': symbol, 'name': name} for symbol, name in new_securities.items()
+                   if symbol not in security_ids]
+        if missing:
+            db.session.bulk_insert_mappings(Security, missing)
+            security_ids.update(db.session.query(Security.symbol, Security.id)
+                                .filter(Security.symbol.in_([security['symbol'] for security in missing])).all())
+    keys = set((account_ids[row['account_number']], security_ids[row['symbol']]) for row in rows) - set(positions)
+    if keys:
+        query = (db.session.query(Position.account_id, Position.security_id, Position.id,
+                                  Position.quantity, Position.cost_basis)
+                 .filter(tuple_(Position.account_id, Position.security_id).in_(keys))
+                 .order_by(Position.id))
+        for account_id, security_id, position_id, quantity, cost_basis in query:
+            positions.setdefault((account_id, security_id), [position_id, quantity or 0, cost_basis or 0])
+        missing = keys - set(positions)
+        if missing:
+            db.session.bulk_insert_mappings(Position, [{'account_id': account_id, 'security_id': security_id,
+                                                        'quantity': 0, 'cost_basis': 0}
+                                                       for account_id, security_id in missing])
+            query = (db.session.query(Position.account_id, Position.security_id, Position.id)
+                     .filter(tuple_(Position.account_id, Position.security_id).in_(missing)))
+            for account_id, security_id, position_id in query:
+                positions.setdefault((account_id, security_id), [position_id, 0, 0])
+    return rows
+
+
+class BulkTransactionWriter(object):
+    # PRE:  account_ids is an optional dictionary {account_number: account id}
+    #        of accounts already known, so they are not looked up again
+    def __init__(self, account_ids=None):
+        self.account_ids = dict(account_ids or {})
+        self.security_ids = {}
+        self.positions = {}
+        self.changed = set()
+        self.occurrences = {}
+        self.count = 0
+        self.position_count = 0
+        self.duplicates = 0
+
+    # PRE:  batch is a list of transaction rows as read with TRANSACTION_COLUMNS
+    # POST: The rows not already imported whose account exists have been written
+    #        with one bulk insert and folded into their positions in memory
+    def write_batch(self, batch):
+        batch, skipped = remove_duplicate_rows(model=Transaction, rows=batch, columns=TRANSACTION_COLUMNS,
+                                               occurrences=self.occurrences)
+        self.duplicates += skipped
+        rows = resolve_transaction_keys(rows=batch, account_ids=self.account_ids, security_ids=self.security_ids,
+                                        positions=self.positions)
+        transactions = []
+        for row in rows:
+            account_id = self.account_ids[row['account_number']]
+            security_id = self.security_ids[row['symbol']]
+            position = self.positions[(account_id, security_id)]
+            position[1], position[2] = fold_transaction(quantity=position[1], cost_basis=position[2],
+                                                        transaction_type=row['type'],
+                                                        quantity_delta=row['quantity'],
+                                                        gross_amount=row['gross_amount'])
+            self.changed.add((account_id, security_id))
+            transactions.append({'date': row['date'], 'type': row['type'], 'quantity': row['quantity'],
+                                 'share_price': row['share_price'], 'gross_amount': row['gross_amount'],
+                                 'description': row['description'], 'fingerprint': row['fingerprint'],
+                                 'account_id': account_id,
+                                 'security_id': security_id, 'position_id': position[0]})
+        db.session.bulk_insert_mappings(Transaction, transactions)
+        self.count += len(transactions)
+
+    # PRE:  batch is a list of position rows as read with POSITION_COLUMNS
+    # POST: The quantity and cost basis of each position whose account exists
+    #        have been set to the row's values in memory, creating securities and
+    #        positions as needed. Later transactions fold onto the new values.
+    def write_positions(self, batch):
+        rows = resolve_transaction_keys(rows=batch, account_ids=self.account_ids, security_ids=self.security_ids,
+                                        positions=self.positions)
+        for row in rows:
+            key = (self.account_ids[row['account_number']], self.security_ids[row['symbol']])
+            self.positions[key][1] = row['quantity']
+            self.positions[key][2] = row['cost_basis']
+            self.changed.add(key)
+        self.position_count += len(rows)
+
+    # POST: The folded quantity and cost basis of every position written to has
+    #        been saved with one bulk update. The caller commits.
+    def finish(self):
+        db.session.bulk_update_mappings(Position, [{'id': self.positions[key][0],
+                                                    'quantity': self.positions[key][1],
+                                                    'cost_basis': self.positions[key][2]}
+                                                   for key in self.changed])
+
+
+# Pre:  file_object is a file uploaded via HTML form with format .csv
+#        containing transaction data
+# Post: The same rows as the row-by-row import have been added in a single
+#        database transaction. Accounts, securities and positions are resolved
+#        per batch with IN queries, the transactions are written with bulk
+#        inserts, and each position's quantity and cost basis are folded in
+#        memory and written once at the end.
+#       RV = {'rows': # of transactions added, 'duplicates': # of rows skipped,
+#             'errors': rows rejected}
+def bulk_import_transactions(file_object):
+    errors = []
+    writer = BulkTransactionWriter()
+    for batch in read_csv_batches(file_object=file_object, columns=TRANSACTION_COLUMNS, errors=errors):
+        writer.write_batch(batch=batch)
+    writer.finish()
     db.session.commit()
+    return {'rows': writer.count, 'duplicates': writer.duplicates, 'errors': errors}
 
 
-# Pre:
-# Post:
+# Pre:  file_object is a custodian xml file uploaded via HTML form whose
+#        <Position> and <Transaction> records carry the POSITION_COLUMNS and
+#        TRANSACTION_COLUMNS fields as attributes or child elements
+# Post: The records have been streamed through the bulk transaction writer in
+#        document order and committed in a single database transaction. A
+#        position record sets the position's quantity and cost basis; a
+#        transaction record is added and folded into its position.
+#       RV = {'rows': # of records imported, 'positions': # of positions set,
+#             'transactions': # of transactions added, 'duplicates': # of
+#             transactions skipped, 'errors': records rejected}
+def process_xml_file(file_object):
+    errors = []
+    writer = BulkTransactionWriter()
+    for kind, batch in read_xml_batches(file_object=file_object, errors=errors):
+        if kind == 'position':
+            writer.write_positions(batch=batch)
+        else:
+            writer.write_batch(batch=batch)
+    writer.finish()
+    db.session.commit()
+    return {'rows': writer.position_count + writer.count, 'positions': writer.position_count,
+            'transactions': writer.count, 'duplicates': writer.duplicates, 'errors': errors}
+
+
+# Pre:  file_object is a file uploaded via HTML form with format .csv
+#        containing option quotes
+# Post: Every valid row whose security exists has been stored as an OptionQuote
+#        dated today. The file is read once into column lists and the contract
+#        columns are turned into NumPy arrays: the symbols are mapped to
+#        securities with one query and an index lookup, and the last row for
+#        each (security_id, type, expiration_date, strike_price) is picked with
+#        one np.unique over the keys. The quotes are keyed by (security_id,
+#        quote_date, type, expiration_date, strike_price): new contracts are bulk
+#        inserted, contracts already quoted today are bulk updated, and rows
+#        identical to the stored quote are skipped.
+#       RV = {'rows': # of quotes inserted or updated, 'inserted', 'updated',
+#             'duplicates': # of rows unchanged, 'unmatched': # of rows with an
+#             unknown symbol, 'errors': rows rejected}
 def process_option_quote_csv_file(file_object):
-    lines = upload_file(file_object=file_object)
-    data = [line.split(',') for line in lines]
+    errors = []
     quote_date = date.today()
-    for line in data:
-        symbol = line[0].strip()
-        security = Security.query.filter_by(symbol=symbol).first()
-        if security is not None:
-            quote = OptionQuote(symbol=symbol,
-                                security_id=security.id,
-                                quote_date=quote_date,
-                                type=line[1].strip().lower(),
-                                expiration_date=date.fromisoformat(line[2].strip()),
-                                strike_price=float(line[3].strip()),
-                                bid=float(line[4].strip()),
-                                ask=float(line[5].strip()),
-                                last=float(line[6].strip()),
-                                high=float(line[7].strip()),
-                                low=float(line[8].strip()),
-                                change=float(line[9].strip()),
-                                volume=float(line[10].strip()),
-                                open_interest=float(line[11].strip()))
-            db.session.add(quote)
+    fields = [name for name, parse in OPTION_QUOTE_COLUMNS]
+    columns = {name: [] for name in fields}
+    for batch in read_csv_batches(file_object=file_object, columns=OPTION_QUOTE_COLUMNS, errors=errors):
+        for name in fields:
+            columns[name] += [row[name] for row in batch]
+    num_rows = len(columns['symbol'])
+    symbols, symbol_index = np.unique(np.array(columns['symbol'], dtype=str), return_inverse=True)
+    security_ids = dict(db.session.query(Security.symbol, Security.id).filter(Security.symbol.in_(symbols.tolist()))) \
+        if num_rows else {}
+    row_security_ids = np.array([security_ids.get(symbol, -1) for symbol in symbols.tolist()],
+                                dtype=np.int64)[symbol_index]
+    matched = np.nonzero(row_security_ids >= 0)[0]
+    unmatched = num_rows - len(matched)
+
+    # Reversed so np.unique's first occurrence of a contract is its last row
+    keys = np.rec.fromarrays([row_security_ids[matched][::-1],
+                              np.char.lower(np.array(columns['type'], dtype=str)[matched][::-1]),
+                              np.array(columns['expiration_date'], dtype='datetime64[D]')[matched][::-1],
+                              np.array(columns['strike_price'], dtype=float)[matched][::-1]],
+                             names='security_id,type,expiration_date,strike_price')
+    keys, last_rows = np.unique(keys, return_index=True)
+    rows = matched[::-1][last_rows]
+
+    existing = {}
+    if len(rows):
+        query = (db.session.query(OptionQuote.id, OptionQuote.fingerprint, OptionQuote.security_id,
+                                  OptionQuote.type, OptionQuote.expiration_date, OptionQuote.strike_price)
+                 .filter(OptionQuote.quote_date == quote_date,
+                         OptionQuote.security_id.in_(set(security_ids.values()))))
+        for quote_id, fingerprint, security_id, quote_type, expiration_date, strike_price in query:
+            existing[(security_id, quote_type, expiration_date, strike_price)] = (quote_id, fingerprint)
+    inserts = []
+    updates = []
+    for index, security_id in zip(rows.tolist(), row_security_ids[rows].tolist()):
+        quote = {name: columns[name][index] for name in fields}
+        quote['type'] = quote['type'].lower()
+        quote['fingerprint'] = get_row_content_hash(row=quote, columns=OPTION_QUOTE_COLUMNS, context=(quote_date,))
+        quote['security_id'] = security_id
+        quote['quote_date'] = quote_date
+        key = (security_id, quote['type'], quote['expiration_date'], quote['strike_price'])
+        if key not in existing:
+            inserts.append(quote)
+        elif existing[key][1] != quote['fingerprint']:
+            updates.append(dict(quote, id=existing[key][0]))
+    db.session.bulk_insert_mappings(OptionQuote, inserts)
+    db.session.bulk_update_mappings(OptionQuote, updates)
     db.session.commit()
+    duplicates = num_rows - unmatched - len(inserts) - len(updates)
+    return {'rows': len(inserts) + len(updates), 'inserted': len(inserts), 'updated': len(updates),
+            'duplicates': duplicates, 'unmatched': unmatched, 'errors': errors}
+
+
+# POST: Repeated contract rows left in the option quote table by imports made
+#        before the unique key existed have been deleted, keeping the last row
+#        stored for each (security_id, quote_date, type, expiration_date,
+#        strike_price), and the unique key has been added to a table created
+#        without it
+#       RV = # of rows deleted
+def remove_duplicate_option_quotes():
+    columns = ['security_id', 'quote_date', 'type', 'expiration_date', 'strike_price']
+    key = [getattr(OptionQuote, name) for name in columns]
+    keep = db.session.query(func.max(OptionQuote.id)).group_by(*key)
+    deleted = (db.session.query(OptionQuote)
+               .filter(OptionQuote.id.not_in(keep.scalar_subquery()), *[column.isnot(None) for column in key])
+               .delete(synchronize_session=False))
+    db.session.commit()
+    inspector = inspect(db.engine)
+    keys = inspector.get_unique_constraints(OptionQuote.__tablename__) + \
+        [index for index in inspector.get_indexes(OptionQuote.__tablename__) if index['unique']]
+    if not any(unique_key['column_names'] == columns for unique_key in keys):
+        constraint, = [arg for arg in OptionQuote.__table_args__ if isinstance(arg, db.UniqueConstraint)]
+        db.Index(constraint.name, *key, unique=True).create(db.engine)
+    return deleted
+
+
+# Pre:  file_object is a file uploaded via HTML form with format .csv
+#        containing fee schedule rules
+# Post: A FeeRule has been added for every valid row, creating fee schedules as
+#        needed, and the rules version of every schedule changed has been bumped
+#       RV = {'rows': # of rules added, 'errors': rows rejected}
+def process_fee_schedule_csv_file(file_object):
+    errors = []
+    count = 0
+    for batch in read_csv_batches(file_object=file_object, columns=FEE_SCHEDULE_COLUMNS, errors=errors):
+        for row in batch:
+            fee_schedule = FeeSchedule.query.filter_by(name=row['name']).first()
+            if fee_schedule is None:
+                fee_schedule = FeeSchedule(name=row['name'])
+                db.session.add(fee_schedule)
+                db.session.flush()
+            fee_rule = FeeRule(minimum=row['minimum'], maximum=row['maximum'], rate=row['rate'],
+                               flat=row['flat'], schedule_id=fee_schedule.id)
+            db.session.add(fee_rule)
+            fee_schedule.rules_changed()
+            count += 1
+        db.session.commit()
+    return {'rows': count, 'errors': errors}
+
+
+# PRE:  file_object, columns and errors are as accepted by read_csv_batches
+# POST: RV = list of every parsed row of the file
+def read_csv_rows(file_object, columns, errors):
+    rows = []
+    for batch in read_csv_batches(file_object=file_object, columns=columns, errors=errors):
+        rows += batch
+    return rows
+
+
+# PRE:  queue is a bounded Queue read by another thread
+#       stop is an Event set when the reader has given up
+# POST: item has been put on queue unless stop was set first
+#       RV = True when item was put on queue
+def put_until_stopped(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+# PRE:  file_object, columns and errors are as accepted by read_csv_batches
+#       batches is a bounded Queue receiving the batches followed by None
+#       stop is an Event set when the reader of batches has given up
+# POST: The file's batches have been put on batches, ending with None
+def queue_csv_batches(file_object, columns, errors, batches, stop):
+    try:
+        for batch in read_csv_batches(file_object=file_object, columns=columns, errors=errors):
+            if not put_until_stopped(queue=batches, item=batch, stop=stop):
+                return
+    finally:
+        put_until_stopped(queue=batches, item=None, stop=stop)
+
+
+# PRE:  rows is a list of client rows as read with CLIENT_COLUMNS
+# POST: A Client has been bulk inserted for every row, creating groups as needed
+#       RV = {(first_name, last_name): (client id, group id)} for every client in
+#        the database, the first client winning where names repeat
+def write_onboarding_clients(rows):
+    client_keys = {}
+    for first_name, last_name, client_id, group_id in (db.session.query(Client.first_name, Client.last_name,
+                                                                        Client.id, Client.group_id)
+                                                       .order_by(Client.id)):
+        client_keys.setdefault((first_name, last_name), (client_id, group_id))
+    group_names = list(dict.fromkeys(row['group_name'] for row in rows if row['group_name']))
+    group_ids = {}
+    if group_names:
+        for name, group_id in (db.session.query(Group.name, Group.id)
+                               .filter(Group.name.in_(group_names)).order_by(Group.id)):
+            group_ids.setdefault(name, group_id)
+        missing = [{'name': name} for name in group_names if name not in group_ids]
+        if missing:
+            db.session.bulk_insert_mappings(Group, missing, return_defaults=True)
+            group_ids.update((group['name'], group['id']) for group in missing)
+    clients = []
+    for row in rows:
+        group_id = group_ids.get(row['group_name'])
+        clients.append({'first_name': row['first_name'], 'middle_name': row['middle_name'],
+                        'last_name': row['last_name'], 'dob': row['dob'], 'email': row['email'],
+                        'cell_phone': row['cell_phone'], 'work_phone': row['work_phone'],
+                        'home_phone': row['home_phone'], 'group_id': group_id, 'assigned': group_id is not None})
+    db.session.bulk_insert_mappings(Client, clients, return_defaults=True)
+    for client in clients:
+        client_keys.setdefault((client['first_name'], client['last_name']), (client['id'], client['group_id']))
+    return client_keys
+
+
+# PRE:  rows is a list of account rows as read with ACCOUNT_COLUMNS
+#       client_keys is as returned by write_onboarding_clients
+# POST: An Account has been bulk inserted for every row whose client is in
+#        client_keys, creating custodians as needed
+#       RV = ({account_number: account id} for every account in the database,
+#             # of accounts added)
+def write_onboarding_accounts(rows, client_keys):
+    account_ids = {}
+    for account_number, account_id in db.session.query(Account.account_number, Account.id).order_by(Account.id):
+        account_ids.setdefault(account_number, account_id)
+    rows = [row for row in rows if (row['client_first'], row['client_last']) in client_keys]
+    custodian_names = list(dict.fromkeys(row['custodian'] for row in rows))
+    custodian_ids = {}
+    if custodian_names:
+        for name, custodian_id in (db.session.query(Custodian.name, Custodian.id)
+                                   .filter(Custodian.name.in_(custodian_names)).order_by(Custodian.id)):
+            custodian_ids.setdefault(name, custodian_id)
+        missing = [{'name': name} for name in custodian_names if name not in custodian_ids]
+        if missing:
+            db.session.bulk_insert_mappings(Custodian, missing, return_defaults=True)
+            custodian_ids.update((custodian['name'], custodian['id']) for custodian in missing)
+    accounts = []
+    for row in rows:
+        client_id, group_id = client_keys[(row['client_first'], row['client_last'])]
+        accounts.append({'account_number': row['account_number'], 'description': row['description'],
+                         'billable': row['billable'], 'discretionary': row['discretionary'],
+                         'client_id': client_id, 'group_id': group_id,
+                         'custodian_id': custodian_ids[row['custodian']]})
+    db.session.bulk_insert_mappings(Account, accounts, return_defaults=True)
+    for account in accounts:
+        account_ids.setdefault(account['account_number'], account['id'])
+    return account_ids, len(accounts)
+
 
+# Pre:  client_file, account_file and transaction_file are files uploaded via
+#        HTML form with format .csv in the formats of the client, account, and
+#        transaction importers
+# Post: The three files have been imported as a pipeline in one database
+#        transaction. All three are parsed concurrently; clients and accounts are
+#        written as soon as their files are read, with the client and account
+#        keys kept in memory so accounts and transactions resolve without
+#        queries, while transaction batches stream through the bulk transaction
+#        writer.
+#       RV = {'rows': # of rows added, 'clients', 'accounts', 'transactions':
+#             # added per file, 'duplicates': # of transactions skipped,
+#             'errors': rows rejected, each with the 'file' it came from}
+def process_onboarding_files(client_file, account_file, transaction_file):
+    client_errors = []
+    account_errors = []
+    transaction_errors = []
+    batches = Queue(maxsize=4)
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        client_rows = executor.submit(read_csv_rows, client_file, CLIENT_COLUMNS, client_errors)
+        account_rows = executor.submit(read_csv_rows, account_file, ACCOUNT_COLUMNS, account_errors)
+        transactions_read = executor.submit(queue_csv_batches, transaction_file, TRANSACTION_COLUMNS,
+                                            transaction_errors, batches, stop)
+        try:
+            client_keys = write_onboarding_clients(rows=client_rows.result())
+            account_ids, account_count = write_onboarding_accounts(rows=account_rows.result(),
+                                                                   client_keys=client_keys)
+            writer = BulkTransactionWriter(account_ids=account_ids)
+            batch = batches.get()
+            while batch is not None:
+                writer.write_batch(batch=batch)
+                batch = batches.get()
+            transactions_read.result()
+            writer.finish()
+            db.session.commit()
+        finally:
+            stop.set()
+    client_count = len(client_rows.result())
+    errors = ([dict(error, file='client file') for error in client_errors] +
+              [dict(error, file='account file') for error in account_errors] +
+              [dict(error, file='transaction file') for error in transaction_errors])
+    return {'rows': client_count + account_count + writer.count, 'clients': client_count,
+            'accounts': account_count, 'transactions': writer.count, 'duplicates': writer.duplicates,
+            'errors': errors}
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('security', __name__, template_folder='templates')
 
-from app.security import routes
+from app.security import routes, commands
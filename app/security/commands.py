@@ -0,0 +1,43 @@
+from app.security import bp
+from app.security.market_data import refresh_market_data, create_stub_server, remove_duplicate_price_rows
+from aiohttp import web
+import click
+
+
+@bp.cli.command('refresh-prices')
+@click.option('--rate', type=int, default=None,
+              help='Requests per minute allowed by the API tier. Defaults to ALPHAVANTAGE_REQUESTS_PER_MINUTE.')
+@click.option('--burst', type=int, default=1, show_default=True,
+              help='Requests that may be sent at once before the rate applies.')
+@click.option('--concurrency', type=int, default=8, show_default=True, help='Requests in flight at once.')
+@click.option('--outputsize', type=click.Choice(['auto', 'compact', 'full']), default='auto', show_default=True,
+              help='Series size. auto fetches the full series only for symbols whose stored history has a gap '
+                   'longer than a compact series.')
+@click.option('--retries', type=int, default=4, show_default=True)
+@click.option('--url', default=None, help='Query endpoint. Defaults to ALPHAVANTAGE_URL.')
+def refresh_prices(rate, burst, concurrency, outputsize, retries, url):
+    """Fetch daily adjusted prices for every security and benchmark."""
+    summary = refresh_market_data(requests_per_minute=rate, burst=burst, concurrency=concurrency,
+                                  outputsize=None if outputsize == 'auto' else outputsize, retries=retries, url=url)
+    for symbol, error in summary['failed']:
+        click.echo('{}: {}'.format(symbol, error))
+    click.echo('{refreshed}/{symbols} symbols refreshed, {rows} rows stored in {seconds:.1f}s '
+               '({symbols_per_minute:.1f} symbols/min)'.format(**summary))
+
+
+@bp.cli.command('stub-alpha-vantage')
+@click.option('--port', type=int, default=8765, show_default=True)
+@click.option('--days', type=int, default=100, show_default=True, help='Trading days per compact series.')
+@click.option('--notice-rate', type=float, default=0.0, show_default=True,
+              help='Share of requests answered with a rate limit notice.')
+@click.option('--delay', type=float, default=0.0, show_default=True, help='Seconds each response is held back.')
+def stub_alpha_vantage(port, days, notice_rate, delay):
+    """Serve synthetic daily adjusted series for running refresh-prices locally."""
+    web.run_app(create_stub_server(days=days, notice_rate=notice_rate, delay=delay), port=port)
+
+
+@bp.cli.command('dedupe-prices')
+def dedupe_prices():
+    """Delete repeated daily adjusted rows and add the unique (parent, date) keys."""
+    for table, count in remove_duplicate_price_rows().items():
+        click.echo('{}: {} duplicate rows deleted'.format(table, count))
@@ -0,0 +1,208 @@
+from app import db
+from app.models import Security, SecurityDailyAdjusted
+from app.alpha_vantage_cache import get_last_trading_day
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+import pandas as pd
+
+# Series type -> the SecurityDailyAdjusted column it is read from
+SERIES_COLUMNS = {
+    'open': SecurityDailyAdjusted.open,
+    'close': SecurityDailyAdjusted.close,
+    'adjusted_close': SecurityDailyAdjusted.adjusted_close,
+    'high': SecurityDailyAdjusted.high,
+    'low': SecurityDailyAdjusted.low,
+    'volume': SecurityDailyAdjusted.volume,
+}
+
+
+# Each indicator below takes values, a float array of prices in date order, and
+# period, a positive integer, and returns a float array the length of values
+# whose element i is the indicator as of values[i]. Elements before the first
+# full period are NaN. sma, wma, momentum and rolling_std also take a 2-D
+# securities x dates array and work along each row.
+
+def sma(values, period):
+    result = np.full(values.shape, np.nan)
+    if values.shape[-1] >= period:
+        sums = np.cumsum(np.concatenate((np.zeros(values.shape[:-1] + (1,)), values), axis=-1), axis=-1)
+        result[..., period - 1:] = (sums[..., period:] - sums[..., :-period]) / period
+    return result
+
+
+# Weights run 1..period with the latest price weighted most
+def wma(values, period):
+    result = np.full(values.shape, np.nan)
+    if values.shape[-1] >= period:
+        weights = np.arange(1, period + 1, dtype=float)
+        result[..., period - 1:] = sliding_window_view(values, period, axis=-1) @ weights / weights.sum()
+    return result
+
+
+# PRE:  values is a float array in date order
+#       alpha is the smoothing factor
+#       period is the number of values averaged to seed the recursion
+# POST: RV = exponential moving average of values seeded with the simple
+#        average of the first period values, as Alpha Vantage computes it. The
+#        recursion runs in pandas' compiled ewm rather than a Python loop.
+def seeded_ema(values, alpha, period):
+    result = np.full(len(values), np.nan)
+    if len(values) >= period:
+        seeded = np.array(values[period - 1:], dtype=float)
+        seeded[0] = values[:period].mean()
+        result[period - 1:] = pd.Series(seeded).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    return result
+
+
+def ema(values, period):
+    return seeded_ema(values=values, alpha=2 / (period + 1), period=period)
+
+
+def momentum(values, period):
+    result = np.full(values.shape, np.nan)
+    result[..., period:] = values[..., period:] - values[..., :-period]
+    return result
+
+
+# Wilder's RSI: gains and losses are averaged with alpha = 1 / period, seeded
+# with their simple average over the first period changes
+def rsi(values, period):
+    result = np.full(len(values), np.nan)
+    if len(values) > period:
+        changes = np.diff(values)
+        average_gain = seeded_ema(values=np.clip(changes, 0, None), alpha=1 / period, period=period)
+        average_loss = seeded_ema(values=np.clip(-changes, 0, None), alpha=1 / period, period=period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[1:] = np.where(average_loss == 0, 100.0, 100 - 100 / (1 + average_gain / average_loss))
+    return result
+
+
+# Population standard deviation of each window, as used for Bollinger bands
+def rolling_std(values, period):
+    result = np.full(values.shape, np.nan)
+    if values.shape[-1] >= period:
+        result[..., period - 1:] = sliding_window_view(values, period, axis=-1).std(axis=-1)
+    return result
+
+
+INDICATORS = {
+    'sma': sma,
+    'wma': wma,
+    'ema': ema,
+    'mom': momentum,
+    'rsi': rsi,
+    'std': rolling_std,
+}
+
+
+# PRE:  security_id is the id of a Security
+#       series_type is a key of SERIES_COLUMNS
+# POST: RV = (dates, values) arrays of the security's stored daily prices in
+#        date order, read with one query
+def load_price_series(security_id, series_type='close'):
+    rows = (db.session.query(SecurityDailyAdjusted.date, SERIES_COLUMNS[series_type])
+            .filter(SecurityDailyAdjusted.security_id == security_id)
+            .order_by(SecurityDailyAdjusted.date).all())
+    dates = np.array([row[0] for row in rows], dtype='datetime64[D]')
+    values = np.array([row[1] for row in rows], dtype=float)
+    return dates, values
+
+
+# PRE:  security_ids is a list of Security ids
+#       series_type is a key of SERIES_COLUMNS
+#       length is the number of latest prices kept per security, defaulting to
+#        the longest stored history
+# POST: RV = (dates, values), two len(security_ids) x length arrays where row i
+#        holds the latest stored prices of security_ids[i] and their dates, in
+#        date order and aligned to the right. Each row follows the security's
+#        own dates, so a security with missing days or an older last date is
+#        not padded with gaps; rows with fewer prices are NaN and NaT on the
+#        left. Read with one query.
+def load_price_matrix(security_ids, series_type='close', length=None):
+    rows = (db.session.query(SecurityDailyAdjusted.security_id, SecurityDailyAdjusted.date,
+                             SERIES_COLUMNS[series_type])
+            .filter(SecurityDailyAdjusted.security_id.in_(security_ids)).all())
+    positions = {security_id: index for index, security_id in enumerate(security_ids)}
+    security_index = np.array([positions[row[0]] for row in rows], dtype=np.int64)
+    row_dates = np.array([row[1] for row in rows], dtype='datetime64[D]')
+    row_values = np.array([row[2] for row in rows], dtype=float)
+    order = np.lexsort((row_dates, security_index))
+    security_index, row_dates, row_values = security_index[order], row_dates[order], row_values[order]
+    counts = np.bincount(security_index, minlength=len(security_ids))
+    if length is None:
+        length = int(counts.max()) if len(rows) else 0
+    # Position of each price counted from its security's latest, which goes in
+    # the last column
+    from_end = np.cumsum(counts)[security_index] - 1 - np.arange(len(rows))
+    keep = from_end < length
+    columns = length - 1 - from_end[keep]
+    dates = np.full((len(security_ids), length), np.datetime64('NaT'), dtype='datetime64[D]')
+    values = np.full((len(security_ids), length), np.nan)
+    dates[security_index[keep], columns] = row_dates[keep]
+    values[security_index[keep], columns] = row_values[keep]
+    return dates, values
+
+
+# PRE:  fast and slow are arrays of the same shape, in date order along the
+#        last axis
+# POST: RV = integer array of that shape holding 1 where fast crosses above slow
+#        (BUY), -1 where it crosses below (SELL), and 0 elsewhere. A crossing is
+#        a strict sign change of fast - slow between consecutive dates, marked
+#        on the later date; touching without crossing and NaN gaps are not
+#        crossings.
+def find_crossovers(fast, slow):
+    with np.errstate(invalid='ignore'):
+        signs = np.sign(fast - slow)
+    signals = np.zeros(signs.shape, dtype=np.int8)
+    crossed = signs[..., :-1] * signs[..., 1:] == -1
+    signals[..., 1:] = np.where(crossed, signs[..., 1:], 0)
+    return signals
+
+
+# PRE:  fast and slow are securities x dates arrays in date order
+#       dates is the array of the same shape holding the date of each value, as
+#        returned by load_price_matrix
+# POST: RV = list of (row, date string, 'BUY' or 'SELL') for every crossing of
+#        every security, found in one pass over the whole matrix, ordered by
+#        row and then date
+def get_crossover_signals(fast, slow, dates):
+    signals = find_crossovers(fast=fast, slow=slow)
+    rows, columns = np.nonzero(signals)
+    return [(int(row), str(dates[row, column]), 'BUY' if signals[row, column] > 0 else 'SELL')
+            for row, column in zip(rows, columns)]
+
+
+# PRE:  dates and values are arrays in date order
+#       num_points is the number of latest points to keep
+# POST: RV is a pandas DataFrame in the shape returned by get_wma_data: column i
+#        holds (date string, value) of the i-th latest point, newest first, so
+#        row 0 holds the dates and row 1 the values. NaN points are dropped.
+def to_indicator_frame(dates, values, num_points):
+    keep = ~np.isnan(values)
+    dates = dates[keep][::-1][:num_points]
+    values = values[keep][::-1][:num_points]
+    return pd.DataFrame({index: (str(day), float(value)) for index, (day, value) in enumerate(zip(dates, values))})
+
+
+# PRE:  symbol is the symbol of a Security
+#       indicator is a key of INDICATORS, or None for the prices themselves
+#       num_points is a positive integer representing the # of data points
+#       period is a positive integer representing the # of intervals the
+#        indicator covers
+#       series_type is a key of SERIES_COLUMNS
+# POST: RV is a pandas DataFrame as returned by to_indicator_frame computed from
+#        the security's stored prices, or None when the stored history is too
+#        short to give num_points points or stops before the last trading day,
+#        so callers fall back to the API rather than chart stale prices
+def get_local_indicator_data(symbol, indicator, num_points=100, period=20, series_type='close'):
+    security_id = db.session.query(Security.id).filter(Security.symbol == symbol).scalar()
+    if security_id is None:
+        return None
+    dates, values = load_price_series(security_id=security_id, series_type=series_type)
+    if len(values) < num_points + (period if indicator is not None else 0):
+        return None
+    if dates[-1] < np.datetime64(get_last_trading_day(), 'D'):
+        return None
+    if indicator is not None:
+        values = INDICATORS[indicator](values, period)
+    return to_indicator_frame(dates=dates, values=values, num_points=num_points)
@@ -0,0 +1,304 @@
+from app import db
+from app.models import Security, SecurityDailyAdjusted, Benchmark, BenchmarkDailyAdjusted
+from flask import current_app
+from aiohttp import web
+from datetime import date, timedelta
+from sqlalchemy import func, inspect
+import numpy as np
+import aiohttp
+import asyncio
+import random
+import time
+
+# Field name -> (Alpha Vantage key, parser) for a TIME_SERIES_DAILY_ADJUSTED bar
+DAILY_ADJUSTED_FIELDS = {
+    'open': ('1. open', float),
+    'high': ('2. high', float),
+    'low': ('3. low', float),
+    'close': ('4. close', float),
+    'adjusted_close': ('5. adjusted close', float),
+    'volume': ('6. volume', int),
+    'dividend_amount': ('7. dividend amount', float),
+    'split_coefficient': ('8. split coefficient', float),
+}
+DAILY_ADJUSTED_SERIES = 'Time Series (Daily)'
+# A compact series holds the last 100 trading days. A gap longer than this since
+# the last stored date needs the full series; the margin covers market holidays,
+# which the weekday count below does not skip.
+COMPACT_TRADING_DAYS = 100
+COMPACT_GAP_MARGIN = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Price target kind -> (model, parent model, foreign key) the series is stored with
+PRICE_TARGETS = {
+    'security': (SecurityDailyAdjusted, Security, 'security_id'),
+    'benchmark': (BenchmarkDailyAdjusted, Benchmark, 'benchmark_id'),
+}
+
+
+class RetryableError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    # PRE:  rate is the number of tokens added per second
+    #       capacity is the largest number of tokens that can be saved up, which
+    #        is the largest burst of requests allowed at once
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    # POST: A token has been taken, after waiting for one to be added if the
+    #        bucket was empty. Waiters are served in order.
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# PRE:  series is a dictionary {iso date: bar} of daily adjusted bars as
+#        returned by TimeSeries.get_daily_adjusted
+# POST: RV = list of dictionaries keyed by 'date' and the DAILY_ADJUSTED_FIELDS
+#        names, in date order
+def parse_daily_adjusted_series(series):
+    rows = []
+    for key, bar in series.items():
+        row = {name: parse(bar[field]) for name, (field, parse) in DAILY_ADJUSTED_FIELDS.items()}
+        row['date'] = date.fromisoformat(key)
+        rows.append(row)
+    rows.sort(key=lambda row: row['date'])
+    return rows
+
+
+# PRE:  payload is the decoded JSON body of a TIME_SERIES_DAILY_ADJUSTED call
+# POST: RV = the rows of the series as returned by parse_daily_adjusted_series.
+#        A rate limit notice raises RetryableError and an error message raises
+#        ValueError.
+def parse_daily_adjusted(payload):
+    if 'Note' in payload or 'Information' in payload:
+        raise RetryableError(payload.get('Note') or payload.get('Information'))
+    if DAILY_ADJUSTED_SERIES not in payload:
+        raise ValueError(payload.get('Error Message') or 'response has no daily series')
+    return parse_daily_adjusted_series(series=payload[DAILY_ADJUSTED_SERIES])
+
+
+# PRE:  last_date is the latest stored date of a series or None
+# POST: RV = 'compact' when the weekdays since last_date fit in a compact
+#        series, otherwise 'full'
+def get_outputsize(last_date, today=None):
+    if last_date is None:
+        return 'full'
+    gap = np.busday_count(last_date, today or date.today())
+    return 'compact' if gap < COMPACT_TRADING_DAYS - COMPACT_GAP_MARGIN else 'full'
+
+
+# PRE:  session is an open aiohttp ClientSession
+#       url and params describe the Alpha Vantage request
+#       bucket is the TokenBucket every request of the refresh shares
+#       retries is the number of times a failed request is repeated
+#       backoff is the delay in seconds before the first retry, doubled for
+#        each retry after it and jittered so waiting requests spread out
+# POST: RV = the parsed rows of the response. Rate limit notices, throttling
+#        and server errors, timeouts and dropped connections are retried; other
+#        failures, or running out of retries, raise.
+async def fetch_daily_adjusted(session, url, params, bucket, retries, backoff):
+    for attempt in range(retries + 1):
+        await bucket.acquire()
+        try:
+            async with session.get(url, params=params) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableError('HTTP {}'.format(response.status))
+                response.raise_for_status()
+                payload = await response.json(content_type=None)
+            return parse_daily_adjusted(payload=payload)
+        except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+
+
+# POST: RV = dictionary {(kind, id): latest stored date} over every security and
+#        benchmark with stored prices, read with one grouped query per kind
+def get_last_price_dates():
+    last_dates = {}
+    for kind, (model, parent, foreign_key) in PRICE_TARGETS.items():
+        column = getattr(model, foreign_key)
+        for parent_id, last_date in db.session.query(column, func.max(model.date)).group_by(column):
+            last_dates[(kind, parent_id)] = last_date
+    return last_dates
+
+
+# PRE:  kind is a key of PRICE_TARGETS and parent_id the id of a row of its parent
+#       rows is a list of parsed rows as returned by parse_daily_adjusted_series
+# POST: The rows whose date is not yet stored for the parent have been written
+#        with one bulk insert. The stored dates are read with one query over the
+#        range the rows cover, so a refresh that overlaps stored history, or
+#        fills a gap inside it, only adds the missing dates.
+#       RV = # of rows written
+def upsert_price_rows(kind, parent_id, symbol, rows):
+    if not rows:
+        return 0
+    model, parent, foreign_key = PRICE_TARGETS[kind]
+    stored = set(day for day, in db.session.query(model.date)
+                 .filter(getattr(model, foreign_key) == parent_id,
+                         model.date.between(rows[0]['date'], rows[-1]['date'])))
+    new_rows = [dict(row, symbol=symbol, **{foreign_key: parent_id}) for row in rows if row['date'] not in stored]
+    db.session.bulk_insert_mappings(model, new_rows)
+    return len(new_rows)
+
+
+# PRE:  targets is a list of (kind, id) pairs sharing symbol
+#       rows is a list of parsed rows as returned by parse_daily_adjusted
+# POST: The new rows of each target have been written by upsert_price_rows and
+#        committed
+#       RV = # of rows written
+def store_price_rows(symbol, targets, rows):
+    count = 0
+    for kind, parent_id in targets:
+        count += upsert_price_rows(kind=kind, parent_id=parent_id, symbol=symbol, rows=rows)
+        if kind == 'benchmark':
+            db.session.query(Benchmark).filter(Benchmark.id == parent_id).update({'last_updated': date.today()})
+    db.session.commit()
+    return count
+
+
+# PRE:  symbols is a dictionary {symbol: [(kind, id)]} of the targets to refresh
+#       The remaining arguments are as described by refresh_market_data
+# POST: Each symbol has been fetched once, at most concurrency at a time and no
+#        faster than the token bucket allows, and its rows stored as each fetch
+#        completes. A symbol whose fetch or store fails is listed in 'failed'.
+#       RV = {'symbols', 'refreshed', 'rows', 'failed': [(symbol, error)]}
+async def refresh_symbols(symbols, url, api_key, requests_per_minute, burst, concurrency, outputsize, retries,
+                          backoff):
+    bucket = TokenBucket(rate=requests_per_minute / 60, capacity=burst)
+    semaphore = asyncio.Semaphore(concurrency)
+    last_dates = get_last_price_dates()
+    summary = {'symbols': len(symbols), 'refreshed': 0, 'rows': 0, 'failed': []}
+
+    async def refresh(session, symbol, targets):
+        # A symbol shared by a security and a benchmark is sized by the target
+        # with the longest gap
+        last_date = min((last_dates.get(target) for target in targets), key=lambda day: day or date.min)
+        params = {'function': 'TIME_SERIES_DAILY_ADJUSTED', 'symbol': symbol,
+                  'outputsize': outputsize or get_outputsize(last_date=last_date), 'apikey': api_key}
+        async with semaphore:
+            try:
+                rows = await fetch_daily_adjusted(session=session, url=url, params=params, bucket=bucket,
+                                                  retries=retries, backoff=backoff)
+            except Exception as error:
+                summary['failed'].append((symbol, '{}: {}'.format(type(error).__name__, error)))
+                return
+        # Writes run on the event loop thread, one short transaction per symbol,
+        # so the session is never shared across threads. A symbol that cannot
+        # be stored is rolled back and reported without stopping the others.
+        try:
+            summary['rows'] += store_price_rows(symbol=symbol, targets=targets, rows=rows)
+        except Exception as error:
+            db.session.rollback()
+            summary['failed'].append((symbol, '{}: {}'.format(type(error).__name__, error)))
+            return
+        summary['refreshed'] += 1
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        await asyncio.gather(*(refresh(session, symbol, targets) for symbol, targets in symbols.items()))
+    return summary
+
+
+# PRE:  requests_per_minute is the request rate of the API tier, defaulting to
+#        ALPHAVANTAGE_REQUESTS_PER_MINUTE
+#       burst is the number of requests that may be sent at once
+#       concurrency is the number of requests in flight at once
+#       outputsize is 'compact' for the last 100 days, 'full' for all history, or
+#        None to choose per symbol from the gap since its last stored date
+#       retries and backoff are passed to fetch_daily_adjusted
+#       url is the query endpoint, defaulting to ALPHAVANTAGE_URL, so the
+#        refresh can run against a local stub server
+# POST: The daily adjusted series of every Security and Benchmark has been
+#        fetched concurrently and the new dates stored
+#       RV = {'symbols', 'refreshed', 'rows', 'failed': [(symbol, error)],
+#             'seconds', 'symbols_per_minute'}
+def refresh_market_data(requests_per_minute=None, burst=1, concurrency=8, outputsize=None, retries=4,
+                        backoff=2.0, url=None):
+    config = current_app.config
+    symbols = {}
+    for kind, (model, parent, foreign_key) in PRICE_TARGETS.items():
+        for parent_id, symbol in db.session.query(parent.id, parent.symbol).order_by(parent.symbol):
+            symbols.setdefault(symbol, []).append((kind, parent_id))
+    start = time.perf_counter()
+    summary = asyncio.run(refresh_symbols(symbols=symbols, url=url or config['ALPHAVANTAGE_URL'],
+                                          api_key=config['ALPHAVANTAGE_API_KEY'] or 'demo',
+                                          requests_per_minute=requests_per_minute or
+                                          config['ALPHAVANTAGE_REQUESTS_PER_MINUTE'],
+                                          burst=burst, concurrency=concurrency, outputsize=outputsize,
+                                          retries=retries, backoff=backoff))
+    summary['seconds'] = time.perf_counter() - start
+    summary['symbols_per_minute'] = summary['refreshed'] * 60 / summary['seconds'] if summary['seconds'] else 0
+    return summary
+
+
+# PRE:  days is the number of trading days in each generated series
+#       notice_rate is the share of requests answered with a rate limit notice
+#       delay is the number of seconds each response is held back
+# POST: RV = an aiohttp application answering TIME_SERIES_DAILY_ADJUSTED
+#        queries at /query with a synthetic series for any symbol, for running
+#        the refresher without calling Alpha Vantage
+def create_stub_server(days=100, notice_rate=0.0, delay=0.0):
+    async def query(request):
+        await asyncio.sleep(delay)
+        symbol = request.query.get('symbol', '')
+        if random.random() < notice_rate:
+            return web.json_response({'Note': 'Thank you for using Alpha Vantage! Our standard API call '
+                                              'frequency is 5 calls per minute.'})
+        if not symbol:
+            return web.json_response({'Error Message': 'Invalid API call.'})
+        count = days if request.query.get('outputsize') == 'compact' else days * 10
+        generator = random.Random(symbol)
+        price = generator.uniform(10, 500)
+        series = {}
+        day = date.today()
+        while len(series) < count:
+            day -= timedelta(days=1)
+            if day.weekday() >= 5:
+                continue
+            price = max(price * generator.uniform(0.97, 1.03), 1)
+            series[day.isoformat()] = {'1. open': '{:.4f}'.format(price), '2. high': '{:.4f}'.format(price * 1.01),
+                                       '3. low': '{:.4f}'.format(price * 0.99), '4. close': '{:.4f}'.format(price),
+                                       '5. adjusted close': '{:.4f}'.format(price),
+                                       '6. volume': str(generator.randint(10000, 1000000)),
+                                       '7. dividend amount': '0.0000', '8. split coefficient': '1.0'}
+        return web.json_response({'Meta Data': {'2. Symbol': symbol}, DAILY_ADJUSTED_SERIES: series})
+
+    app = web.Application()
+    app.router.add_get('/query', query)
+    return app
+
+
+# POST: Repeated (parent, date) rows left in the daily adjusted tables by
+#        refreshes made before the unique keys existed have been deleted,
+#        keeping the first row stored for each date, and the unique key has
+#        been added to tables created without it
+#       RV = dictionary {table name: # of rows deleted}
+def remove_duplicate_price_rows():
+    deleted = {}
+    inspector = inspect(db.engine)
+    for kind, (model, parent, foreign_key) in PRICE_TARGETS.items():
+        column = getattr(model, foreign_key)
+        keep = db.session.query(func.min(model.id)).group_by(column, model.date)
+        deleted[model.__tablename__] = (db.session.query(model).filter(model.id.not_in(keep.scalar_subquery()))
+                                        .delete(synchronize_session=False))
+        db.session.commit()
+        columns = [foreign_key, 'date']
+        keys = inspector.get_unique_constraints(model.__tablename__) + \
+            [index for index in inspector.get_indexes(model.__tablename__) if index['unique']]
+        if not any(key['column_names'] == columns for key in keys):
+            constraint, = [arg for arg in model.__table_args__ if isinstance(arg, db.UniqueConstraint)]
+            db.Index(constraint.name, *[model.__table__.c[name] for name in columns], unique=True).create(db.engine)
+    return deleted
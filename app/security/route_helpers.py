@@ -2,6 +2,12 @@ from app import db
 from app.models import (Security, SecurityDailyAdjusted)
 from alpha_vantage.techindicators import TechIndicators
 from alpha_vantage.timeseries import TimeSeries
+from app.alpha_vantage_cache import call_alpha_vantage, get_last_trading_day
+from app.security.market_data import get_outputsize, parse_daily_adjusted_series, upsert_price_rows
+from app.security.indicators import (get_local_indicator_data, load_price_matrix, wma, find_crossovers,
+                                     get_crossover_signals)
+from sqlalchemy import func
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 import os
@@ -28,11 +34,14 @@ def legend_title_generator(title):
 
 # Pre:  symbol is a string representing a security
 # Post: RV is a pandas dataFrame object containing adjusted close price data
-#        for the last 100 days
+#        for the last 100 days, read from the stored prices when there are
+#        enough of them
 def get_daily_price_data(symbol):
-    ts = TimeSeries(key=os.environ['ALPHAVANTAGE_API_KEY'])
-    data, meta_data = ts.get_daily_adjusted(symbol=symbol,
-                                            outputsize='compact')
+    df = get_local_indicator_data(symbol=symbol, indicator=None, num_points=100, series_type='adjusted_close')
+    if df is not None:
+        return df
+    data, meta_data = call_alpha_vantage(TimeSeries, 'get_daily_adjusted', symbol=symbol,
+                                         outputsize='compact')
     date_price_pair = [(key, data[key]['5. adjusted close']) for key
                        in data.keys()]
     num_points = len(date_price_pair)
@@ -74,11 +83,17 @@ def get_daily_adjusted_price_data_by_type(price_data, price_type):
 #        average calculation
 # Post: RV is a pandas DataFrame object containing WMA data for the security
 #        generated using the period, interval, and series type provided.
+#        Daily WMAs are computed locally from the stored prices when they cover
+#        num_points points; otherwise Alpha Vantage computes them.
 def get_wma_data(symbol, num_points=100, period=20, interval='daily',
                  series_type='close'):
-    ti = TechIndicators(key=os.environ['ALPHAVANTAGE_API_KEY'])
-    data, meta_data = ti.get_wma(symbol=symbol, interval=interval,
-                                 time_period=period, series_type=series_type)
+    if interval == 'daily':
+        df = get_local_indicator_data(symbol=symbol, indicator='wma', num_points=num_points, period=period,
+                                      series_type=series_type)
+        if df is not None:
+            return df
+    data, meta_data = call_alpha_vantage(TechIndicators, 'get_wma', symbol=symbol, interval=interval,
+                                         time_period=period, series_type=series_type)
     date_value_pairs = [(key, float(data[key]['WMA'])) for key in data.keys()]
     if len(date_value_pairs) < num_points:
         num_points = len(date_value_pairs)
@@ -86,46 +101,33 @@ def get_wma_data(symbol, num_points=100, period=20, interval='daily',
     return pd.DataFrame(data_points)
 
 
+# Pre:  df_0 and df_1 are pandas DataFrames as returned by get_wma_data
+# Post: RV = (dates, values_0, values_1) arrays over the dates both frames
+#        cover, in date order, whichever order the frames list them in
+def get_aligned_series(df_0, df_1):
+    series = pd.concat([pd.Series(df_0.loc[1].to_numpy(dtype=float), index=df_0.loc[0].to_numpy()),
+                        pd.Series(df_1.loc[1].to_numpy(dtype=float), index=df_1.loc[0].to_numpy())],
+                       axis=1, join='inner').sort_index()
+    return series.index.to_numpy(), series[0].to_numpy(), series[1].to_numpy()
+
+
+# Pre:  df_0 and df_1 are pandas DataFrames as returned by get_wma_data
+# Post: RV is a list of 2-tuples (signal, date) in date order where signal is
+#        'BUY' on the first date df_0 is above df_1 after being below it, and
+#        'SELL' on the first date it is below after being above
 def get_crossover_trades(df_0, df_1):
-    crossover_points = []
-    data = {'0': df_0.loc[0], '1': df_0.loc[1], '2': df_1.loc[1]}
-    df_2 = pd.DataFrame(data)
-    prev_val_0 = df_2.loc[0][1]
-    prev_val_1 = df_2.loc[0][2]
-    for index in df_2.index:
-        curr_val_0 = df_2.loc[index][1]
-        curr_val_1 = df_2.loc[index][2]
-        if prev_val_0 < prev_val_1 and curr_val_0 > curr_val_1:
-            crossover_points.append(('BUY', df_2.loc[index][0]))
-        elif prev_val_0 > prev_val_1 and curr_val_0 < curr_val_1:
-            crossover_points.append(('SELL', df_2.loc[index][0]))
-        prev_val_0 = curr_val_0
-        prev_val_1 = curr_val_1
-    return crossover_points
-
-
-# Pre:  values is a list of 3-tuples (val_1, val_2, date) where val_1 and
-#        val_2 are floats and date is a string
-# Post: RV is a list of 2-tuples (val_1, date) such that the previous val_1
-#        was greater than or equal to val_2 and is now lesser or val_1 was
-#        lesser than or equal to val_2 and is now greater
+    dates, values_0, values_1 = get_aligned_series(df_0=df_0, df_1=df_1)
+    signals = find_crossovers(fast=values_0, slow=values_1)
+    return [('BUY' if signals[index] > 0 else 'SELL', dates[index]) for index in np.nonzero(signals)[0]]
+
+
+# Pre:  df_0 and df_1 are pandas DataFrames as returned by get_wma_data
+# Post: RV = x_vals, y_vals where x_vals holds the dates on which df_0 crosses
+#        df_1, in date order, and y_vals the value of df_0 on each
 def get_crossover_points(df_0, df_1):
-    x_vals = []
-    y_vals = []
-    data = {'0': df_0.loc[0], '1': df_0.loc[1], '2': df_1.loc[1]}
-    df_2 = pd.DataFrame(data)
-    prev_val_0 = df_2.loc[0][1]
-    prev_val_1 = df_2.loc[0][2]
-    for index in df_2.index:
-        curr_val_0 = df_2.loc[index][1]
-        curr_val_1 = df_2.loc[index][2]
-        if ((prev_val_0 < prev_val_1 and curr_val_0 > curr_val_1) or
-                (prev_val_0 > prev_val_1 and curr_val_0 < curr_val_1)):
-            x_vals.append(df_2.loc[index][0])
-            y_vals.append(curr_val_0)
-        prev_val_0 = curr_val_0
-        prev_val_1 = curr_val_1
-    return x_vals, y_vals
+    dates, values_0, values_1 = get_aligned_series(df_0=df_0, df_1=df_1)
+    crossings = np.nonzero(find_crossovers(fast=values_0, slow=values_1))[0]
+    return list(dates[crossings]), list(values_0[crossings])
 
 
 def generate_daily_close_wma_crossover_chart(symbol, num_points=100, period_0=20, period_1=100,
@@ -173,16 +175,49 @@ def generate_daily_close_wma_crossover_chart(symbol, num_points=100, period_0=20
     return file_path
 
 
-def process_daily_close_wma_crossover_data(securities, period_0, period_1):
+# Pre:  securities is an iterable of Security objects
+#       period_0 and period_1 are the periods of the two daily close WMAs
+# Post: RV is a list of (symbol, (signal, date)) for every WMA crossover in the
+#        last num_points trading days of each security. Securities whose stored
+#        history is long enough and up to the last trading day are loaded as one
+#        matrix holding each security's own latest prices, and their WMAs and
+#        crossings computed for all of them at once; the rest are fetched and
+#        compared one at a time.
+def process_daily_close_wma_crossover_data(securities, period_0, period_1, num_points=100):
+    securities = list(securities)
     crossovers = []
-    for security in securities:
+    remote = []
+    local = []
+    # Prices needed for num_points values of the longer WMA
+    length = num_points + max(period_0, period_1) - 1
+    if securities:
+        histories = {security_id: (count, last_date) for security_id, count, last_date in
+                     db.session.query(SecurityDailyAdjusted.security_id, func.count(),
+                                      func.max(SecurityDailyAdjusted.date))
+                     .filter(SecurityDailyAdjusted.security_id.in_([security.id for security in securities]))
+                     .group_by(SecurityDailyAdjusted.security_id)}
+        last_trading_day = get_last_trading_day()
+        for security in securities:
+            count, last_date = histories.get(security.id, (0, None))
+            if count > length and last_date >= last_trading_day:
+                local.append(security)
+            else:
+                remote.append(security)
+    if local:
+        dates, prices = load_price_matrix(security_ids=[security.id for security in local], series_type='close',
+                                          length=length)
+        wma_0 = wma(prices, period_0)[:, -num_points:]
+        wma_1 = wma(prices, period_1)[:, -num_points:]
+        for row, day, signal in get_crossover_signals(fast=wma_0, slow=wma_1, dates=dates[:, -num_points:]):
+            crossovers.append((local[row].symbol, (signal, day)))
+    for security in remote:
         df_0 = get_wma_data(symbol=security.symbol,
-                            num_points=100,
+                            num_points=num_points,
                             period=period_0,
                             interval='daily',
                             series_type='close')
         df_1 = get_wma_data(symbol=security.symbol,
-                            num_points=100,
+                            num_points=num_points,
                             period=period_1,
                             interval='daily',
                             series_type='close')
@@ -192,21 +227,18 @@ def process_daily_close_wma_crossover_data(securities, period_0, period_1):
     return crossovers
 
 
+# Pre:  security_id is the id of a Security
+# Post: The security's daily adjusted series has been fetched, compact or full
+#        depending on the gap since its last stored date, and only the dates
+#        not yet stored have been inserted
+#       RV = # of rows inserted
 def store_daily_adjusted_price_data(security_id):
     security = Security.query.get(int(security_id))
-    ts = TimeSeries(key=os.environ['ALPHAVANTAGE_API_KEY'])
-    data, meta_data = ts.get_daily_adjusted(symbol=security.symbol,
-                                            outputsize='compact')
-    snapshots = [SecurityDailyAdjusted(symbol=security.symbol,
-                                       date=date.fromisoformat(key),
-                                       open=float(data[key]['1. open']),
-                                       close=float(data[key]['4. close']),
-                                       adjusted_close=float(data[key]['5. adjusted close']),
-                                       high=float(data[key]['2. high']),
-                                       low=float(data[key]['3. low']),
-                                       volume=int(data[key]['6. volume']),
-                                       dividend_amount=float(data[key]['7. dividend amount']),
-                                       split_coefficient=float(data[key]['8. split coefficient']),
-                                       security_id=security.id) for key in data.keys()]
-    db.session.add_all(instances=snapshots)
+    last_date = db.session.query(func.max(SecurityDailyAdjusted.date)) \
+        .filter(SecurityDailyAdjusted.security_id == security.id).scalar()
+    data, meta_data = call_alpha_vantage(TimeSeries, 'get_daily_adjusted', symbol=security.symbol,
+                                         outputsize=get_outputsize(last_date=last_date))
+    count = upsert_price_rows(kind='security', parent_id=security.id, symbol=security.symbol,
+                              rows=parse_daily_adjusted_series(series=data))
     db.session.commit()
+    return count
@@ -17,6 +17,8 @@ import os
 from werkzeug.utils import secure_filename
 from alpha_vantage.timeseries import TimeSeries
 from alpha_vantage.techindicators import TechIndicators
+from app.alpha_vantage_cache import call_alpha_vantage
+from app.security.indicators import get_local_indicator_data
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
@@ -80,9 +82,8 @@ def upload_securities():
 def update_security_data(security_id):
     security = Security.query.get(int(security_id))
     if security.last_snapshot != date.today() or True:
-        ts = TimeSeries(key=os.environ['ALPHAVANTAGE_API_KEY'])
-        data, meta_data = ts.get_daily(symbol=security.symbol,
-                                       outputsize='compact')
+        data, meta_data = call_alpha_vantage(TimeSeries, 'get_daily', symbol=security.symbol,
+                                             outputsize='compact')
         df = pd.DataFrame(data)
         rows = df.index
         date_key = df.columns[0]
@@ -206,13 +207,15 @@ def view_security_momentum(security_id):
     security = Security.query.get(int(security_id))
     file_name = os.path.join('technical_indicators/momentum/' +
                              "{}_momentum.png".format(security.symbol))
-    ti = TechIndicators(key=os.environ['ALPHAVANTAGE_API_KEY'])
-    data, meta_data = ti.get_mom(symbol=security.symbol, interval='daily',
-                                 time_period=20, series_type='close')
-    dates = [key for key in data.keys()]
-    values = [float(data[key]['MOM']) for key in data.keys()]
-    point_pairs = dict([(i, (dates[i], values[i])) for i in range(100)])
-    df = pd.DataFrame(point_pairs)
+    df = get_local_indicator_data(symbol=security.symbol, indicator='mom', num_points=100, period=20,
+                                  series_type='close')
+    if df is None:
+        data, meta_data = call_alpha_vantage(TechIndicators, 'get_mom', symbol=security.symbol, interval='daily',
+                                             time_period=20, series_type='close')
+        dates = [key for key in data.keys()]
+        values = [float(data[key]['MOM']) for key in data.keys()]
+        point_pairs = dict([(i, (dates[i], values[i])) for i in range(100)])
+        df = pd.DataFrame(point_pairs)
     fig = px.line(x=df.loc[0], y=df.loc[1])
     fig.add_trace()
     fig.write_image(file_name)
@@ -19,6 +19,13 @@ class TransactionForm(FlaskForm):
 
 class UploadFileForm(FlaskForm):
     upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['csv'], '.csv only')])
+    dry_run = BooleanField('Validate only')
+    submit = SubmitField('Upload')
+
+
+class UploadXMLFileForm(FlaskForm):
+    upload_file = FileField('File', validators=[FileRequired(), FileAllowed(['xml'], '.xml only')])
+    dry_run = BooleanField('Validate only')
     submit = SubmitField('Upload')
 
 
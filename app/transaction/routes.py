@@ -1,11 +1,11 @@
 from flask import render_template, flash, redirect, url_for
-from flask_login import login_required
+from flask_login import login_required, current_user
 from app import db
 from app.models import (Account, Security, Position, Transaction)
-from app.transaction.forms import (TransactionForm, UploadFileForm, ExportToFileForm)
+from app.transaction.forms import (TransactionForm, UploadFileForm, UploadXMLFileForm, ExportToFileForm)
 from app.transaction import bp
-from app.route_helpers import (get_security_choices,
-                               process_transaction_csv_file)
+from app.route_helpers import get_security_choices
+from app.jobs import submit_import_job
 from datetime import date
 import os
 from werkzeug.utils import secure_filename
@@ -107,11 +107,25 @@ def edit_transaction(transaction_id):
 def upload_transactions():
     form = UploadFileForm()
     if form.validate_on_submit():
-        process_transaction_csv_file(file_object=form.upload_file.data)
-        return redirect(url_for('transaction.view_transactions'))
+        job = submit_import_job(kind='transactions', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
     return render_template('upload_transaction_file.html', title='Upload Transaction File', form=form)
 
 
+@bp.route('/upload_custodian_xml', methods=['GET', 'POST'])
+@login_required
+def upload_custodian_xml():
+    form = UploadXMLFileForm()
+    if form.validate_on_submit():
+        job = submit_import_job(kind='custodian_xml', file_objects=[form.upload_file.data], user_id=current_user.id,
+                                dry_run=form.dry_run.data)
+        flash('Upload queued as import job {}'.format(job.id))
+        return redirect(url_for('main.view_import_job', job_id=job.id))
+    return render_template('upload_custodian_xml.html', title='Upload Custodian XML', form=form)
+
+
 @bp.route('/export_transactions', methods=['GET', 'POST'])
 @login_required
 def export_transactions():
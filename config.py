@@ -11,5 +11,17 @@ class Config(object):
 
     UPLOADS_DEFAULT_DEST = '/uploads'
     UPLOADED_FILES_DEST = '/uploads/files'
+    IMPORT_JOB_FOLDER = os.environ.get('IMPORT_JOB_FOLDER') or 'uploads/jobs'
+    IMPORT_JOB_WORKERS = int(os.environ.get('IMPORT_JOB_WORKERS') or 1)
+    RECOVER_IMPORT_JOBS = True
+    CHUNKED_UPLOAD_FOLDER = os.environ.get('CHUNKED_UPLOAD_FOLDER') or 'uploads/chunks'
+    CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    FEE_FILE_FOLDER = os.environ.get('FEE_FILE_FOLDER') or os.path.join(basedir, 'exports')
 
     ALPHAVANTAGE_API_KEY = os.environ.get('ALPHAVANTAGE_API_KEY')
+    ALPHAVANTAGE_URL = os.environ.get('ALPHAVANTAGE_URL') or 'https://www.alphavantage.co/query'
+    ALPHAVANTAGE_REQUESTS_PER_MINUTE = int(os.environ.get('ALPHAVANTAGE_REQUESTS_PER_MINUTE') or 5)
+    ALPHAVANTAGE_CACHE_PATH = os.environ.get('ALPHAVANTAGE_CACHE_PATH') or \
+        os.path.join(basedir, 'alpha_vantage_cache.db')
+    ALPHAVANTAGE_CACHE_MAX_BYTES = int(os.environ.get('ALPHAVANTAGE_CACHE_MAX_BYTES') or 256 * 1024 * 1024)
+    ALPHAVANTAGE_CACHE_STALE_SECONDS = int(os.environ.get('ALPHAVANTAGE_CACHE_STALE_SECONDS') or 7 * 24 * 60 * 60)
@@ -0,0 +1,82 @@
+from app import db
+from app.models import Quarter, Group, Account, AccountSnapshot, GroupSnapshot, FeeSchedule
+from app.billing.route_helpers import generate_group_snapshots_by_row, generate_group_snapshots_set_based
+from datetime import date
+import pytest
+
+
+# POST: A quarter has been seeded with account snapshots across three groups,
+#        one of which already has a GroupSnapshot, plus snapshots with no account
+#        and an account with no group, none linked to a group snapshot yet.
+#       RV = id of the quarter
+def seed_quarter(existing_market_value=1000.0):
+    schedule = FeeSchedule(name='Standard')
+    quarter = Quarter(name='2022Q3', from_date=date(2022, 7, 1), to_date=date(2022, 9, 30), aum=0, fee=0)
+    db.session.add_all([schedule, quarter])
+    db.session.flush()
+    groups = [Group(name='Group{}'.format(index), fee_schedule_id=schedule.id) for index in range(3)]
+    db.session.add_all(groups)
+    db.session.flush()
+    db.session.add(GroupSnapshot(date=date(2022, 10, 1), name='Group0 - 2022Q3', group_name='Group0',
+                                 quarter_name=quarter.name, market_value=existing_market_value, fee=0,
+                                 fee_schedule_id=schedule.id, group_id=groups[0].id, quarter_id=quarter.id))
+    accounts = [Account(account_number='A{}'.format(index), group_id=groups[index % 3].id, billable=True)
+                for index in range(12)]
+    accounts.append(Account(account_number='UNGROUPED', billable=True))
+    db.session.add_all(accounts)
+    db.session.flush()
+    for index, account in enumerate(accounts):
+        db.session.add(AccountSnapshot(name='{} - 2022Q3'.format(account.account_number),
+                                       account_number=account.account_number, account_id=account.id,
+                                       market_value=1000.25 * (index + 1), quarter_id=quarter.id,
+                                       quarter_name=quarter.name, custodian='Custodian'))
+    db.session.add(AccountSnapshot(name='UNKNOWN - 2022Q3', account_number='UNKNOWN', market_value=50.0,
+                                   quarter_id=quarter.id, quarter_name=quarter.name))
+    db.session.commit()
+    return quarter.id
+
+
+# POST: RV = ({group_name: market_value}, {account_number: group_name or None})
+#        describing the quarter's group snapshots and account snapshot links
+def get_snapshot_state(quarter_id):
+    market_values = {name: market_value for name, market_value in
+                     db.session.query(GroupSnapshot.group_name, GroupSnapshot.market_value)
+                     .filter(GroupSnapshot.quarter_id == quarter_id)}
+    links = {}
+    for account_snapshot in AccountSnapshot.query.filter_by(quarter_id=quarter_id):
+        group_snapshot = GroupSnapshot.query.get(account_snapshot.group_snapshot_id) \
+            if account_snapshot.group_snapshot_id is not None else None
+        links[account_snapshot.account_number] = group_snapshot.group_name if group_snapshot else None
+    return market_values, links
+
+
+def reset_database():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def test_set_based_matches_row_by_row(app):
+    quarter_id = seed_quarter()
+    generate_group_snapshots_by_row(quarter_id=quarter_id)
+    by_row_values, by_row_links = get_snapshot_state(quarter_id=quarter_id)
+
+    reset_database()
+    quarter_id = seed_quarter()
+    linked = generate_group_snapshots_set_based(quarter_id=quarter_id)
+    set_based_values, set_based_links = get_snapshot_state(quarter_id=quarter_id)
+
+    assert linked == 12
+    assert set_based_links == by_row_links
+    assert set(set_based_values) == set(by_row_values) == {'Group0', 'Group1', 'Group2'}
+    for name in by_row_values:
+        assert set_based_values[name] == pytest.approx(by_row_values[name])
+    assert by_row_links['UNGROUPED'] is None and by_row_links['UNKNOWN'] is None
+
+
+def test_set_based_adds_to_null_market_value(app):
+    quarter_id = seed_quarter(existing_market_value=None)
+    generate_group_snapshots_set_based(quarter_id=quarter_id)
+    market_values, links = get_snapshot_state(quarter_id=quarter_id)
+    assert market_values['Group0'] == pytest.approx(sum(1000.25 * (index + 1) for index in range(0, 12, 3)))
+    assert links['A0'] == 'Group0'
@@ -0,0 +1,63 @@
+from app import db
+from app.models import Security, SecurityDailyAdjusted
+from app.security import market_data
+from app.security.market_data import create_stub_server, refresh_market_data
+from aiohttp import web
+from sqlalchemy.exc import IntegrityError
+from threading import Thread
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def stub_url():
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_stub_server(days=30))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+    host, port = runner.addresses[0][:2]
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield 'http://{}:{}/query'.format(host, port)
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def refresh(url):
+    return refresh_market_data(requests_per_minute=60000, burst=10, concurrency=4, retries=1, backoff=0.01, url=url)
+
+
+def test_refresh_stores_every_symbol(app, stub_url):
+    db.session.add_all([Security(symbol='S{}'.format(index), name='Security') for index in range(5)])
+    db.session.commit()
+    summary = refresh(url=stub_url)
+    assert summary['failed'] == []
+    assert summary['refreshed'] == 5
+    assert summary['rows'] == SecurityDailyAdjusted.query.count() == 5 * 300
+    # Stored history is recent, so the second pass fetches compact series and
+    # adds nothing
+    assert refresh(url=stub_url)['rows'] == 0
+
+
+def test_refresh_reports_failed_symbols_and_keeps_the_rest(app, stub_url, monkeypatch):
+    db.session.add_all([Security(symbol=symbol, name='Security') for symbol in ('GOOD1', 'GOOD2', 'BROKEN', '')])
+    db.session.commit()
+    upsert_price_rows = market_data.upsert_price_rows
+
+    def failing_upsert(kind, parent_id, symbol, rows):
+        if symbol == 'BROKEN':
+            raise IntegrityError('INSERT INTO security_daily_adjusted', {}, Exception('UNIQUE constraint failed'))
+        return upsert_price_rows(kind=kind, parent_id=parent_id, symbol=symbol, rows=rows)
+
+    monkeypatch.setattr(market_data, 'upsert_price_rows', failing_upsert)
+    summary = refresh(url=stub_url)
+    failed = dict(summary['failed'])
+    assert set(failed) == {'BROKEN', ''}
+    assert failed['BROKEN'].startswith('IntegrityError')
+    assert failed[''].startswith('ValueError')
+    assert summary['refreshed'] == 2
+    stored = dict(db.session.query(SecurityDailyAdjusted.symbol, db.func.count())
+                  .group_by(SecurityDailyAdjusted.symbol))
+    assert stored == {'GOOD1': 300, 'GOOD2': 300}